@@ -1,41 +1,311 @@
+import argparse
+import os
 import sys
-import time
 from datetime import datetime, timedelta
 
-from src.utils import constants
 from src.utils.logger import logger, log_execution_time
-from src.app import App
 
-@log_execution_time
-def main():
+DATE_FORMATS = ("%Y-%m-%d", "%d/%m/%Y", "%Y%m%d")
+
+def parse_date(value: str) -> datetime:
+    '''converte uma data da linha de comando (YYYY-MM-DD, DD/MM/YYYY ou YYYYMMDD) em datetime'''
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            continue
+    raise argparse.ArgumentTypeError(f"Data inválida: '{value}'. Utilize YYYY-MM-DD, DD/MM/YYYY ou YYYYMMDD.")
+
+def get_recipients(args) -> list:
+    '''retorna os destinatários passados por argumento ou, na ausência deles, a variável de ambiente MAIL_RECIPIENTS'''
+    if args.recipients:
+        return args.recipients
+
+    recipients = os.getenv("MAIL_RECIPIENTS", "")
+    return [recipient.strip() for recipient in recipients.split(",") if recipient.strip()]
+
+def get_deadline(args):
+    '''retorna o prazo da execução (--deadline ou RUN_DEADLINE, HH:MM) como a próxima ocorrência desse horário, ou None'''
+    deadline = args.deadline
+
+    if deadline is None and os.getenv("RUN_DEADLINE"):
+        deadline = parse_time(os.getenv("RUN_DEADLINE"))
+
+    if deadline is None:
+        return None
+
+    now = datetime.now()
+    deadline = datetime.combine(now.date(), deadline)
+    return deadline if deadline > now else deadline + timedelta(days=1)
+
+def preflight_ok(app, args, sources: list) -> bool:
+    '''executa o pré-voo das fontes informadas, a menos que --skip-preflight tenha sido passado'''
+    if args.skip_preflight:
+        return True
+
+    return app.preflight(sources=sources) == 0
+
+def run_check(args):
+    from src.app import App
+
+    app = App(diagnostics=args.diagnostics or None)
+
+    if not preflight_ok(app, args, ["protheus", "totalbus", "duckdb"]):
+        return 1
+
+    return app.check_shipping_tickets(
+        date=args.date, chunk_size=args.chunk_size, workers=args.workers, incremental=args.incremental or None, deadline=get_deadline(args), priority=args.priority
+    )
+
+def run_export(args):
+    from src.app import App
+    return App().generate_csv_files(date=args.date)
+
+def run_send(args):
+    from src.app import App
+    return App().send_email(date=args.date, recipients=get_recipients(args))
+
+def run_backfill(args):
+    from src.app import App
+
+    if args.end < args.start:
+        logger.error("A data final do intervalo é anterior à data inicial!")
+        return 1
+
+    app = App(diagnostics=args.diagnostics or None)
+
+    if not preflight_ok(app, args, ["protheus", "totalbus", "duckdb"]):
+        return 1
+
+    status = 0
+    date = args.start
+
+    while date <= args.end:
+        logger.info(f"Reprocessando fichas de remessa do dia {date.strftime("%d/%m/%Y")}...")
+        if app.check_shipping_tickets(date=date, chunk_size=args.chunk_size, workers=args.workers, incremental=args.incremental or None) != 0:
+            status = 1
+        date += timedelta(days=1)
+
+    return status
+
+def run_all(args):
+    # Fluxo completo: comparativo das fichas, exportação para .xlsx e, se houver destinatários, envio do e-mail
+    from src.app import App
+
+    app = App(diagnostics=args.diagnostics or None)
+    recipients = get_recipients(args)
+
+    sources = ["protheus", "totalbus", "duckdb"] + (["smtp"] if len(recipients) > 0 else [])
+    if not preflight_ok(app, args, sources):
+        return 1
+
+    status = app.check_shipping_tickets(
+        date=args.date, chunk_size=args.chunk_size, workers=args.workers, incremental=args.incremental or None, deadline=get_deadline(args), priority=args.priority
+    )
+    if status != 0:
+        return 1
+
+    if app.generate_csv_files(date=args.date) != 0:
+        return 1
+
+    if len(recipients) == 0:
+        logger.info("Nenhum destinatário configurado. O envio do e-mail não será feito.")
+        return 0
+
+    return app.send_email(date=args.date, recipients=recipients)
+
+def run_service(args):
+    from src.service import Service
+
+    service = Service(
+        interval_minutes=args.interval,
+        cutoff=args.cutoff,
+        recipients=get_recipients(args),
+        status_path=args.status_file,
+    )
+    return service.run()
+
+def run_tenants(args):
+    from src.tenants import TenantRunner, load_tenants
+
+    tenants = load_tenants(args.config)
+
+    if args.only:
+        tenants = [tenant for tenant in tenants if tenant.name in args.only]
+
+    runner = TenantRunner(tenants, workers=args.tenant_workers, diagnostics=args.diagnostics or None)
+    return runner.run(
+        date=args.date,
+        skip_preflight=args.skip_preflight,
+        chunk_size=args.chunk_size,
+        workers=args.workers,
+        incremental=args.incremental or None,
+        deadline=get_deadline(args),
+        priority=args.priority,
+    )
+
+def run_ingest(args):
+    from src.app import App
+    return App().ingest_sales(date=args.date, rebuild=args.rebuild)
+
+def run_status_api(args):
+    from src.status_api import StatusAPI
+    return StatusAPI(host=args.host, port=args.port).run()
+
+def run_trends(args):
+    from src.app import App
+
+    end_date = args.end or datetime.now()
+    start_date = args.start or end_date - timedelta(days=90)
+
+    report = App().get_discrepancy_trends(report=args.report, start_date=start_date, end_date=end_date, limit=args.limit)
+    if report is None:
+        return 1
+
+    print(report.to_string(index=False) if len(report) > 0 else "Nenhum dado encontrado no intervalo.")
+    return 0
+
+def run_preflight(args):
+    from src.app import App
+    return App().preflight(sources=args.sources, min_connections=args.min_connections)
+
+def run_coordinator(args):
+    from src.app import App
+
     app = App()
-    date = datetime(2025, 5, 6)
-
-    # Inicia comparativo de fichas de remessa
-    app.check_shipping_tickets(date=date)
-
-    # Inicia exportação para .xlsx
-    app.generate_csv_files(date=date)
-
-    # Envia o e-mail com os arquivos para os destinatários especificados
-    # recipients = [
-    #     "adriano.lipski@princesadoscampos.com.br",
-    #     "thelma.silva@princesadoscampos.com.br",
-    #     "marlon.siqueira@princesadoscampos.com.br",
-    #     "nayara.roca@princesadoscampos.com.br",
-    #     # "wesley.soares@princesadoscampos.com.br",
-    #     # "erinelson.santos@princesadoscampos.com.br"
-    # ]
-    # app.send_email(date=date, recipients=recipients)
-    logger.success("Processo concluído com sucesso!")
 
-if __name__ == "__main__":
-    if len(sys.argv) > 1:
-        logger.warning("Aviso! Argumentos de terminal serão ignorados.")
+    if not args.collect_only and not preflight_ok(app, args, ["protheus", "duckdb"]):
+        return 1
+
+    if not args.collect_only and app.enqueue_shipping_tickets(date=args.date) != 0:
+        return 1
+
+    return app.collect_shipping_tickets(date=args.date, timeout=args.timeout)
+
+def run_queue_worker(args):
+    from src.app import App
+
+    app = App()
+
+    if not preflight_ok(app, args, ["protheus", "totalbus"]):
+        return 1
+
+    return app.run_worker(worker_id=args.worker_id, once=args.once, idle_timeout=args.idle_timeout)
 
+def parse_time(value: str):
+    '''converte um horário da linha de comando (HH:MM) em time'''
     try:
-        main()
-    except Exception as e:
-        logger.error(f"Erro durante a execução: {str(e)}")
-        sys.exit(1)
-    sys.exit(0)
+        return datetime.strptime(value, "%H:%M").time()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Horário inválido: '{value}'. Utilize HH:MM.")
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="main.py",
+        description="Automação de conferência das fichas de remessa (Protheus x TotalBus).",
+    )
+    parser.add_argument("--profile", action="store_true", help="Grava perfis de tempo (wall-clock) e memória de cada etapa em logs/profile (padrão: PROFILE).")
+    subparsers = parser.add_subparsers(dest="command")
+
+    date_parser = argparse.ArgumentParser(add_help=False)
+    date_parser.add_argument("--date", "-d", type=parse_date, default=None, help="Data das fichas de remessa (padrão: D-1).")
+
+    preflight_parser = argparse.ArgumentParser(add_help=False)
+    preflight_parser.add_argument("--skip-preflight", action="store_true", help="Não testa as dependências antes de começar.")
+
+    chunk_parser = argparse.ArgumentParser(add_help=False)
+    chunk_parser.add_argument("--diagnostics", action="store_true", help="Grava planos e tempos das consultas no duck.db (padrão: QUERY_DIAGNOSTICS).")
+    chunk_parser.add_argument("--chunk-size", type=int, default=None, help="Processa as fichas em blocos desse tamanho (padrão: CHUNK_SIZE, 0 = desligado).")
+    chunk_parser.add_argument("--incremental", action="store_true", help="Usa os totais incrementais do TotalBus no duck.db (padrão: TOTALBUS_INCREMENTAL).")
+    chunk_parser.add_argument("--workers", type=int, default=None, help="Quantidade de fichas verificadas em paralelo (padrão: CHECK_WORKERS ou 1).")
+
+    deadline_parser = argparse.ArgumentParser(add_help=False)
+    deadline_parser.add_argument("--deadline", type=parse_time, default=None, help="Prazo da execução, HH:MM (padrão: RUN_DEADLINE). Fichas não verificadas até lá são registradas como pendentes.")
+    deadline_parser.add_argument("--priority", choices=["value", "history"], default=None, help="Ordem das fichas no modo prazo: valor de receita ou histórico de discrepâncias (padrão: DEADLINE_PRIORITY ou value).")
+
+    mail_parser = argparse.ArgumentParser(add_help=False)
+    mail_parser.add_argument("--recipients", "-r", nargs="+", default=None, help="Destinatários do e-mail (padrão: MAIL_RECIPIENTS).")
+
+    check = subparsers.add_parser("check", parents=[date_parser, preflight_parser, chunk_parser, deadline_parser], help="Faz o comparativo das fichas de remessa.")
+    check.set_defaults(handler=run_check)
+
+    export = subparsers.add_parser("export", parents=[date_parser], help="Gera as planilhas .xlsx a partir do duck.db.")
+    export.set_defaults(handler=run_export)
+
+    send = subparsers.add_parser("send", parents=[date_parser, mail_parser], help="Envia as planilhas por e-mail.")
+    send.set_defaults(handler=run_send)
+
+    backfill = subparsers.add_parser("backfill", parents=[preflight_parser, chunk_parser], help="Refaz o comparativo para um intervalo de datas.")
+    backfill.add_argument("--start", "-s", type=parse_date, required=True, help="Data inicial (inclusiva).")
+    backfill.add_argument("--end", "-e", type=parse_date, required=True, help="Data final (inclusiva).")
+    backfill.set_defaults(handler=run_backfill)
+
+    run = subparsers.add_parser("run", parents=[date_parser, mail_parser, preflight_parser, chunk_parser, deadline_parser], help="Comparativo, exportação e envio do e-mail.")
+    run.set_defaults(handler=run_all)
+
+    trends = subparsers.add_parser("trends", help="Consulta tendências de discrepância a partir dos resumos diários.")
+    trends.add_argument("report", choices=["agencies", "reasons", "durations"], help="Relatório desejado.")
+    trends.add_argument("--start", "-s", type=parse_date, default=None, help="Data inicial (padrão: 90 dias antes da final).")
+    trends.add_argument("--end", "-e", type=parse_date, default=None, help="Data final (padrão: hoje).")
+    trends.add_argument("--limit", "-l", type=int, default=10, help="Quantidade máxima de linhas.")
+    trends.set_defaults(handler=run_trends)
+
+    coordinator = subparsers.add_parser("coordinator", parents=[date_parser, preflight_parser], help="Enfileira as fichas do dia para os workers e coleta os resultados.")
+    coordinator.add_argument("--collect-only", action="store_true", help="Não enfileira novamente, apenas aguarda e coleta os resultados.")
+    coordinator.add_argument("--timeout", "-t", type=float, default=None, help="Tempo máximo de espera pelos workers, em segundos.")
+    coordinator.set_defaults(handler=run_coordinator)
+
+    worker = subparsers.add_parser("worker", parents=[preflight_parser], help="Processa itens da fila de trabalho do modo distribuído.")
+    worker.add_argument("--worker-id", default=None, help="Identificador do worker (padrão: host:pid).")
+    worker.add_argument("--once", action="store_true", help="Encerra assim que a fila estiver vazia.")
+    worker.add_argument("--idle-timeout", type=float, default=None, help="Encerra após esse tempo ocioso, em segundos.")
+    worker.set_defaults(handler=run_queue_worker)
+
+    preflight = subparsers.add_parser("preflight", help="Testa as conexões com todas as dependências e mede o tempo de resposta.")
+    preflight.add_argument("--sources", nargs="+", default=None, choices=["protheus", "totalbus", "duckdb", "smtp"], help="Fontes a testar (padrão: todas).")
+    preflight.add_argument("--min-connections", type=int, default=None, help="Conexões abertas por banco (padrão: PREFLIGHT_MIN_CONNECTIONS ou 1).")
+    preflight.set_defaults(handler=run_preflight)
+
+    serve = subparsers.add_parser("serve", parents=[mail_parser], help="Executa em modo serviço, com passadas ao longo do dia.")
+    serve.add_argument("--interval", "-i", type=int, default=None, help="Minutos entre as passadas intradiárias (padrão: SERVICE_INTERVAL_MINUTES ou 60).")
+    serve.add_argument("--cutoff", "-c", type=parse_time, default=None, help="Horário de corte da passada final, HH:MM (padrão: SERVICE_CUTOFF ou 23:30).")
+    serve.add_argument("--status-file", default=None, help="Caminho do arquivo de status do serviço (padrão: database/service_status.json).")
+    serve.set_defaults(handler=run_service)
+
+    tenants = subparsers.add_parser("tenants", parents=[date_parser, preflight_parser, chunk_parser, deadline_parser], help="Fluxo completo de todos os tenants em um único processo.")
+    tenants.add_argument("--config", default=None, help="Arquivo de configuração dos tenants (padrão: TENANTS_FILE ou tenants.json).")
+    tenants.add_argument("--only", nargs="+", default=None, help="Executa apenas os tenants informados.")
+    tenants.add_argument("--tenant-workers", type=int, default=None, help="Tenants executados ao mesmo tempo (padrão: TENANT_WORKERS ou todos).")
+    tenants.set_defaults(handler=run_tenants)
+
+    ingest = subparsers.add_parser("ingest", help="Ingestão incremental das vendas do TotalBus no duck.db.")
+    ingest.add_argument("--date", "-d", type=parse_date, default=None, help="Data da ficha; são lidas as vendas do dia anterior a ela (padrão: amanhã, ou seja, as vendas de hoje).")
+    ingest.add_argument("--rebuild", action="store_true", help="Descarta os totais do dia e lê o dia inteiro novamente.")
+    ingest.set_defaults(handler=run_ingest)
+
+    api = subparsers.add_parser("api", help="Sobe a API HTTP/JSON somente leitura sobre o duck.db.")
+    api.add_argument("--host", default=None, help="Endereço da API (padrão: STATUS_API_HOST ou 127.0.0.1).")
+    api.add_argument("--port", "-p", type=int, default=None, help="Porta da API (padrão: STATUS_API_PORT ou 8080).")
+    api.set_defaults(handler=run_status_api)
+
+    return parser
+
+@log_execution_time
+def main(args):
+    if args.profile:
+        from src.utils.profiler import profiler
+        profiler.enable()
+
+    return args.handler(args)
+
+if __name__ == "__main__":
+    parser = build_parser()
+    args = parser.parse_args()
+
+    # Sem subcomando, mantém o comportamento antigo: fluxo completo para D-1
+    if args.command is None:
+        args = parser.parse_args([*sys.argv[1:], "run"])
+
+    # log_execution_time retorna None quando a execução é interrompida por uma exceção
+    status = main(args)
+    sys.exit(1 if status is None else status)
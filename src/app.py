@@ -1,26 +1,223 @@
+import contextvars
 import os
-import pandas as pd
-import smtplib
-import ssl
 import traceback
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
-from email import encoders
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.base import MIMEBase
-
-from .classes.Protheus import Protheus
-from .classes.TotalBus import TotalBus
-from .classes.DuckConnector import DuckConnector
-from .utils import constants
+
+# Os módulos pesados (pandas, SQLAlchemy, duckdb, drivers de banco e smtplib) são importados dentro de cada etapa,
+# para que um subcomando da CLI carregue apenas o que ele realmente utiliza.
+from .utils import constants, money
 from .utils.logger import logger
-from .utils.constants import YESTERDAY
+from .utils.profiler import profile_stage, profiler
+from .utils.templates import read_template
 
 load_dotenv()
 
 class App():
-    def check_shipping_tickets(self, date: datetime = None):
+    def __init__(self, diagnostics: bool = None, profile: bool = None, tenant = None, duck_connection = None):
+        # Os conectores são criados na primeira vez em que são utilizados e ficam guardados na instância. Dessa forma,
+        # um processo de longa duração (modo serviço) reaproveita as engines, os pools de conexão e a conexão com o
+        # duck.db entre uma execução e outra.
+        #
+        # 'diagnostics' liga o modo de diagnóstico das consultas (padrão: QUERY_DIAGNOSTICS), e 'profile' liga o perfil
+        # de tempo e memória das etapas (padrão: PROFILE).
+        #
+        # Os valores do Protheus e do TotalBus são comparados em centavos, com a tolerância MONEY_TOLERANCE_CENTS
+        # (padrão: 0, valores exatamente iguais).
+        #
+        # Com 'tenant' (ver tenants.py), a instância usa as credenciais, o schema do duck.db e a pasta das planilhas
+        # do tenant. 'duck_connection' é a conexão com o duck.db compartilhada pelos tenants de uma mesma execução.
+        self.tenant = tenant
+        self.shared_duck_connection = duck_connection
+        self.csv_path = tenant.output_path if tenant is not None else constants.CSV_PATH
+
+        self._duck_connector = None
+        self._protheus_connector = None
+        self._totalbus_connector = None
+
+        if diagnostics is None:
+            diagnostics = os.getenv("QUERY_DIAGNOSTICS", "0").lower() in ("1", "true", "sim")
+
+        self.diagnostics_enabled = diagnostics
+        self.money_tolerance_cents = money.get_tolerance_cents()
+
+        if profile is None:
+            profile = os.getenv("PROFILE", "0").lower() in ("1", "true", "sim")
+
+        if profile:
+            profiler.enable()
+
+    @property
+    def duck_connector(self):
+        if self._duck_connector is None:
+            from .classes.DuckConnector import DuckConnector
+
+            if self.tenant is None:
+                self._duck_connector = DuckConnector()
+            else:
+                self._duck_connector = DuckConnector(schema=self.tenant.schema, csv_folder=self.csv_path, connection=self.shared_duck_connection)
+
+        return self._duck_connector
+
+    @property
+    def protheus_connector(self):
+        if self._protheus_connector is None:
+            from .classes.Protheus import Protheus
+            self._protheus_connector = Protheus(env_prefix=self.tenant.env_prefix if self.tenant is not None else "")
+
+        return self._protheus_connector
+
+    @property
+    def totalbus_connector(self):
+        if self._totalbus_connector is None:
+            from .classes.TotalBus import TotalBus
+            self._totalbus_connector = TotalBus(env_prefix=self.tenant.env_prefix if self.tenant is not None else "")
+
+        return self._totalbus_connector
+
+    def start_diagnostics(self):
+        # Cria o QueryDiagnostics da execução e o associa aos conectores, se o modo de diagnóstico estiver ligado.
+        if not self.diagnostics_enabled:
+            return None
+
+        from .classes.QueryDiagnostics import QueryDiagnostics
+
+        diagnostics = QueryDiagnostics()
+        self.protheus_connector.diagnostics = diagnostics
+        self.totalbus_connector.diagnostics = diagnostics
+
+        logger.info(f"Modo de diagnóstico das consultas ligado (run_id {diagnostics.run_id}).")
+        return diagnostics
+
+    def finish_diagnostics(self, diagnostics):
+        # Desassocia o diagnóstico dos conectores e grava o resultado no duck.db. Um erro aqui nunca interrompe a execução.
+        if diagnostics is None:
+            return None
+
+        self.protheus_connector.diagnostics = None
+        self.totalbus_connector.diagnostics = None
+
+        try:
+            return diagnostics.flush(self.duck_connector)
+        except Exception as e:
+            logger.error(f"Não foi possível gravar o diagnóstico das consultas: {e}")
+            tb_str = traceback.format_exc()
+            logger.error(f"\n{tb_str}")
+            return None
+
+    def get_scheduler_stats(self) -> list:
+        # Contadores dos escalonadores de consultas dos conectores já criados (ver QueryScheduler.get_stats)
+        connectors = (self._protheus_connector, self._totalbus_connector)
+        return [connector.scheduler.get_stats() for connector in connectors if connector is not None and connector.scheduler is not None]
+
+    def release_duck_connector(self):
+        # Fecha apenas a conexão com o duck.db, para que outros processos (ex: a API de status) possam lê-lo enquanto
+        # a instância está ociosa. A conexão é reaberta no próximo uso.
+        if self._duck_connector is not None:
+            self._duck_connector.close()
+            self._duck_connector = None
+
+    def close(self):
+        # Libera os pools de conexão e fecha o duck.db. Os conectores são recriados se a instância for usada novamente.
+        if self._protheus_connector is not None:
+            self._protheus_connector.dispose()
+            self._protheus_connector = None
+
+        if self._totalbus_connector is not None:
+            self._totalbus_connector.dispose()
+            self._totalbus_connector = None
+
+        if self._duck_connector is not None:
+            self._duck_connector.close()
+            self._duck_connector = None
+
+    @profile_stage("preflight")
+    def preflight(self, sources: list = None, min_connections: int = None):
+        # Esta função faz o pré-voo da execução: testa, ao mesmo tempo, todas as dependências em 'sources' antes do
+        # trabalho começar, para que uma dependência fora do ar interrompa a execução em segundos.
+        #
+        # Fontes disponíveis:
+        # - protheus / totalbus: abre 'min_connections' conexões do pool (padrão: PREFLIGHT_MIN_CONNECTIONS ou 1) e
+        #   executa uma consulta trivial, deixando o pool aquecido para o comparativo
+        # - duckdb: abre o duck.db local
+        # - smtp: conecta no servidor SMTP e faz o login com as credenciais do .env
+        #
+        # O tempo de resposta de cada fonte é registrado no log. A função retorna 0 se todas as fontes responderem,
+        # e 1 caso contrário.
+
+        import time
+        from concurrent.futures import ThreadPoolExecutor
+
+        if sources is None:
+            sources = ["protheus", "totalbus", "duckdb", "smtp"]
+
+        if min_connections is None:
+            min_connections = int(os.getenv("PREFLIGHT_MIN_CONNECTIONS", "1"))
+
+        probes = {
+            "protheus": lambda: self.protheus_connector.warm_up(min_connections=min_connections),
+            "totalbus": lambda: self.totalbus_connector.warm_up(min_connections=min_connections),
+            "duckdb": self.probe_duckdb,
+            "smtp": self.probe_smtp,
+        }
+
+        def run_probe(source):
+            started_at = time.perf_counter()
+
+            try:
+                if source not in probes:
+                    raise ValueError(f"Fonte desconhecida. Opções: {", ".join(probes)}.")
+
+                return source, probes[source](), None
+            except Exception as e:
+                return source, time.perf_counter() - started_at, e
+
+        logger.info(f"Iniciando pré-voo: {", ".join(sources)}...")
+
+        with ThreadPoolExecutor(max_workers=max(len(sources), 1)) as executor:
+            results = list(executor.map(run_probe, sources))
+
+        status = 0
+        for source, latency, error in results:
+            if error is None:
+                logger.info(f"Pré-voo {source}: OK em {latency * 1000:.0f} ms.")
+            else:
+                logger.error(f"Pré-voo {source}: falhou após {latency * 1000:.0f} ms. Motivo: {error}")
+                status = 1
+
+        if status == 0:
+            logger.success("Pré-voo concluído. Todas as dependências estão respondendo.")
+        else:
+            logger.error("Pré-voo falhou. A execução será interrompida.")
+
+        return status
+
+    def probe_duckdb(self) -> float:
+        import time
+
+        started_at = time.perf_counter()
+        self.duck_connector.duck_connection.execute("SELECT 1").fetchall()
+        return time.perf_counter() - started_at
+
+    def probe_smtp(self) -> float:
+        import smtplib
+        import ssl
+        import time
+
+        timeout = int(os.getenv("DB_CONNECT_TIMEOUT", "10"))
+        started_at = time.perf_counter()
+
+        with smtplib.SMTP(constants.SMTP_SERVER, constants.SMTP_PORT, timeout=timeout) as server:
+            server.ehlo()
+            server.starttls(context=ssl.create_default_context())
+            server.ehlo()
+            server.login(os.getenv("SMTP_USER"), os.getenv("SMTP_PASSWORD"))
+
+        return time.perf_counter() - started_at
+
+    @profile_stage("check_shipping_tickets")
+    def check_shipping_tickets(self, date: datetime = None, chunk_size: int = None, workers: int = None,
+                               deadline: datetime = None, priority: str = None, incremental: bool = None):
         # Esta função é a função principal da automação. É ela quem vai fazer a checagem das fichas de remessa
         #
         # A função comeca puxando as fichas de remessa existentes no Protheus, e daí faz o comparativo com as
@@ -33,176 +230,783 @@ class App():
         #
         # Após a checagem, as informações de quais fichas e agências estão corretas ou discrepantes é armazenada no
         # banco de dados, com a data de verificação. Fichas discrepantes devem conter uma mensagem do quê está
-        # discrepante na conferência dos bilhetes.
+        # discrepante na conferência dos bilhetes. Os resumos diários (DiscrepancyHistory) só são atualizados quando
+        # todas as fichas do dia foram verificadas sem erro.
         # 
         # Se a data não for especificada, a função irá utilizar o dia anterior ao de sua execução como padrão.
+        #
+        # Com 'chunk_size' (padrão: CHUNK_SIZE, 0 = desligado), as fichas são lidas do Protheus em blocos desse tamanho,
+        # e cada bloco é comparado e gravado no duck.db antes do próximo ser lido. Assim, o uso de memória depende do
+        # tamanho do bloco, e não da quantidade de fichas do dia.
+        #
+        # Com 'workers' (padrão: CHECK_WORKERS = 1, sequencial), as fichas de cada bloco são verificadas em paralelo. A
+        # quantidade de consultas simultâneas em cada banco é controlada pelo escalonador de cada conector
+        # (QueryScheduler), e não pela quantidade de workers. Em paralelo, cada linha do log leva a empresa, a agência e
+        # o número da ficha em verificação, já que as linhas de fichas diferentes se intercalam.
+        #
+        # Com 'deadline' (modo prazo), a execução tem um horário limite. As fichas são ordenadas por prioridade
+        # (ver prioritize_tickets) e verificadas em blocos, que são gravados à medida que terminam. Quando o horário
+        # limite, descontada a reserva para a exportação e o e-mail (DEADLINE_RESERVE_MINUTES = 15), é atingido, as
+        # fichas restantes não são verificadas e ficam registradas na tabela unchecked_tickets. Nesse modo, todas as
+        # fichas são lidas de uma vez para serem ordenadas, e 'chunk_size' passa a ser apenas o tamanho dos blocos
+        # (padrão: DEADLINE_BATCH_SIZE = 50). Fichas que já estavam em verificação no horário limite são concluídas.
+        #
+        # Com 'incremental' (padrão: TOTALBUS_INCREMENTAL), as vendas e transações extras do TotalBus são lidas pela
+        # ingestão incremental (ver ingest_sales): apenas o trecho posterior à última ingestão é consultado no Oracle, e
+        # os valores de cada agência vêm dos totais pré-agregados no duck.db. Se a ingestão falhar, o comparativo
+        # consulta o Oracle normalmente.
         # 
-        # A função retorna 0 se não houver nenhum erro durante a sua execução, e 1 caso contrário.
+        # A função retorna 0 se não houver nenhum erro durante a sua execução, e 1 caso contrário. Fichas deixadas sem
+        # verificação pelo modo prazo não são consideradas um erro.
 
         if date is None:
             logger.warning("Nenhuma data foi passada! Utilizando D-1...")
-            date = constants.YESTERDAY
+            date = constants.get_yesterday()
+
+        if chunk_size is None:
+            chunk_size = int(os.getenv("CHUNK_SIZE", "0"))
+
+        if workers is None:
+            workers = int(os.getenv("CHECK_WORKERS", "1"))
+
+        if incremental is None:
+            incremental = os.getenv("TOTALBUS_INCREMENTAL", "0").lower() in ("1", "true", "sim")
+
+        from concurrent.futures import ThreadPoolExecutor
+        from .classes.DiscrepancyHistory import DiscrepancyHistory, DiscrepancyRollup
 
         logger.info("Iniciando processo de comparação de fichas de remessa...")
 
-        duck_connector = DuckConnector()
-        protheus_connector = Protheus()
-        totalbus_connector = TotalBus()
+        protheus_connector = self.protheus_connector
+        totalbus_connector = self.totalbus_connector
+
+        # O cache de consultas do TotalBus vale apenas para esta execução
+        totalbus_connector.clear_cache()
+
+        # Com o modo de diagnóstico ligado, os planos e tempos das consultas desta execução são gravados no duck.db
+        diagnostics = self.start_diagnostics()
+
+        # Horário a partir do qual nenhuma ficha nova é verificada (modo prazo) e fichas que ficaram sem verificação
+        cutoff = None
+        unchecked_tickets = []
 
-        shipping_tickets = protheus_connector.get_shipping_ticket_summary(date=date)
+        try:
+            if incremental:
+                self.load_local_totals(date=date)
+
+            if chunk_size > 0 and deadline is None:
+                # Modo em blocos: as fichas são lidas, comparadas e gravadas bloco a bloco
+                logger.info(f"Processando as fichas de remessa em blocos de {chunk_size}.")
+                chunks = protheus_connector.iter_shipping_ticket_summary(date=date, chunk_size=chunk_size)
+                total_tickets = None
+            else:
+                shipping_tickets = protheus_connector.get_shipping_ticket_summary(date=date)
+            
+                if shipping_tickets is None:
+                    logger.error("Não foi possível receber as fichas de remessa do Protheus...")
+                    return 1
+                else:
+                    logger.success("Fichas de remessa obtidas com sucesso!")
+
+                total_tickets = len(shipping_tickets)
+
+                if deadline is not None:
+                    shipping_tickets = self.prioritize_tickets(shipping_tickets, date=date, priority=priority)
+
+                    batch_size = chunk_size if chunk_size > 0 else int(os.getenv("DEADLINE_BATCH_SIZE", "50"))
+                    chunks = [shipping_tickets[i:i + batch_size] for i in range(0, total_tickets, batch_size)]
+
+                    cutoff = deadline - timedelta(minutes=int(os.getenv("DEADLINE_RESERVE_MINUTES", "15")))
+                    logger.info(
+                        f"Modo prazo: fichas verificadas até {cutoff.strftime("%d/%m/%Y %H:%M")} "
+                        f"(prazo final {deadline.strftime("%d/%m/%Y %H:%M")}), em blocos de {batch_size}."
+                    )
+                else:
+                    chunks = [shipping_tickets]
+
+            # Os resumos diários são acumulados bloco a bloco e gravados uma única vez no final
+            rollup = DiscrepancyRollup()
+            processed_tickets = 0
+            status = 0
+
+            def check(numbered_ticket):
+                number, ticket = numbered_ticket
+
+                if cutoff is not None and datetime.now() >= cutoff:
+                    unchecked_tickets.append(ticket)
+                    return None
+
+                if workers <= 1:
+                    logger.info("-" * 100)
+                    logger.info(f"Verificando ficha de remessa {number}/{total_tickets or "?"}...")
+                    return self.check_ticket(ticket=ticket, date=date)
+
+                with logger.contextualize(ticket=f"[{ticket.associated_company.strip()} {ticket.agency_name.strip()} {ticket.ticket_number}] "):
+                    logger.info(f"Verificando ficha de remessa {number}/{total_tickets or "?"}...")
+                    return self.check_ticket(ticket=ticket, date=date)
+
+            try:
+                with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+                    for chunk in chunks:
+                        if cutoff is not None and datetime.now() >= cutoff:
+                            unchecked_tickets.extend(chunk)
+                            continue
+
+                        valid_tickets = []
+                        incongruent_tickets = []
+
+                        # executor.map devolve os resultados na ordem das fichas
+                        numbered_tickets = list(enumerate(chunk, start=processed_tickets + 1))
+                        if workers > 1:
+                            # As threads do executor não herdam o contexto do log (ex: o tenant da execução)
+                            log_context = contextvars.copy_context()
+                            results = executor.map(lambda numbered_ticket: log_context.copy().run(check, numbered_ticket), numbered_tickets)
+                        else:
+                            results = map(check, numbered_tickets)
+
+                        for result in results:
+                            if result is None:
+                                continue
+
+                            if result.valid:
+                                valid_tickets.append(result)
+                            else:
+                                incongruent_tickets.append(result)
+
+                        processed_tickets += len(numbered_tickets)
+                        self.write_results(valid_tickets=valid_tickets, incongruent_tickets=incongruent_tickets)
+
+                        # As fichas do bloco deixam de constar como não verificadas de uma execução anterior do dia. No
+                        # modo prazo, as que ficaram sem verificação neste bloco são gravadas novamente no final.
+                        self.write_unchecked_tickets(shipping_tickets=chunk, unchecked_tickets=[])
+                        rollup.add_all(valid_tickets)
+                        rollup.add_all(incongruent_tickets)
+            except Exception as e:
+                logger.error(f"Não foi possível continuar a leitura das fichas de remessa após {processed_tickets} fichas.")
+                logger.error(f"Motivo: {e}")
+                tb_str = traceback.format_exc()
+                logger.error(f"\n{tb_str}")
+                status = 1
         
-        if shipping_tickets is None:
-            logger.error("Não foi possível receber as fichas de remessa do Protheus...")
-            return 1
-        else:
-            logger.success("Fichas de remessa obtidas com sucesso!")
+            # No modo prazo, as fichas pendentes são gravadas antes de qualquer retorno, inclusive quando o prazo já
+            # estava esgotado antes da primeira ficha
+            if deadline is not None:
+                self.write_unchecked_tickets(shipping_tickets=unchecked_tickets, unchecked_tickets=unchecked_tickets)
+                self.log_deadline_coverage(shipping_tickets=shipping_tickets, unchecked_tickets=unchecked_tickets)
+
+            if processed_tickets == 0 and len(unchecked_tickets) == 0 and status == 0:
+                logger.info("Não há nenhuma ficha de remessa para avaliar hoje!")
+                return 0
+
+            logger.info("-"*100)
+
+            cache_stats = totalbus_connector.get_cache_stats()
+            logger.info(f"Cache de consultas do TotalBus: {cache_stats["hits"]} acertos, {cache_stats["misses"]} consultas ao banco.")
+
+            for stats in self.get_scheduler_stats():
+                logger.info(
+                    f"Escalonador {stats["source"]}: {stats["completed"]} consultas, concorrência final {stats["limit"]}/{stats["max_concurrency"]}, "
+                    f"{stats["increases"]} aumentos, {stats["decreases"]} reduções, {stats["errors"]} erros, {stats["slow"]} consultas lentas, "
+                    f"{stats["wait_time"]:.1f} s de espera na fila."
+                )
+
+            # Os resumos do dia são substituídos pelos desta execução, então só são gravados quando ela verificou todas
+            # as fichas. Uma execução parcial (prazo esgotado ou leitura interrompida) trocaria os totais do dia
+            # inteiro pelos de uma parte das fichas.
+            if status == 0 and len(unchecked_tickets) == 0:
+                DiscrepancyHistory(self.duck_connector).save_rollup(date=date, rollup=rollup)
+            else:
+                logger.warning("Execução parcial: os resumos diários do dia não serão alterados.")
+
+            if status == 0:
+                logger.success("Comparativo concluído com sucesso!")
 
-        if len(shipping_tickets) == 0:
-            logger.info("Não há nenhuma ficha de remessa para avaliar hoje!")
+            return status
+        finally:
+            totalbus_connector.clear_local_totals()
+            self.finish_diagnostics(diagnostics)
+
+    @profile_stage("ingest_sales")
+    def ingest_sales(self, date: datetime = None, rebuild: bool = False):
+        # Esta função faz a ingestão incremental das vendas e transações extras do TotalBus no duck.db (SalesIngestion),
+        # lendo apenas as linhas posteriores à última ingestão. Pode ser agendada em intervalos ao longo do dia, para
+        # que o comparativo só precise ler o último trecho. Com 'rebuild', os totais do dia são descartados e lidos
+        # novamente do zero.
+        #
+        # 'date' é a data da ficha, e as vendas lidas são as do dia anterior a ela (ver SalesIngestion). Se a data não
+        # for especificada, a função lê o dia de vendas em andamento (hoje), ou seja, a ficha de amanhã.
+        #
+        # A função retorna 0 se a ingestão for concluída, e 1 caso contrário.
+
+        if date is None:
+            date = datetime.now() + timedelta(days=1)
+            logger.info(f"Nenhuma data foi passada! Lendo as vendas em andamento do dia {datetime.now().strftime("%d/%m/%Y")}...")
+
+        from .classes.SalesIngestion import SalesIngestion
+
+        try:
+            rows = SalesIngestion(self.totalbus_connector, self.duck_connector).ingest(date=date, rebuild=rebuild)
+            logger.success(f"Ingestão incremental concluída: {rows} linhas novas.")
             return 0
+        except Exception as e:
+            logger.error("Não foi possível concluir a ingestão incremental do TotalBus.")
+            logger.error(f"Motivo: {e}")
+            tb_str = traceback.format_exc()
+            logger.error(f"\n{tb_str}")
+            return 1
 
-        valid_tickets = []
-        incongruent_tickets = []
-        
-        for i, ticket in enumerate(shipping_tickets.itertuples()):
-            try:
-                agency_name = ticket.agency_name.strip()
-                agency_code = ticket.agency_code.strip()
-                associated_company = ticket.associated_company.strip()
-
-                logger.info("-" * 100)
-                logger.info(f"Verificando ficha de remessa {i+1}/{len(shipping_tickets)}...")
-                logger.info(f"Nome da agência: {agency_name}.")
-                logger.info(f"Empresa: {associated_company}")
-                logger.info(f"Código da agência: {agency_code}.")
-
-                # Ignora fichas de remessa vazias
-                if float(ticket.receipt) == 0.0:
-                    logger.info("Ficha vazia! Pulando...")
-                    valid_tickets.append({
-                        "nome_agencia": agency_name,
-                        "cod_agencia_protheus": agency_code,
-                        "num_ficha_protheus": ticket.ticket_number,
-                        "observacao": "Ficha de remessa zerada."
-                    })
-                    continue
+    def load_local_totals(self, date: datetime):
+        # Lê o último trecho do TotalBus e passa a responder as consultas do TotalBus da ficha 'date' com os totais
+        # pré-agregados. Se a ingestão falhar, ou se ela ainda não cobrir o dia de vendas inteiro (ex: uma execução
+        # logo após a meia-noite, dentro de INGESTION_LAG_MINUTES), as consultas continuam sendo feitas direto no Oracle.
+        from .classes.SalesIngestion import SalesIngestion
+
+        if self.ingest_sales(date=date) != 0:
+            logger.warning("Os valores do TotalBus serão consultados diretamente no Oracle.")
+            return 1
+
+        ingestion = SalesIngestion(self.totalbus_connector, self.duck_connector)
+
+        if not ingestion.covers_sales_day(date=date):
+            logger.warning("A ingestão incremental ainda não cobre o dia de vendas inteiro. Os valores do TotalBus serão consultados diretamente no Oracle.")
+            return 1
+
+        totals = ingestion.load_totals(date=date)
+        self.totalbus_connector.set_local_totals(date=date, totals=totals)
+
+        logger.info(
+            f"Comparativo usando os totais incrementais do TotalBus: {len(totals["shipping_report"])} agências com vendas, "
+            f"{len(totals["extra_events"])} com transações extras."
+        )
+        return 0
+
+    def write_results(self, valid_tickets: list, incongruent_tickets: list):
+        # Grava os resultados do comparativo (listas de ReconciliationResult) nas tabelas valid_tickets e
+        # incongruent_tickets do duck.db.
+        #
+        # Uma ficha (empresa, código da agência e número da ficha) fica em uma única linha de uma única tabela: as
+        # fichas desta execução são removidas das duas tabelas antes da gravação. Assim, quando o resultado de uma
+        # ficha muda entre duas passadas do mesmo dia (ex: modo serviço), a ficha não fica nas duas planilhas. As linhas
+        # gravadas antes da coluna empresa existir (empresa nula) também são substituídas.
+
+        import pandas as pd
+        from .classes.Records import results_to_dataframe
+
+        duck_connector = self.duck_connector
+        duck_connection = duck_connector.duck_connection
+        tables = (
+            ("valid_tickets", valid_tickets, "observacao"),
+            ("incongruent_tickets", incongruent_tickets, "motivo_erro"),
+        )
+
+        run_keys = pd.DataFrame(
+            [(result.associated_company, result.agency_code, result.ticket_number) for result in valid_tickets + incongruent_tickets],
+            columns=["empresa", "cod_agencia_protheus", "num_ficha_protheus"],
+        )
+
+        if len(run_keys) == 0:
+            return None
+
+        existing_tables = {
+            row[0]
+            for row in duck_connection.execute(
+                "SELECT table_name FROM information_schema.tables WHERE table_schema = current_schema()"
+            ).fetchall()
+        }
+
+        duck_connection.register("run_keys_df", run_keys)
+
+        try:
+            duck_connection.execute("BEGIN TRANSACTION")
 
-                # Procura ticket no TotalBus
-                totalbus_tickets = totalbus_connector.get_agency_shipping_report(date=date, agency_name=agency_name)
-                observation_message = ""
-                incongruence_message = ""
-
-                if totalbus_tickets is None:
-                    logger.error(f"Houve um erro ao procurar pela ficha da agência {agency_name} no TotalBus. Pulando...")
-                    incongruent_tickets.append({
-                        "nome_agencia": agency_name,
-                        "cod_agencia_protheus": agency_code,
-                        "num_ficha_protheus": ticket.ticket_number,
-                        "motivo_erro": "Ocorreu um erro ao buscar a ficha da agência no TotalBus.",
-                    })
+            for table_name, _, _ in tables:
+                if table_name not in existing_tables:
                     continue
 
-                # 1 - Verifica se o valor de receita do Protheus é o mesmo do TotalBus
-                receipt_matching = False
-                for totalbus_ticket in totalbus_tickets:
-                    if round(totalbus_ticket["receipt_total"], 2) == round(float(ticket.receipt), 2):
-                        receipt_matching = True
-                
-                if not receipt_matching:
-                    incongruence_message += ";Valor da receita não está batendo."
+                duck_connection.execute(f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS empresa VARCHAR")
+                duck_connection.execute(f"""
+                    DELETE FROM {table_name}
+                    WHERE EXISTS (
+                        SELECT 1
+                        FROM run_keys_df r
+                        WHERE r.cod_agencia_protheus = {table_name}.cod_agencia_protheus
+                            AND r.num_ficha_protheus = {table_name}.num_ficha_protheus
+                            AND ({table_name}.empresa IS NULL OR r.empresa = {table_name}.empresa)
+                    )
+                """)
 
-                # Procura detalhes de receitas e despesas no Protheus e TotalBus
-                protheus_details = protheus_connector.get_shipping_details(date=date, agency_code=agency_code, associated_company=associated_company)
-                totalbus_extra_events = totalbus_connector.get_agency_extra_events(date=date, agency_name=agency_name)
-                totalbus_cancelled_total = totalbus_connector.get_agency_cancelled_total(date=date, agency_name=agency_name)
+            for table_name, results, message_column in tables:
+                if len(results) > 0:
+                    duck_connector.upsert_data(df=results_to_dataframe(results, message_column), table_name=table_name, update_schema=True)
 
-                # Cálculo do valor total cancelado ou devolvido, do Protheus e TotalBus
-                protheus_cancelled_total = 0
-                protheus_find_cancelled_transactions = protheus_details.loc[protheus_details["transaction_description"].str.contains("BILHETE CANCELADO", na=False)]
+            duck_connection.execute("COMMIT")
+        except Exception:
+            duck_connection.execute("ROLLBACK")
+            raise
+        finally:
+            duck_connection.unregister("run_keys_df")
 
-                if len(protheus_find_cancelled_transactions) > 0:
-                    protheus_cancelled_total += float(protheus_find_cancelled_transactions.iloc[0]["transaction_value"])
-                
-                protheus_find_returned_transactions = protheus_details.loc[protheus_details["transaction_description"].str.contains("BILHETE DEVOLVIDO", na=False)]
+        duck_connector.mark_data_changed()
 
-                if len(protheus_find_returned_transactions) > 0:
-                    protheus_cancelled_total += float(protheus_find_returned_transactions.iloc[0]["transaction_value"])
+    def prioritize_tickets(self, shipping_tickets: list, date: datetime, priority: str = None) -> list:
+        # Ordena as fichas para o modo prazo, das mais importantes para as menos importantes:
+        # - 'value': pelo valor de receita da ficha (G6X_VLRREI)
+        # - 'history': pela taxa de dias discrepantes da agência nos últimos DEADLINE_HISTORY_DAYS (padrão: 30) dias,
+        #   segundo os resumos diários (daily_agency_summary), com o valor de receita como desempate
+        #
+        # O padrão é DEADLINE_PRIORITY ou 'value'.
+        if priority is None:
+            priority = os.getenv("DEADLINE_PRIORITY", "value")
 
-                # 2 - Verifica bilhetes cancelados e devolvidos em ambas as plataformas
-                cancelled_matching = False
+        def ticket_value(ticket):
+            return ticket.receipt_cents or 0
 
-                if protheus_cancelled_total == 0 and len(totalbus_cancelled_total) == 0:
-                    observation_message += ";Não há bilhetes cancelados e devolvidos."
-                    cancelled_matching = True
+        if priority == "history":
+            from .classes.DiscrepancyHistory import DiscrepancyHistory
 
-                for totalbus_ticket in totalbus_cancelled_total:
-                    if round(totalbus_ticket["cancelled_total"], 2) == round(protheus_cancelled_total, 2):
-                        cancelled_matching = True
+            history_days = int(os.getenv("DEADLINE_HISTORY_DAYS", "30"))
+            rates = DiscrepancyHistory(self.duck_connector).get_agency_discrepancy_rates(
+                start_date=date - timedelta(days=history_days),
+                end_date=date - timedelta(days=1),
+            )
 
-                if not cancelled_matching:
-                    incongruence_message += ";Valores de bilhetes cancelados e devolvidos não batem."
+            logger.info(f"Fichas ordenadas pelo histórico de discrepâncias de {len(rates)} agências.")
+            return sorted(
+                shipping_tickets,
+                key=lambda ticket: (rates.get((ticket.associated_company.strip(), ticket.agency_name.strip()), 0.0), ticket_value(ticket)),
+                reverse=True,
+            )
 
-                # 3 - Verifica se há despesas extras ou receitas extras registradas no Protheus
-                for extra_event in totalbus_extra_events:
-                    protheus_find_extra_event = protheus_details.loc[protheus_details["transaction_description"].str.contains(extra_event["description"], na=False)]
-                    
-                    if len(protheus_find_extra_event) == 0:
-                        incongruence_message += f";Transação de {extra_event["description"]} não encontrada no Protheus."
-                    elif float(protheus_find_extra_event.iloc[0]["transaction_value"]) != extra_event["total"]:
-                        incongruence_message += f";Valor de {extra_event["description"]} não bate com o valor encontrado no Protheus."
+        if priority != "value":
+            logger.warning(f"Prioridade '{priority}' desconhecida. Ordenando as fichas pelo valor de receita...")
 
-                # 4 - Verifica se há Vendas POS e Requisições no protheus
-                protheus_pos = protheus_details.loc[protheus_details["transaction_description"].str.contains("POS", na=False)]
+        logger.info("Fichas ordenadas pelo valor de receita.")
+        return sorted(shipping_tickets, key=ticket_value, reverse=True)
 
-                if not protheus_pos.empty:
-                    message = ";A ficha contém Vendas POS."
+    def write_unchecked_tickets(self, shipping_tickets: list, unchecked_tickets: list):
+        # Grava na tabela unchecked_tickets do duck.db as fichas que o modo prazo deixou sem verificação. As fichas
+        # 'shipping_tickets' são removidas da tabela antes, para que uma nova execução do mesmo dia, com ou sem prazo,
+        # não deixe registradas como pendentes (e exportadas em fichas_nao_verificadas) fichas que ela verificou.
+        #
+        # Retorna a quantidade de fichas gravadas como não verificadas.
+        import pandas as pd
 
-                    if incongruence_message != "":
-                        incongruence_message += message
-                    else:
-                        observation_message += message
-                
-                protheus_requisitions = protheus_details.loc[protheus_details["transaction_description"].str.contains("REQUISIÇÕES", na=False)]
+        duck_connection = self.duck_connector.duck_connection
+        duck_connection.execute("""
+            CREATE TABLE IF NOT EXISTS unchecked_tickets (
+                nome_agencia VARCHAR,
+                cod_agencia_protheus VARCHAR,
+                num_ficha_protheus VARCHAR,
+                empresa VARCHAR,
+                valor_receita DECIMAL(18,2),
+                motivo VARCHAR,
+                data_processamento TIMESTAMP
+            )
+        """)
+
+        processed_at = datetime.now()
+        columns = ["nome_agencia", "cod_agencia_protheus", "num_ficha_protheus", "empresa", "valor_receita_cents", "motivo", "data_processamento"]
+
+        run_tickets = pd.DataFrame(
+            [(ticket.agency_name.strip(), ticket.agency_code.strip(), ticket.ticket_number) for ticket in shipping_tickets],
+            columns=columns[:3],
+        )
+        unchecked = pd.DataFrame(
+            [
+                (ticket.agency_name.strip(), ticket.agency_code.strip(), ticket.ticket_number, ticket.associated_company.strip(),
+                 ticket.receipt_cents or 0, "Não verificada: prazo da execução esgotado.", processed_at)
+                for ticket in unchecked_tickets
+            ],
+            columns=columns,
+        )
+
+        duck_connection.register("run_tickets_df", run_tickets)
+        duck_connection.register("unchecked_df", unchecked)
+
+        try:
+            duck_connection.execute("BEGIN TRANSACTION")
+            duck_connection.execute("""
+                DELETE FROM unchecked_tickets
+                WHERE EXISTS (
+                    SELECT 1
+                    FROM run_tickets_df r
+                    WHERE r.cod_agencia_protheus = unchecked_tickets.cod_agencia_protheus
+                        AND r.num_ficha_protheus = unchecked_tickets.num_ficha_protheus
+                )
+            """)
+            duck_connection.execute("""
+                INSERT INTO unchecked_tickets
+                SELECT
+                    nome_agencia,
+                    cod_agencia_protheus,
+                    num_ficha_protheus,
+                    empresa,
+                    CAST(CAST(valor_receita_cents AS DECIMAL(18,0)) * 0.01 AS DECIMAL(18,2)),
+                    motivo,
+                    data_processamento
+                FROM unchecked_df
+            """)
+            duck_connection.execute("COMMIT")
+        except Exception:
+            duck_connection.execute("ROLLBACK")
+            raise
+        finally:
+            duck_connection.unregister("run_tickets_df")
+            duck_connection.unregister("unchecked_df")
+
+        self.duck_connector.mark_data_changed()
+        return len(unchecked_tickets)
+
+    def log_deadline_coverage(self, shipping_tickets: list, unchecked_tickets: list):
+        # Registra no log quantas fichas e quanto do valor de receita do dia o modo prazo deixou sem verificação
+        if len(unchecked_tickets) == 0:
+            logger.success("Modo prazo: todas as fichas foram verificadas dentro do prazo.")
+            return 0
+
+        total_value = sum(ticket.receipt_cents or 0 for ticket in shipping_tickets)
+        unchecked_value = sum(ticket.receipt_cents or 0 for ticket in unchecked_tickets)
+        coverage = (1 - unchecked_value / total_value) * 100 if total_value else 0.0
+
+        logger.warning(
+            f"Modo prazo: {len(unchecked_tickets)} de {len(shipping_tickets)} fichas ficaram sem verificação "
+            f"({money.format_money(unchecked_value)} de receita). As fichas verificadas cobrem {coverage:.1f}% do valor de "
+            f"receita do dia."
+        )
+        return len(unchecked_tickets)
+
+    def save_rollup(self, date: datetime, valid_tickets: list, incongruent_tickets: list):
+        # Substitui os resumos diários (por agência, empresa e motivo) do dia processado pelos totais dos resultados.
+        # Só deve ser chamada com todos os resultados do dia, pois os resumos anteriores do dia são descartados.
+
+        from .classes.DiscrepancyHistory import DiscrepancyHistory, DiscrepancyRollup
+
+        rollup = DiscrepancyRollup()
+        rollup.add_all(valid_tickets)
+        rollup.add_all(incongruent_tickets)
+        DiscrepancyHistory(self.duck_connector).save_rollup(date=date, rollup=rollup)
+
+    def check_ticket(self, ticket, date: datetime):
+        # Esta função faz o comparativo de uma única ficha de remessa (ShippingTicket) do Protheus com o TotalBus,
+        # seguindo os passos descritos em check_shipping_tickets.
+        #
+        # O retorno é um ReconciliationResult, válido ou discrepante. Se houver algum erro inesperado durante a
+        # checagem, o erro é registrado no log e a função retorna None.
+
+        from .classes.Records import ReconciliationResult
+
+        protheus_connector = self.protheus_connector
+        totalbus_connector = self.totalbus_connector
+
+        try:
+            agency_name = ticket.agency_name.strip()
+            agency_code = ticket.agency_code.strip()
+            associated_company = ticket.associated_company.strip()
+
+            logger.info(f"Nome da agência: {agency_name}.")
+            logger.info(f"Empresa: {associated_company}")
+            logger.info(f"Código da agência: {agency_code}.")
+
+            def build_result(valid: bool, message: str):
+                return ReconciliationResult(
+                    agency_name=agency_name,
+                    agency_code=agency_code,
+                    ticket_number=ticket.ticket_number,
+                    associated_company=associated_company,
+                    valid=valid,
+                    message=message,
+                )
+
+            # Ignora fichas de remessa vazias
+            if ticket.receipt_cents == 0:
+                logger.info("Ficha vazia! Pulando...")
+                return build_result(True, "Ficha de remessa zerada.")
 
-                if not protheus_requisitions.empty:
-                    message = ";A ficha contém requisições."
+            # Procura ticket no TotalBus
+            totalbus_tickets = totalbus_connector.get_agency_shipping_report(date=date, agency_name=agency_name)
+            observation_message = ""
+            incongruence_message = ""
 
-                    if incongruence_message != "":
-                        incongruence_message += message
-                    else:
-                        observation_message += message
+            if totalbus_tickets is None:
+                logger.error(f"Houve um erro ao procurar pela ficha da agência {agency_name} no TotalBus. Pulando...")
+                return build_result(False, "Ocorreu um erro ao buscar a ficha da agência no TotalBus.")
+
+            # 1 - Verifica se o valor de receita do Protheus é o mesmo do TotalBus
+            # Os valores são inteiros em centavos, comparados com a tolerância configurada (MONEY_TOLERANCE_CENTS)
+            tolerance = self.money_tolerance_cents
+            receipt_matching = any(
+                money.matches(totalbus_ticket.total_cents, ticket.receipt_cents, tolerance) for totalbus_ticket in totalbus_tickets
+            )
+            
+            if not receipt_matching:
+                incongruence_message += ";Valor da receita não está batendo."
+
+            # Procura detalhes de receitas e despesas no Protheus e TotalBus
+            protheus_details = protheus_connector.get_shipping_details(date=date, agency_code=agency_code, associated_company=associated_company)
+            totalbus_extra_events = totalbus_connector.get_agency_extra_events(date=date, agency_name=agency_name)
+            totalbus_cancelled_total = totalbus_connector.get_agency_cancelled_total(date=date, agency_name=agency_name)
+
+            # Cálculo do valor total cancelado ou devolvido, do Protheus e TotalBus
+            protheus_cancelled_total = 0
+            protheus_find_cancelled_transactions = protheus_details.loc[protheus_details["transaction_description"].str.contains("BILHETE CANCELADO", na=False)]
+
+            if len(protheus_find_cancelled_transactions) > 0:
+                protheus_cancelled_total += protheus_find_cancelled_transactions.iloc[0]["transaction_value_cents"]
+            
+            protheus_find_returned_transactions = protheus_details.loc[protheus_details["transaction_description"].str.contains("BILHETE DEVOLVIDO", na=False)]
+
+            if len(protheus_find_returned_transactions) > 0:
+                protheus_cancelled_total += protheus_find_returned_transactions.iloc[0]["transaction_value_cents"]
+
+            # 2 - Verifica bilhetes cancelados e devolvidos em ambas as plataformas
+            cancelled_matching = False
+
+            if protheus_cancelled_total == 0 and len(totalbus_cancelled_total) == 0:
+                observation_message += ";Não há bilhetes cancelados e devolvidos."
+                cancelled_matching = True
+
+            for totalbus_ticket in totalbus_cancelled_total:
+                if money.matches(totalbus_ticket.total_cents, protheus_cancelled_total, tolerance):
+                    cancelled_matching = True
+
+            if not cancelled_matching:
+                incongruence_message += ";Valores de bilhetes cancelados e devolvidos não batem."
+
+            # 3 - Verifica se há despesas extras ou receitas extras registradas no Protheus
+            for extra_event in totalbus_extra_events:
+                protheus_find_extra_event = protheus_details.loc[protheus_details["transaction_description"].str.contains(extra_event.description, na=False)]
                 
-                if incongruence_message == "":
-                    valid_tickets.append({
-                        "nome_agencia": agency_name,
-                        "cod_agencia_protheus": agency_code,
-                        "num_ficha_protheus": ticket.ticket_number,
-                        "observacao": observation_message.replace(";", "", 1) if observation_message != "" else "Nada a declarar.",
-                    })
+                if len(protheus_find_extra_event) == 0:
+                    incongruence_message += f";Transação de {extra_event.description} não encontrada no Protheus."
+                elif not money.matches(protheus_find_extra_event.iloc[0]["transaction_value_cents"], extra_event.total_cents, tolerance):
+                    incongruence_message += f";Valor de {extra_event.description} não bate com o valor encontrado no Protheus."
+
+            # 4 - Verifica se há Vendas POS e Requisições no protheus
+            protheus_pos = protheus_details.loc[protheus_details["transaction_description"].str.contains("POS", na=False)]
+
+            if not protheus_pos.empty:
+                message = ";A ficha contém Vendas POS."
+
+                if incongruence_message != "":
+                    incongruence_message += message
                 else:
-                    incongruent_tickets.append({
-                        "nome_agencia": agency_name,
-                        "cod_agencia_protheus": agency_code,
-                        "num_ficha_protheus": ticket.ticket_number,
-                        "motivo_erro": incongruence_message.replace(";", "", 1),
-                    })
+                    observation_message += message
+            
+            protheus_requisitions = protheus_details.loc[protheus_details["transaction_description"].str.contains("REQUISIÇÕES", na=False)]
+
+            if not protheus_requisitions.empty:
+                message = ";A ficha contém requisições."
+
+                if incongruence_message != "":
+                    incongruence_message += message
+                else:
+                    observation_message += message
+            
+            if incongruence_message == "":
+                return build_result(True, observation_message.replace(";", "", 1) if observation_message != "" else "Nada a declarar.")
+
+            return build_result(False, incongruence_message.replace(";", "", 1))
+        except Exception as e:
+            logger.error(f"Ocorreu um erro ao fazer o comparativo da ficha de remessa da agência {ticket.agency_name}")
+            logger.error(f"Motivo: {e}")
+            tb_str = traceback.format_exc()
+            logger.error(f"\n{tb_str}")
+            return None
+
+    def enqueue_shipping_tickets(self, date: datetime = None):
+        # Esta função é o lado do coordenador no modo distribuído. Ela busca as fichas de remessa do dia no Protheus e
+        # as enfileira na WorkQueue, um item por agência, para que os workers (run_worker) façam o comparativo.
+        #
+        # Se a data não for especificada, a função irá utilizar o dia anterior ao de sua execução como padrão.
+        #
+        # A função retorna 0 se as fichas forem enfileiradas, e 1 caso contrário.
+
+        if date is None:
+            logger.warning("Nenhuma data foi passada! Utilizando D-1...")
+            date = constants.get_yesterday()
+
+        from dataclasses import asdict
+        from .classes.WorkQueue import WorkQueue
+
+        shipping_tickets = self.protheus_connector.get_shipping_ticket_summary(date=date)
+
+        if shipping_tickets is None:
+            logger.error("Não foi possível receber as fichas de remessa do Protheus...")
+            return 1
+
+        # Fichas da mesma agência ficam no mesmo item, para que o worker reaproveite as consultas do TotalBus
+        items = {}
+        for ticket in shipping_tickets:
+            items.setdefault(ticket.agency_name.strip(), []).append(asdict(ticket))
+
+        total_items = WorkQueue().enqueue(run_date=date.strftime("%Y-%m-%d"), items=items)
+        logger.success(f"{len(shipping_tickets)} fichas de remessa enfileiradas em {total_items} itens.")
+        return 0
+
+    @profile_stage("run_worker")
+    def run_worker(self, worker_id: str = None, once: bool = False, idle_timeout: float = None, poll_seconds: float = 5):
+        # Esta função é o lado do worker no modo distribuído. Ela reserva itens da WorkQueue, faz o comparativo das
+        # fichas de cada item e grava o resultado de volta na fila. Vários workers, em um ou mais servidores, podem
+        # rodar ao mesmo tempo.
+        #
+        # Enquanto um item é processado, uma thread renova a reserva dele. Se o worker cair, a reserva expira e outro
+        # worker assume o item.
+        #
+        # Com 'once', o worker encerra assim que a fila estiver vazia. Com 'idle_timeout', ele encerra depois de
+        # ficar esse tempo (em segundos) sem encontrar itens. Sem nenhum dos dois, ele roda indefinidamente.
+        #
+        # A função retorna 0 se todos os itens processados forem concluídos, e 1 caso contrário.
+
+        import json
+        import socket
+        import threading
+        import time
+        from dataclasses import asdict
+        from .classes.Records import ShippingTicket
+        from .classes.WorkQueue import WorkQueue
+
+        queue = WorkQueue()
+        worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        idle_since = time.monotonic()
+        status = 0
+
+        logger.info(f"Worker {worker_id} iniciado.")
+
+        while True:
+            item = queue.claim(worker_id=worker_id)
+
+            if item is None:
+                if once or (idle_timeout is not None and time.monotonic() - idle_since > idle_timeout):
+                    break
+
+                time.sleep(poll_seconds)
+                continue
+
+            logger.info(f"Item {item["id"]} reservado: agência {item["agency_name"]} - Data: {item["run_date"]} (tentativa {item["attempts"]}).")
+
+            stop_heartbeat = threading.Event()
+
+            def heartbeat():
+                while not stop_heartbeat.wait(queue.lease_seconds / 3):
+                    if not queue.heartbeat(item_id=item["id"], worker_id=worker_id):
+                        logger.warning(f"A reserva do item {item["id"]} foi perdida.")
+                        return
+
+            heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+            heartbeat_thread.start()
+
+            try:
+                date = datetime.strptime(item["run_date"], "%Y-%m-%d")
+                tickets = [ShippingTicket(**ticket) for ticket in json.loads(item["payload"])]
+
+                # As consultas do TotalBus repetidas ficam dentro do mesmo item (mesma agência)
+                self.totalbus_connector.clear_cache()
+                results = [self.check_ticket(ticket=ticket, date=date) for ticket in tickets]
+                results = [asdict(result) for result in results if result is not None]
+
+                stop_heartbeat.set()
+                heartbeat_thread.join()
+
+                if not queue.complete(item_id=item["id"], worker_id=worker_id, result=results):
+                    logger.warning(f"O item {item["id"]} foi assumido por outro worker. O resultado será descartado.")
+                    status = 1
             except Exception as e:
-                logger.error(f"Ocorreu um erro ao fazer o comparativo da ficha de remessa {i + 1}")
+                stop_heartbeat.set()
+                heartbeat_thread.join()
+
+                logger.error(f"Ocorreu um erro ao processar o item {item["id"]}")
                 logger.error(f"Motivo: {e}")
                 tb_str = traceback.format_exc()
                 logger.error(f"\n{tb_str}")
-        
-        logger.info("-"*100)
-        
-        duck_connector.upsert_data(df=pd.DataFrame(valid_tickets), table_name="valid_tickets")
-        duck_connector.upsert_data(df=pd.DataFrame(incongruent_tickets), table_name="incongruent_tickets")
+                queue.fail(item_id=item["id"], worker_id=worker_id, error=str(e))
+                status = 1
 
-        logger.success("Comparativo concluído com sucesso!")
-        return 0
+            idle_since = time.monotonic()
+
+        logger.info(f"Worker {worker_id} encerrado.")
+        return status
+
+    @profile_stage("collect_shipping_tickets")
+    def collect_shipping_tickets(self, date: datetime = None, timeout: float = None):
+        # Esta função é a etapa final do coordenador no modo distribuído. Ela aguarda os workers concluírem todos os
+        # itens da data, monta as listas de fichas válidas e discrepantes e as grava no duck.db (write_results). Os
+        # resumos diários (save_rollup) só são atualizados quando todos os itens foram concluídos.
+        #
+        # Se a data não for especificada, a função irá utilizar o dia anterior ao de sua execução como padrão.
+        #
+        # A função retorna 0 se todos os itens foram concluídos, e 1 se algum falhou, se o tempo limite acabou ou se os
+        # workers pararam de responder. Os resultados dos itens concluídos são gravados mesmo assim.
 
+        if date is None:
+            logger.warning("Nenhuma data foi passada! Utilizando D-1...")
+            date = constants.get_yesterday()
+
+        import json
+        from .classes.Records import ReconciliationResult
+        from .classes.WorkQueue import WorkQueue
+
+        queue = WorkQueue()
+        run_date = date.strftime("%Y-%m-%d")
+        status = 0
+
+        if not queue.wait(run_date=run_date, timeout=timeout):
+            logger.error(f"Os workers não concluíram a fila (tempo limite esgotado ou nenhum worker ativo). Progresso: {queue.get_progress(run_date)}")
+            status = 1
+
+        for item in queue.get_items(run_date=run_date, status="failed"):
+            logger.error(f"O item da agência {item["agency_name"]} falhou após {item["attempts"]} tentativas. Motivo: {item["error"]}")
+            status = 1
+
+        valid_tickets = []
+        incongruent_tickets = []
+
+        for item in queue.get_items(run_date=run_date, status="done"):
+            for result in json.loads(item["result"]):
+                result = ReconciliationResult(**result)
+
+                if result.valid:
+                    valid_tickets.append(result)
+                else:
+                    incongruent_tickets.append(result)
+
+        logger.info(f"Resultados coletados: {len(valid_tickets)} fichas válidas e {len(incongruent_tickets)} discrepantes.")
+        self.write_results(valid_tickets=valid_tickets, incongruent_tickets=incongruent_tickets)
+
+        # Assim como em check_shipping_tickets, uma execução parcial não substitui os resumos do dia inteiro
+        if status == 0:
+            self.save_rollup(date=date, valid_tickets=valid_tickets, incongruent_tickets=incongruent_tickets)
+        else:
+            logger.warning("Execução parcial: os resumos diários do dia não serão alterados.")
+
+        return status
+
+    def get_discrepancy_trends(self, report: str, start_date: datetime, end_date: datetime, limit: int = 10):
+        # Esta função responde perguntas de tendência a partir dos resumos diários do duck.db, sem varrer o histórico
+        # bruto das fichas. Os relatórios disponíveis são:
+        # - agencies: agências com mais dias discrepantes no intervalo
+        # - reasons: motivos de discrepância mais frequentes
+        # - durations: por quanto tempo as discrepâncias de cada agência ficaram em aberto
+        #
+        # O retorno é um DataFrame com o relatório, ou None se o relatório não existir.
+
+        from .classes.DiscrepancyHistory import DiscrepancyHistory
+
+        history = DiscrepancyHistory(self.duck_connector)
+        reports = {
+            "agencies": history.get_most_incongruent_agencies,
+            "reasons": history.get_top_reasons,
+            "durations": history.get_discrepancy_durations,
+        }
+
+        if report not in reports:
+            logger.error(f"Relatório de tendência '{report}' não existe. Opções: {", ".join(reports)}.")
+            return None
+
+        return reports[report](start_date=start_date, end_date=end_date, limit=limit)
+
+    @profile_stage("generate_csv_files")
     def generate_csv_files(self, date: datetime = None):
         # Esta função tem como objetivo apenas gerar os arquivos .xlsx com as informações das fichas de remessa.
-        # Os arquivos são gerados a partir do banco duck.db e inseridos no diretório 'database/csv/'
+        # Os arquivos são gerados a partir do banco duck.db e inseridos no diretório 'database/csv/' (ou na pasta do tenant)
         #
         # Se a data não for especificada, a função irá utilizar o dia anterior ao de sua execução como padrão.
         #
@@ -210,11 +1014,11 @@ class App():
 
         if date is None:
             logger.warning("Nenhuma data foi passada! Utilizando D-1...")
-            date = constants.YESTERDAY
+            date = constants.get_yesterday()
 
         date = date - timedelta(days=1)
 
-        duck_connector = DuckConnector()
+        duck_connector = self.duck_connector
 
         logger.info("Iniciando exportação dos arquivos de fichas de remessa...")
 
@@ -225,6 +1029,20 @@ class App():
             incongruent_tickets_query = f"SELECT * FROM incongruent_tickets WHERE num_ficha_protheus = {date.strftime("%Y%m%d")}"
             duck_connector.export_data_to_csv(query=incongruent_tickets_query, filename="fichas_discrepantes")
 
+            # Fichas deixadas sem verificação pelo modo prazo. A planilha só existe se houver alguma, para que o e-mail
+            # não leve a planilha de um dia anterior.
+            unchecked_path = os.path.join(self.csv_path, "fichas_nao_verificadas.xlsx")
+            if os.path.exists(unchecked_path):
+                os.remove(unchecked_path)
+
+            unchecked_tickets_query = f"SELECT * FROM unchecked_tickets WHERE num_ficha_protheus = {date.strftime("%Y%m%d")} ORDER BY valor_receita DESC"
+            table_exists = duck_connector.duck_connection.execute(
+                "SELECT COUNT(*) FROM information_schema.tables WHERE table_name = 'unchecked_tickets' AND table_schema = current_schema()"
+            ).fetchone()[0]
+
+            if table_exists and duck_connector.duck_connection.execute(f"SELECT COUNT(*) FROM ({unchecked_tickets_query})").fetchone()[0] > 0:
+                duck_connector.export_data_to_csv(query=unchecked_tickets_query, filename="fichas_nao_verificadas")
+
             logger.success("Arquivos .csv gerados com sucesso!")
             return 0
         except Exception as e:
@@ -245,9 +1063,12 @@ class App():
 
         if date is None:
             logger.warning("Nenhuma data foi passada. Utilizando D-1")
-            date = constants.YESTERDAY
+            date = constants.get_yesterday()
 
         date = date - timedelta(days=1)
+
+        from email import encoders
+        from email.mime.base import MIMEBase
         
         with open(file_path, "rb") as file:
             payload = MIMEBase("application", "octet-stream")
@@ -263,6 +1084,7 @@ class App():
 
         return mail
 
+    @profile_stage("send_email")
     def send_email(self, date: datetime = None, recipients: list = None):
         # Esta função tem como objetivo disparar e-mails informando as fichas válidas e inválidas para os destinatários especificados.
         #
@@ -273,15 +1095,20 @@ class App():
         #
         # Se a data não for especificada, a função irá utilizar o dia anterior ao de sua execução como padrão.
         #
-        # A função sempre retornará None.
+        # A função retorna 0 se o e-mail for enviado, e 1 caso contrário.
         
         if recipients is None or len(recipients) == 0:
             logger.error("Nenhum recipiente foi especificado. Envio do e-mail será descartado...")
-            return None
+            return 1
 
         if date is None:
             logger.warning("Nenhuma data foi passada. Utilizando D-1")
-            date = constants.YESTERDAY
+            date = constants.get_yesterday()
+
+        import smtplib
+        import ssl
+        from email.mime.multipart import MIMEMultipart
+        from email.mime.text import MIMEText
 
         logger.info("Iniciando a construção e envio do e-mail...")
 
@@ -289,10 +1116,9 @@ class App():
         password = os.getenv("SMTP_PASSWORD")
         body_path = os.path.join(constants.HTML_PATH, "mail_body.html")
 
-        with open(body_path, "r", encoding="utf-8") as file:
-            mail_body = file.read().format(**{
-                "date": date.strftime("%d/%m/%Y")
-            })
+        mail_body = read_template(body_path).format(**{
+            "date": date.strftime("%d/%m/%Y")
+        })
 
         try:
             mail = MIMEMultipart('mixed')
@@ -302,14 +1128,19 @@ class App():
             mail.attach(MIMEText(mail_body, "html"))
             
             logger.info("Lendo o arquivo das fichas de remessa válidas...")
-            tickets_path = os.path.join(constants.CSV_PATH, "fichas_validadas.xlsx")
+            tickets_path = os.path.join(self.csv_path, "fichas_validadas.xlsx")
             self.attach_file_to_mail(date=date, mail=mail, file_path=tickets_path)
 
             logger.info("Lendo o arquivo das fichas de remessa discrepantes...")
-            tickets_path = os.path.join(constants.CSV_PATH, "fichas_discrepantes.xlsx")
+            tickets_path = os.path.join(self.csv_path, "fichas_discrepantes.xlsx")
             self.attach_file_to_mail(date=date, mail=mail, file_path=tickets_path)
 
-            with smtplib.SMTP("smtp.office365.com", 587) as server:
+            tickets_path = os.path.join(self.csv_path, "fichas_nao_verificadas.xlsx")
+            if os.path.exists(tickets_path):
+                logger.info("Lendo o arquivo das fichas de remessa não verificadas no prazo...")
+                self.attach_file_to_mail(date=date, mail=mail, file_path=tickets_path)
+
+            with smtplib.SMTP(constants.SMTP_SERVER, constants.SMTP_PORT) as server:
                 server.ehlo()
                 server.starttls(context=ssl.create_default_context())
                 server.ehlo()
@@ -318,10 +1149,10 @@ class App():
                 server.quit()
             
             logger.info("Email enviado com sucesso!")
+            return 0
         except Exception as e:
             logger.error("Ocorreu um erro ao enviar o e-mail.")
             logger.error(f"Motivo: {e}")
             tb_str = traceback.format_exc()
             logger.error(f"\n{tb_str}")
-        
-        return None
+            return 1
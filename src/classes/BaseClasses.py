@@ -1,22 +1,119 @@
 import os
+import time
 import traceback
 import sqlalchemy as sqla
 from sqlalchemy.exc import OperationalError
 import pandas as pd
 
+from .QueryScheduler import QueryScheduler
 from src.utils import constants
 from src.utils.logger import logger
 
 class BaseDBConnector:
     def __init__(self):
         self.conn_string = None
+        self.engine = None
+
+        # Consulta trivial usada no pré-voo (warm_up) e parâmetros extras repassados ao driver na conexão, como o
+        # tempo limite para abrir uma conexão. As classes filhas ajustam os dois para o seu banco.
+        self.probe_query = "SELECT 1"
+        self.connect_args = {}
+        self.connect_timeout = int(os.getenv("DB_CONNECT_TIMEOUT", "10"))
+
+        # Nome da fonte nos diagnósticos e, quando o modo de diagnóstico está ligado, o QueryDiagnostics da execução
+        self.source_name = None
+        self.diagnostics = None
+
+        # Escalonador de consultas da fonte (concorrência e taxa máxima), criado na primeira consulta
+        self.scheduler = None
+
+    def get_engine(self):
+        # A engine (e o seu pool de conexões) é criada uma única vez por conector e reaproveitada entre as consultas.
+        # O pool_pre_ping descarta conexões que o servidor derrubou enquanto o processo estava ocioso.
+        if self.engine is None:
+            self.engine = sqla.create_engine(self.conn_string, pool_pre_ping=True, connect_args=self.connect_args)
+
+        return self.engine
+
+    def get_scheduler(self):
+        # O escalonador é criado uma única vez por conector, com o orçamento configurado para a fonte (source_name).
+        if self.scheduler is None:
+            self.scheduler = QueryScheduler(self.source_name)
+
+        return self.scheduler
+
+    def warm_up(self, min_connections: int = 1) -> float:
+        # Pré-voo do conector: abre 'min_connections' conexões do pool, executa a consulta de teste em cada uma e as
+        # devolve ao pool, que fica aquecido para a execução. Não há novas tentativas: uma falha é lançada
+        # imediatamente, para que a execução seja abortada em segundos e não depois das esperas de fetch*_read_query.
+        #
+        # Retorna o tempo, em segundos, para abrir a primeira conexão e executar a consulta de teste.
+        if self.conn_string is None:
+            raise ValueError("A string de conexão não foi definida!")
+
+        engine = self.get_engine()
+        connections = []
+
+        try:
+            started_at = time.perf_counter()
+            latency = None
+
+            for _ in range(max(min_connections, 1)):
+                conn = engine.connect()
+                connections.append(conn)
+                conn.execute(sqla.text(self.probe_query)).fetchall()
+
+                if latency is None:
+                    latency = time.perf_counter() - started_at
+
+            return latency
+        finally:
+            for conn in connections:
+                conn.close()
+
+    def dispose(self):
+        # Fecha todas as conexões do pool. Uma nova engine será criada na próxima consulta.
+        if self.engine is not None:
+            self.engine.dispose()
+            self.engine = None
+
+    def explain(self, conn, query: str):
+        # Retorna o plano de execução da consulta como texto. Cada banco implementa a sua forma de obter o plano, e o
+        # conector base não sabe fazer isso.
+        return None
 
-    def fetchone_read_query(self, query: str):
+    def capture_plan(self, conn, query: str, template: str):
+        # Captura o plano de execução do template, uma única vez por execução, se o modo de diagnóstico estiver ligado.
+        # Uma falha na captura nunca interrompe a consulta.
+        if self.diagnostics is None or template is None or not self.diagnostics.needs_plan(self.source_name, template):
+            return
+
+        try:
+            plan = self.explain(conn, query)
+
+            if plan is not None:
+                self.diagnostics.record_plan(self.source_name, template, plan)
+        except Exception as e:
+            logger.warning(f"Não foi possível capturar o plano de execução de {template}: {e}")
+
+    def record_execution(self, template: str, elapsed: float, fetch_time: float, rows):
+        if self.diagnostics is not None and template is not None:
+            self.diagnostics.record_execution(self.source_name, template, elapsed, fetch_time, rows)
+
+    def execute_read_query(self, query: str, consume, template: str = None):
+        # Executa uma consulta de leitura, com até 3 tentativas em caso de erro de conexão, e entrega o resultado
+        # para a função 'consume', que decide como as linhas serão lidas (linha única, lista de linhas, DataFrame...).
+        #
+        # 'template' é o nome do template SQL de origem da consulta, usado pelo modo de diagnóstico para agrupar os
+        # tempos de execução e capturar o plano.
+        #
+        # Retorna o que 'consume' retornar, ou None se a consulta não puder ser realizada.
         if self.conn_string is None:
             logger.error("Não foi possível fazer a conexão com o banco, pois a string de conexão não foi definida!")
             return None
         
-        engine = sqla.create_engine(self.conn_string)
+        engine = self.get_engine()
+        scheduler = self.get_scheduler()
 
         attempt = 1
         max_tries = 3
@@ -27,58 +124,128 @@ class BaseDBConnector:
                 logger.debug("Executando query...")
                 logger.debug(query)
 
-                with engine.connect() as conn:
-                    result = conn.execute(sqla.text(query))
-                    data = result.fetchall()
+                # O escalonador ajusta a concorrência pelo tempo de execução da consulta, sem o tempo de leitura
+                with scheduler.slot() as timing, engine.connect() as conn:
+                    self.capture_plan(conn, query, template)
 
-                    columns = result.keys()
-                    df = pd.DataFrame(data, columns=columns) if data else pd.DataFrame(columns=columns)
+                    started_at = time.perf_counter()
+                    result = conn.execute(sqla.text(query))
+                    executed_at = time.perf_counter()
+                    timing.elapsed = executed_at - started_at
+                    data = consume(result)
+                    fetched_at = time.perf_counter()
 
-                    conn.close()
+                    rows = len(data) if isinstance(data, (list, pd.DataFrame)) else int(data is not None)
+                    self.record_execution(template, executed_at - started_at, fetched_at - executed_at, rows)
 
-                return df.iloc[0]
+                    return data
             except OperationalError as e:
                 logger.error(f"Erro ao executar a query: {e}. Aguardando {delay} segundos...")
                 tb_str = traceback.format_exc()
                 logger.error(f"\n{tb_str}")
                 attempt += 1
                 time.sleep(delay)
-        
+
         logger.error("Não foi possível realizar a consulta...")
         return None
 
-    def fetchmany_read_query(self, query: str):
+    def stream_rows(self, query: str, chunk_size: int = 1000, template: str = None):
+        # Gerador que entrega as linhas da consulta em blocos de até 'chunk_size' Rows, sem carregar o resultado inteiro
+        # na memória. O SQLAlchemy usa um cursor do lado do servidor quando o driver suporta, e fetchmany caso
+        # contrário. A conexão fica aberta até o último bloco ser consumido (ou o gerador ser fechado).
+        #
+        # As novas tentativas valem apenas para abrir a conexão e executar a consulta. Um erro no meio da leitura é
+        # lançado para quem está consumindo o gerador, pois os blocos anteriores já foram entregues.
         if self.conn_string is None:
             logger.error("Não foi possível fazer a conexão com o banco, pois a string de conexão não foi definida!")
-            return None
-        
-        engine = sqla.create_engine(self.conn_string)
+            return
+
+        engine = self.get_engine()
+        scheduler = self.get_scheduler()
 
         attempt = 1
         max_tries = 3
         delay = 60
+        conn = None
 
         while attempt <= max_tries:
             try:
-                logger.debug("Executando query...")
+                logger.debug(f"Executando query em blocos de {chunk_size} linhas...")
                 logger.debug(query)
 
-                with engine.connect() as conn:
-                    result = conn.execute(sqla.text(query))
-                    data = result.fetchall()
+                # A vaga do escalonador vale apenas para abrir a conexão e executar a consulta. Quem consome os blocos
+                # faz outras consultas entre um bloco e outro, e segurar a vaga durante a leitura poderia travá-las.
+                with scheduler.slot() as timing:
+                    conn = engine.connect()
+                    self.capture_plan(conn, query, template)
 
-                    columns = result.keys()
-                    df = pd.DataFrame(data, columns=columns) if data else pd.DataFrame(columns=columns)
+                    started_at = time.perf_counter()
+                    result = conn.execution_options(stream_results=True, max_row_buffer=chunk_size).execute(sqla.text(query))
+                    elapsed = time.perf_counter() - started_at
+                    timing.elapsed = elapsed
 
+                break
+            except OperationalError as e:
+                if conn is not None:
                     conn.close()
+                    conn = None
 
-                return df
-            except OperationalError as e:
                 logger.error(f"Erro ao executar a query: {e}. Aguardando {delay} segundos...")
                 tb_str = traceback.format_exc()
                 logger.error(f"\n{tb_str}")
                 attempt += 1
                 time.sleep(delay)
 
-        logger.error("Não foi possível realizar a consulta...")
-        return None
+        if conn is None:
+            raise ConnectionError("Não foi possível realizar a consulta...")
+
+        # No modo em blocos, o tempo de fetch registrado é apenas o de leitura dos blocos, sem o processamento deles
+        fetch_time = 0.0
+        rows = 0
+
+        try:
+            partitions = result.partitions(chunk_size)
+
+            while True:
+                fetch_started_at = time.perf_counter()
+                partition = next(partitions, None)
+                fetch_time += time.perf_counter() - fetch_started_at
+
+                if partition is None:
+                    break
+
+                rows += len(partition)
+                yield partition
+        finally:
+            conn.close()
+            self.record_execution(template, elapsed, fetch_time, rows)
+
+    def fetch_rows(self, query: str, template: str = None):
+        # Retorna as linhas da consulta como uma lista de Rows do SQLAlchemy (acesso por atributo, ex: row.agency_name),
+        # sem passar pelo pandas.
+        return self.execute_read_query(query, lambda result: result.fetchall(), template=template)
+
+    def fetch_row(self, query: str, template: str = None):
+        # Retorna apenas a primeira linha da consulta, ou None se ela não retornar nenhuma linha.
+        return self.execute_read_query(query, lambda result: result.fetchone(), template=template)
+
+    def fetch_scalar(self, query: str, template: str = None):
+        # Retorna o valor da primeira coluna da primeira linha da consulta, ou None se ela não retornar nenhuma linha.
+        return self.execute_read_query(query, lambda result: result.scalar(), template=template)
+
+    def fetchone_read_query(self, query: str, template: str = None):
+        # Retorna a primeira linha da consulta como uma Series do pandas. Apenas essa linha é lida do cursor.
+        def consume(result):
+            row = result.fetchone()
+            return pd.Series(tuple(row), index=list(result.keys())) if row is not None else None
+
+        return self.execute_read_query(query, consume, template=template)
+
+    def fetchmany_read_query(self, query: str, template: str = None):
+        # Retorna todas as linhas da consulta em um DataFrame do pandas.
+        def consume(result):
+            data = result.fetchall()
+            columns = result.keys()
+            return pd.DataFrame(data, columns=columns) if data else pd.DataFrame(columns=columns)
+
+        return self.execute_read_query(query, consume, template=template)
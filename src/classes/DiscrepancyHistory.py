@@ -0,0 +1,204 @@
+from collections import Counter
+from datetime import datetime
+
+from src.utils.logger import logger
+
+class DiscrepancyRollup():
+    # Acumula, em memória, os totais diários de uma execução do comparativo:
+    # - por agência e empresa: quantidade de fichas válidas e discrepantes
+    # - por empresa e motivo: quantidade de ocorrências de cada motivo de discrepância
+    #
+    # O acumulador guarda apenas contadores (não os resultados), então o seu tamanho depende da quantidade de agências
+    # e motivos, e não da quantidade de fichas.
+
+    def __init__(self):
+        self.agencies = {}
+        self.reasons = Counter()
+
+    def add(self, result):
+        key = (result.associated_company, result.agency_name, result.agency_code)
+        counts = self.agencies.setdefault(key, [0, 0])
+
+        if result.valid:
+            counts[0] += 1
+            return
+
+        counts[1] += 1
+
+        # O motivo de erro é uma lista de mensagens separadas por ";" (ver App.check_ticket)
+        for reason in result.message.split(";"):
+            if reason.strip():
+                self.reasons[(result.associated_company, reason.strip())] += 1
+
+    def add_all(self, results: list):
+        for result in results:
+            self.add(result)
+
+    def is_empty(self) -> bool:
+        return len(self.agencies) == 0
+
+class DiscrepancyHistory():
+    # Tabelas de resumo diário no duck.db, mantidas a cada execução de check_shipping_tickets:
+    # - daily_agency_summary: fichas válidas e discrepantes por dia, empresa e agência
+    # - daily_reason_summary: ocorrências de cada motivo de discrepância por dia e empresa
+    #
+    # Cada execução substitui apenas as linhas do dia processado, então as tabelas nunca precisam ser recalculadas a
+    # partir do histórico bruto (valid_tickets/incongruent_tickets). As consultas de tendência leem apenas os resumos.
+
+    AGENCY_TABLE = "daily_agency_summary"
+    REASON_TABLE = "daily_reason_summary"
+
+    def __init__(self, duck_connector):
+        self.duck_connector = duck_connector
+        self.duck_connection = duck_connector.duck_connection
+        self.create_tables()
+
+    def create_tables(self):
+        self.duck_connection.execute(f"""
+            CREATE TABLE IF NOT EXISTS {self.AGENCY_TABLE} (
+                data_ficha DATE,
+                empresa VARCHAR,
+                nome_agencia VARCHAR,
+                cod_agencia_protheus VARCHAR,
+                fichas_validas INTEGER,
+                fichas_discrepantes INTEGER,
+                data_processamento TIMESTAMP
+            )
+        """)
+        self.duck_connection.execute(f"""
+            CREATE TABLE IF NOT EXISTS {self.REASON_TABLE} (
+                data_ficha DATE,
+                empresa VARCHAR,
+                motivo VARCHAR,
+                ocorrencias INTEGER,
+                data_processamento TIMESTAMP
+            )
+        """)
+
+    def save_rollup(self, date: datetime, rollup: DiscrepancyRollup):
+        # Substitui os resumos do dia 'date' pelos totais acumulados em 'rollup', em uma única transação.
+        import pandas as pd
+
+        if rollup.is_empty():
+            logger.debug("Nenhum resultado para resumir. Os resumos diários não serão alterados.")
+            return None
+
+        ticket_date = date.date()
+        processed_at = datetime.now()
+
+        agencies = pd.DataFrame(
+            [(ticket_date, *key, *counts, processed_at) for key, counts in rollup.agencies.items()],
+            columns=["data_ficha", "empresa", "nome_agencia", "cod_agencia_protheus", "fichas_validas", "fichas_discrepantes", "data_processamento"],
+        )
+        reasons = pd.DataFrame(
+            [(ticket_date, *key, count, processed_at) for key, count in rollup.reasons.items()],
+            columns=["data_ficha", "empresa", "motivo", "ocorrencias", "data_processamento"],
+        )
+
+        self.duck_connection.register("agency_rollup_df", agencies)
+        self.duck_connection.register("reason_rollup_df", reasons)
+
+        try:
+            self.duck_connection.execute("BEGIN TRANSACTION")
+            self.duck_connection.execute(f"DELETE FROM {self.AGENCY_TABLE} WHERE data_ficha = ?", [ticket_date])
+            self.duck_connection.execute(f"DELETE FROM {self.REASON_TABLE} WHERE data_ficha = ?", [ticket_date])
+            self.duck_connection.execute(f"INSERT INTO {self.AGENCY_TABLE} SELECT * FROM agency_rollup_df")
+            self.duck_connection.execute(f"INSERT INTO {self.REASON_TABLE} SELECT * FROM reason_rollup_df")
+            self.duck_connection.execute("COMMIT")
+        except Exception:
+            self.duck_connection.execute("ROLLBACK")
+            raise
+        finally:
+            self.duck_connection.unregister("agency_rollup_df")
+            self.duck_connection.unregister("reason_rollup_df")
+
+        self.duck_connector.mark_data_changed()
+
+        logger.info(f"Resumos diários do dia {date.strftime("%d/%m/%Y")} atualizados: {len(agencies)} agências, {len(reasons)} motivos.")
+        return len(agencies) + len(reasons)
+
+    def get_most_incongruent_agencies(self, start_date: datetime, end_date: datetime, limit: int = 10):
+        # Agências que mais tiveram fichas discrepantes no intervalo (datas inclusivas), com a taxa de dias discrepantes.
+        return self.duck_connection.execute(f"""
+            SELECT
+                empresa,
+                nome_agencia,
+                COUNT(DISTINCT data_ficha) FILTER (WHERE fichas_discrepantes > 0) AS dias_discrepantes,
+                COUNT(DISTINCT data_ficha) AS dias_verificados,
+                ROUND(COUNT(DISTINCT data_ficha) FILTER (WHERE fichas_discrepantes > 0) / COUNT(DISTINCT data_ficha), 4) AS taxa_discrepancia,
+                SUM(fichas_discrepantes) AS fichas_discrepantes
+            FROM {self.AGENCY_TABLE}
+            WHERE data_ficha BETWEEN ? AND ?
+            GROUP BY empresa, nome_agencia
+            HAVING SUM(fichas_discrepantes) > 0
+            ORDER BY dias_discrepantes DESC, fichas_discrepantes DESC
+            LIMIT ?
+        """, [start_date.date(), end_date.date(), limit]).fetchdf()
+
+    def get_agency_discrepancy_rates(self, start_date: datetime, end_date: datetime) -> dict:
+        # Taxa de dias discrepantes de cada agência no intervalo (datas inclusivas), no formato
+        # {(empresa, nome_agencia): taxa}. Usada para priorizar as agências no modo prazo.
+        rows = self.duck_connection.execute(f"""
+            SELECT
+                empresa,
+                nome_agencia,
+                COUNT(DISTINCT data_ficha) FILTER (WHERE fichas_discrepantes > 0) / COUNT(DISTINCT data_ficha) AS taxa_discrepancia
+            FROM {self.AGENCY_TABLE}
+            WHERE data_ficha BETWEEN ? AND ?
+            GROUP BY empresa, nome_agencia
+        """, [start_date.date(), end_date.date()]).fetchall()
+
+        return {(empresa, nome_agencia): taxa for empresa, nome_agencia, taxa in rows}
+
+    def get_top_reasons(self, start_date: datetime, end_date: datetime, limit: int = 10):
+        # Motivos de discrepância mais frequentes no intervalo (datas inclusivas), por empresa.
+        return self.duck_connection.execute(f"""
+            SELECT
+                empresa,
+                motivo,
+                SUM(ocorrencias) AS ocorrencias,
+                COUNT(DISTINCT data_ficha) AS dias
+            FROM {self.REASON_TABLE}
+            WHERE data_ficha BETWEEN ? AND ?
+            GROUP BY empresa, motivo
+            ORDER BY ocorrencias DESC
+            LIMIT ?
+        """, [start_date.date(), end_date.date(), limit]).fetchdf()
+
+    def get_discrepancy_durations(self, start_date: datetime, end_date: datetime, limit: int = 10):
+        # Períodos em que cada agência ficou discrepante: dias verificados consecutivos da agência com fichas
+        # discrepantes formam um período (dias sem ficha, como fins de semana, não interrompem o período). Um período
+        # está em aberto se chega ao último dia verificado da agência no intervalo.
+        return self.duck_connection.execute(f"""
+            WITH agency_days AS (
+                SELECT
+                    empresa,
+                    nome_agencia,
+                    data_ficha,
+                    SUM(fichas_discrepantes) AS fichas_discrepantes,
+                    ROW_NUMBER() OVER (PARTITION BY empresa, nome_agencia ORDER BY data_ficha) AS dia_verificado,
+                    MAX(data_ficha) OVER (PARTITION BY empresa, nome_agencia) AS ultimo_dia
+                FROM {self.AGENCY_TABLE}
+                WHERE data_ficha BETWEEN ? AND ?
+                GROUP BY empresa, nome_agencia, data_ficha
+            ),
+            discrepant_days AS (
+                SELECT
+                    *,
+                    dia_verificado - ROW_NUMBER() OVER (PARTITION BY empresa, nome_agencia ORDER BY data_ficha) AS periodo
+                FROM agency_days
+                WHERE fichas_discrepantes > 0
+            )
+            SELECT
+                empresa,
+                nome_agencia,
+                MIN(data_ficha) AS inicio,
+                MAX(data_ficha) AS fim,
+                COUNT(*) AS dias_verificados,
+                MAX(data_ficha) - MIN(data_ficha) + 1 AS dias_corridos,
+                MAX(data_ficha) = ANY_VALUE(ultimo_dia) AS em_aberto
+            FROM discrepant_days
+            GROUP BY empresa, nome_agencia, periodo
+            ORDER BY dias_verificados DESC, fim DESC
+            LIMIT ?
+        """, [start_date.date(), end_date.date(), limit]).fetchdf()
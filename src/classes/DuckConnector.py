@@ -1,4 +1,5 @@
 import os
+import time
 import duckdb
 import pandas as pd
 import traceback
@@ -8,14 +9,54 @@ from src.utils import constants
 from src.utils.logger import logger
 
 class DuckConnector():
-    def __init__(self):
+    def __init__(self, schema: str = None, csv_folder: str = None, connection = None):
+        # No modo multi-tenant (ver Tenants), cada tenant grava no seu próprio schema do duck.db ('schema'). Os tenants
+        # de uma mesma execução compartilham a conexão com o arquivo ('connection'): cada DuckConnector usa um cursor
+        # próprio dessa conexão, com o schema do tenant como padrão, então as consultas continuam sem o nome do schema.
         self.db_folder = constants.DATA_PATH
-        self.csv_folder = constants.CSV_PATH
+        self.csv_folder = csv_folder or constants.CSV_PATH
+        self.schema = schema
 
         os.makedirs(self.csv_folder, exist_ok=True)
         os.makedirs(self.db_folder, exist_ok=True)
         
-        self.duck_connection = duckdb.connect(os.path.join(self.db_folder, "duck.db"))
+        self.db_path = os.path.join(self.db_folder, "duck.db")
+
+        if connection is None:
+            self.duck_connection = self.connect()
+        else:
+            self.duck_connection = connection.cursor()
+
+        if schema is not None:
+            self.duck_connection.execute(f"CREATE SCHEMA IF NOT EXISTS {schema}")
+            self.duck_connection.execute(f"SET schema = '{schema}'")
+
+    def connect(self, max_tries: int = 5, delay: int = 2):
+        # Abre a conexão com o duck.db. Se o arquivo estiver travado por outro processo (ex: uma leitura da API de
+        # status em andamento), tenta novamente algumas vezes antes de desistir.
+        attempt = 1
+
+        while True:
+            try:
+                return duckdb.connect(self.db_path)
+            except duckdb.IOException as e:
+                if attempt >= max_tries:
+                    raise
+
+                logger.warning(f"O duck.db está em uso por outro processo: {e}. Aguardando {delay} segundos...")
+                attempt += 1
+                time.sleep(delay)
+
+    def close(self):
+        # Fecha a conexão com o duck.db, liberando o arquivo para outros processos. Com uma conexão compartilhada,
+        # fecha apenas o cursor deste conector.
+        self.duck_connection.close()
+
+    def mark_data_changed(self):
+        # Grava uma nova versão dos dados no arquivo duck.db.version. Leitores em outros processos (ex: a API de
+        # status) comparam essa versão para saber quando descartar as respostas em cache.
+        with open(f"{self.db_path}.version", "w", encoding="utf-8") as file:
+            file.write(str(time.time_ns()))
 
     def upsert_data(self, df, table_name, *, include_columns=[], exclude_columns=[], update_schema=False):
         # Perform an upsert operation (update or insert) on the specified table.
@@ -48,17 +89,19 @@ class DuckConnector():
 
         # Check if the table exists
         table_exists = self.duck_connection.execute(
-            f"SELECT COUNT(*) FROM information_schema.tables WHERE table_name = '{table_name}'"
+            f"SELECT COUNT(*) FROM information_schema.tables WHERE table_name = '{table_name}' AND table_schema = current_schema()"
         ).fetchone()[0]
 
         if table_exists == 0:
             # If the table doesn't exist, create it and insert data
             logger.info(f"Criando tabela {table_name}")
-            return (
+            result = (
                 self.duck_connection.sql(
                     f"CREATE TABLE {table_name} AS SELECT * FROM temp_df"
                 )
             )
+            self.mark_data_changed()
+            return result
         else:
             # Get existing columns in the destination table
             existing_columns = [
@@ -67,7 +110,7 @@ class DuckConnector():
                     f"""
                     SELECT column_name 
                     FROM information_schema.columns 
-                    WHERE table_name = '{table_name}'
+                    WHERE table_name = '{table_name}' AND table_schema = current_schema()
                     """
                 ).fetchall()
             ]
@@ -175,6 +218,9 @@ class DuckConnector():
             # Clean up temporary table
             self.duck_connection.unregister("temp_df")
 
+            if affected_rows > 0:
+                self.mark_data_changed()
+
             return affected_rows
 
     def export_data_to_csv(self, query: str = None, filename: str = None):
@@ -5,32 +5,53 @@ from dotenv import load_dotenv
 from datetime import datetime
 
 from .BaseClasses import BaseDBConnector
+from .Records import ShippingTicket
 from src.utils.logger import logger
-from src.utils.constants import YESTERDAY, SQL_PATH
+from src.utils.templates import read_template
+from src.utils import constants
+from src.utils.constants import SQL_PATH
 
 load_dotenv()
 
 class Protheus(BaseDBConnector):
-    def __init__(self):
+    def __init__(self, env_prefix: str = ""):
         super().__init__()
 
-        self.server = os.getenv("PROTHEUS_SERVER")
-        self.database = os.getenv("PROTHEUS_DB")
-        self.username = os.getenv("PROTHEUS_USERNAME")
-        self.password = os.getenv("PROTHEUS_PASSWORD")
-        self.port = os.getenv("PROTHEUS_PORT")
+        # 'env_prefix' seleciona as credenciais de um tenant (ex: GRUPO_A_PROTHEUS_SERVER, ver Tenants)
+        self.server = os.getenv(f"{env_prefix}PROTHEUS_SERVER")
+        self.database = os.getenv(f"{env_prefix}PROTHEUS_DB")
+        self.username = os.getenv(f"{env_prefix}PROTHEUS_USERNAME")
+        self.password = os.getenv(f"{env_prefix}PROTHEUS_PASSWORD")
+        self.port = os.getenv(f"{env_prefix}PROTHEUS_PORT")
 
+        self.source_name = "protheus"
+
+        # Tempo limite de login do ODBC
+        self.connect_args = {"timeout": self.connect_timeout}
         self.conn_string = f"mssql+pyodbc://{self.username}:{self.password}@{self.server}:{self.port}/{self.database}?driver=ODBC+Driver+17+for+SQL+Server"
 
     def print_connection(self):
         print(self.conn_string)
 
+    def explain(self, conn, query: str):
+        # Plano estimado do SQL Server: com SHOWPLAN_XML ligado, a consulta não é executada e o banco devolve o plano
+        # em XML. A opção vale para a sessão, então é desligada logo em seguida, na mesma conexão.
+        conn.exec_driver_sql("SET SHOWPLAN_XML ON")
+
+        try:
+            rows = conn.execute(sqla.text(query)).fetchall()
+        finally:
+            conn.exec_driver_sql("SET SHOWPLAN_XML OFF")
+
+        return "\n".join(str(row[0]) for row in rows)
+
     def get_shipping_ticket_summary(self, date: datetime = None):
         # Esta função tem como objetivo buscar no Protheus todas as fichas de remessa emitidas em uma determinada data.
         #
         # Se a data não for especificada, a função irá utilizar o dia anterior ao de sua execução como padrão.
         #
-        # Ao ser executada, a função irá retornar um DataFrame com as seguintes colunas:
+        # Ao ser executada, a função irá retornar uma lista de ShippingTicket com os seguintes campos:
+        # - Empresa associada
         # - Nome da agência
         # - Código da agência - Código da agência no Protheus (NÃO É O MESMO DO CÓDIGO DA AGÊNCIA NO TOTALBUS!)
         # - Número da ficha - Segue o formato padrão de YYYYMMDD que representa a data do fechamento dessa ficha
@@ -40,19 +61,21 @@ class Protheus(BaseDBConnector):
 
         if date is None:
             logger.warning("Data não especificada, usando D-1...")
-            date = YESTERDAY
+            date = constants.get_yesterday()
 
         emission_date = date.strftime("%Y%m%d")
 
         try:
             path_file = os.path.join(SQL_PATH, "protheus_shipping_tickets.sql")
-            with open(path_file) as file:
-                logger.debug(f"Buscando todas as fichas de remessa do dia {date.strftime("%d/%m/%Y")}...")
-                query = file.read().format(**locals())
+            logger.debug(f"Buscando todas as fichas de remessa do dia {date.strftime("%d/%m/%Y")}...")
+            query = read_template(path_file).format(**locals())
 
-                shipping_tickets = self.fetchmany_read_query(query=query)
+            rows = self.fetch_rows(query=query, template="protheus_shipping_tickets")
 
-            return shipping_tickets
+            if rows is None:
+                return None
+
+            return [ShippingTicket.from_row(row) for row in rows]
         except Exception as e:
             logger.error(f"Não foi possível buscar as fichas de remessa. Cheque os logs de debug!")
             logger.error(f"Motivo: {e}")
@@ -60,6 +83,29 @@ class Protheus(BaseDBConnector):
             logger.error(f"\n{tb_str}")
             return None
 
+    def iter_shipping_ticket_summary(self, date: datetime = None, chunk_size: int = 1000):
+        # Versão em blocos de get_shipping_ticket_summary, para dias com muitas fichas (fim de mês, feriados).
+        #
+        # É um gerador que entrega listas de até 'chunk_size' ShippingTicket, lidas do banco conforme são consumidas.
+        # Assim, apenas um bloco de fichas fica na memória por vez.
+        #
+        # Se a data não for especificada, a função irá utilizar o dia anterior ao de sua execução como padrão.
+        #
+        # Erros durante a consulta são lançados para quem está consumindo o gerador.
+
+        if date is None:
+            logger.warning("Data não especificada, usando D-1...")
+            date = constants.get_yesterday()
+
+        emission_date = date.strftime("%Y%m%d")
+
+        path_file = os.path.join(SQL_PATH, "protheus_shipping_tickets.sql")
+        logger.debug(f"Buscando as fichas de remessa do dia {date.strftime("%d/%m/%Y")} em blocos de {chunk_size}...")
+        query = read_template(path_file).format(**locals())
+
+        for rows in self.stream_rows(query=query, chunk_size=chunk_size, template="protheus_shipping_tickets"):
+            yield [ShippingTicket.from_row(row) for row in rows]
+
     def get_shipping_details(self, date: datetime = None, agency_code: str = None, associated_company: str = None):
         # Esta função tem como objetivo buscar no Protheus detalhes de despesas e algumas receitas extras,
         # tais como multas, excesso de bagagem, etc. Tudo isso a partir do código da agência no Protheus.
@@ -84,17 +130,16 @@ class Protheus(BaseDBConnector):
 
         if date is None:
             logger.warning("Data não especificada, usando D-1...")
-            date = YESTERDAY
+            date = constants.get_yesterday()
 
         emission_date = date.strftime("%Y%m%d")
 
         try:
             path_file = os.path.join(SQL_PATH, "protheus_agency_details.sql")
-            with open(path_file) as file:
-                logger.debug(f"Buscando as transações adicionais da agência. Código: {agency_code}. Data: {date.strftime("%d/%m/%Y")}...")
-                query = file.read().format(**locals())
+            logger.debug(f"Buscando as transações adicionais da agência. Código: {agency_code}. Data: {date.strftime("%d/%m/%Y")}...")
+            query = read_template(path_file).format(**locals())
 
-                extra_events = self.fetchmany_read_query(query=query)
+            extra_events = self.fetchmany_read_query(query=query, template="protheus_agency_details")
 
             return extra_events
         except Exception as e:
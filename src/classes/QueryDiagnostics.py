@@ -0,0 +1,245 @@
+import hashlib
+import os
+import re
+import threading
+from datetime import datetime
+
+from src.utils.logger import logger
+
+class QueryDiagnostics():
+    # Diagnóstico das consultas de uma execução, por fonte (protheus/totalbus) e template SQL.
+    #
+    # Durante a execução, os conectores (BaseDBConnector) registram aqui:
+    # - o plano de execução de cada template, capturado uma única vez por execução (EXPLAIN PLAN/DBMS_XPLAN no Oracle
+    #   e SHOWPLAN_XML no SQL Server)
+    # - o tempo de execução, o tempo de leitura (fetch) e a quantidade de linhas de cada consulta
+    #
+    # No fim da execução, 'flush' grava tudo no duck.db (query_plans, query_executions e query_run_summary) e compara
+    # cada template com as execuções anteriores (linha de base):
+    # - plano alterado: o hash do plano é diferente do último plano capturado para o template
+    # - regressão: o tempo médio é maior que 'regression_factor' vezes a mediana dos tempos médios das últimas
+    #   'baseline_runs' execuções (padrão: DIAG_REGRESSION_FACTOR = 2 e DIAG_BASELINE_RUNS = 7)
+
+    PLANS_TABLE = "query_plans"
+    EXECUTIONS_TABLE = "query_executions"
+    SUMMARY_TABLE = "query_run_summary"
+
+    # Regressões abaixo desse tempo médio (em segundos) são ignoradas, para não alertar sobre variações de milissegundos
+    MIN_REGRESSION_SECONDS = 0.5
+
+    def __init__(self, run_id: str = None, regression_factor: float = None, baseline_runs: int = None):
+        if regression_factor is None:
+            regression_factor = float(os.getenv("DIAG_REGRESSION_FACTOR", "2"))
+
+        if baseline_runs is None:
+            baseline_runs = int(os.getenv("DIAG_BASELINE_RUNS", "7"))
+
+        self.run_id = run_id or datetime.now().strftime("%Y%m%d%H%M%S%f")
+        self.regression_factor = regression_factor
+        self.baseline_runs = baseline_runs
+
+        self.plans = {}
+        self.executions = []
+        self.lock = threading.Lock()
+
+    def needs_plan(self, source: str, template: str) -> bool:
+        # Retorna True apenas na primeira chamada para cada (fonte, template), reservando a captura do plano.
+        with self.lock:
+            if (source, template) in self.plans:
+                return False
+
+            self.plans[(source, template)] = None
+            return True
+
+    def record_plan(self, source: str, template: str, plan: str):
+        with self.lock:
+            self.plans[(source, template)] = (get_plan_hash(plan), plan)
+
+    def record_execution(self, source: str, template: str, elapsed: float, fetch_time: float, rows: int):
+        with self.lock:
+            self.executions.append((self.run_id, source, template, elapsed, fetch_time, rows, datetime.now()))
+
+    def create_tables(self, duck_connection):
+        duck_connection.execute(f"""
+            CREATE TABLE IF NOT EXISTS {self.PLANS_TABLE} (
+                run_id VARCHAR,
+                fonte VARCHAR,
+                template VARCHAR,
+                plan_hash VARCHAR,
+                plano VARCHAR,
+                capturado_em TIMESTAMP
+            )
+        """)
+        duck_connection.execute(f"""
+            CREATE TABLE IF NOT EXISTS {self.EXECUTIONS_TABLE} (
+                run_id VARCHAR,
+                fonte VARCHAR,
+                template VARCHAR,
+                tempo_execucao DOUBLE,
+                tempo_fetch DOUBLE,
+                linhas BIGINT,
+                executado_em TIMESTAMP
+            )
+        """)
+        duck_connection.execute(f"""
+            CREATE TABLE IF NOT EXISTS {self.SUMMARY_TABLE} (
+                run_id VARCHAR,
+                fonte VARCHAR,
+                template VARCHAR,
+                execucoes BIGINT,
+                tempo_medio DOUBLE,
+                tempo_p95 DOUBLE,
+                tempo_fetch_medio DOUBLE,
+                linhas_total BIGINT,
+                plan_hash VARCHAR,
+                tempo_base DOUBLE,
+                plano_alterado BOOLEAN,
+                regressao BOOLEAN,
+                data_execucao TIMESTAMP
+            )
+        """)
+
+    def flush(self, duck_connector) -> list:
+        # Grava o diagnóstico da execução no duck.db e retorna a lista de alertas (planos alterados e regressões), que
+        # também são registrados no log.
+        import pandas as pd
+
+        duck_connection = duck_connector.duck_connection
+        self.create_tables(duck_connection)
+
+        with self.lock:
+            plans = {key: value for key, value in self.plans.items() if value is not None}
+            executions = list(self.executions)
+
+        if len(executions) == 0 and len(plans) == 0:
+            logger.debug("Nenhuma consulta registrada para o diagnóstico.")
+            return []
+
+        captured_at = datetime.now()
+        plans_df = pd.DataFrame(
+            [(self.run_id, source, template, plan_hash, plan, captured_at) for (source, template), (plan_hash, plan) in plans.items()],
+            columns=["run_id", "fonte", "template", "plan_hash", "plano", "capturado_em"],
+        )
+        executions_df = pd.DataFrame(
+            executions,
+            columns=["run_id", "fonte", "template", "tempo_execucao", "tempo_fetch", "linhas", "executado_em"],
+        )
+
+        duck_connection.register("plans_df", plans_df)
+        duck_connection.register("executions_df", executions_df)
+
+        try:
+            # A linha de base é calculada antes de gravar esta execução, apenas com as execuções anteriores
+            summary = duck_connection.execute(f"""
+                WITH current_run AS (
+                    SELECT
+                        fonte,
+                        template,
+                        COUNT(*) AS execucoes,
+                        AVG(tempo_execucao + tempo_fetch) AS tempo_medio,
+                        QUANTILE_CONT(tempo_execucao + tempo_fetch, 0.95) AS tempo_p95,
+                        AVG(tempo_fetch) AS tempo_fetch_medio,
+                        SUM(linhas) AS linhas_total
+                    FROM executions_df
+                    GROUP BY fonte, template
+                ),
+                current_plans AS (
+                    SELECT fonte, template, plan_hash FROM plans_df
+                ),
+                current_keys AS (
+                    SELECT fonte, template FROM current_run
+                    UNION
+                    SELECT fonte, template FROM current_plans
+                ),
+                previous_runs AS (
+                    SELECT
+                        fonte,
+                        template,
+                        tempo_medio,
+                        ROW_NUMBER() OVER (PARTITION BY fonte, template ORDER BY data_execucao DESC) AS ordem
+                    FROM {self.SUMMARY_TABLE}
+                ),
+                baseline AS (
+                    SELECT fonte, template, MEDIAN(tempo_medio) AS tempo_base
+                    FROM previous_runs
+                    WHERE ordem <= ?
+                    GROUP BY fonte, template
+                ),
+                previous_plans AS (
+                    SELECT fonte, template, plan_hash
+                    FROM (
+                        SELECT
+                            fonte,
+                            template,
+                            plan_hash,
+                            ROW_NUMBER() OVER (PARTITION BY fonte, template ORDER BY capturado_em DESC) AS ordem
+                        FROM {self.PLANS_TABLE}
+                    )
+                    WHERE ordem = 1
+                )
+                SELECT
+                    ? AS run_id,
+                    k.fonte,
+                    k.template,
+                    COALESCE(r.execucoes, 0) AS execucoes,
+                    r.tempo_medio,
+                    r.tempo_p95,
+                    r.tempo_fetch_medio,
+                    r.linhas_total,
+                    p.plan_hash,
+                    b.tempo_base,
+                    COALESCE(p.plan_hash IS NOT NULL AND pp.plan_hash IS NOT NULL AND p.plan_hash <> pp.plan_hash, FALSE) AS plano_alterado,
+                    COALESCE(r.tempo_medio >= ? AND r.tempo_medio > b.tempo_base * ?, FALSE) AS regressao,
+                    ? AS data_execucao
+                FROM current_keys k
+                LEFT JOIN current_run r USING (fonte, template)
+                LEFT JOIN current_plans p USING (fonte, template)
+                LEFT JOIN baseline b USING (fonte, template)
+                LEFT JOIN previous_plans pp USING (fonte, template)
+                ORDER BY k.fonte, k.template
+            """, [self.baseline_runs, self.run_id, self.MIN_REGRESSION_SECONDS, self.regression_factor, captured_at]).fetchdf()
+
+            duck_connection.register("summary_df", summary)
+            duck_connection.execute(f"INSERT INTO {self.PLANS_TABLE} SELECT * FROM plans_df")
+            duck_connection.execute(f"INSERT INTO {self.EXECUTIONS_TABLE} SELECT * FROM executions_df")
+            duck_connection.execute(f"INSERT INTO {self.SUMMARY_TABLE} SELECT * FROM summary_df")
+            duck_connection.unregister("summary_df")
+        finally:
+            duck_connection.unregister("plans_df")
+            duck_connection.unregister("executions_df")
+
+        alerts = []
+        for row in summary.itertuples():
+            logger.info(
+                f"Diagnóstico {row.fonte}/{row.template}: {row.execucoes} execuções, "
+                f"média de {(row.tempo_medio or 0) * 1000:.0f} ms, p95 de {(row.tempo_p95 or 0) * 1000:.0f} ms."
+            )
+
+            if row.plano_alterado:
+                alerts.append(f"O plano de execução de {row.fonte}/{row.template} mudou (hash atual: {row.plan_hash}).")
+
+            if row.regressao:
+                alerts.append(
+                    f"Regressão de tempo em {row.fonte}/{row.template}: média de {row.tempo_medio:.2f} s, "
+                    f"contra {row.tempo_base:.2f} s nas execuções anteriores."
+                )
+
+        for alert in alerts:
+            logger.warning(alert)
+
+        logger.info(f"Diagnóstico das consultas gravado no duck.db (run_id {self.run_id}).")
+        return alerts
+
+def get_plan_hash(plan: str) -> str:
+    '''retorna o hash do plano informado pelo próprio banco ou, se não houver, um hash do texto do plano'''
+    # Oracle (DBMS_XPLAN): "Plan hash value: 123456"
+    match = re.search(r"Plan hash value:\s*(\d+)", plan)
+    if match:
+        return match.group(1)
+
+    # SQL Server (SHOWPLAN_XML): QueryPlanHash="0x..."
+    match = re.search(r'QueryPlanHash="([^"]+)"', plan)
+    if match:
+        return match.group(1)
+
+    return hashlib.sha1(plan.encode("utf-8")).hexdigest()[:16]
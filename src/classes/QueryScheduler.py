@@ -0,0 +1,163 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+from sqlalchemy.exc import OperationalError
+
+from src.utils.logger import logger
+
+class QueryScheduler():
+    # Escalonador de consultas de uma fonte (protheus/totalbus), usado pelo BaseDBConnector antes de cada consulta.
+    #
+    # Cada fonte tem o seu orçamento:
+    # - concorrência máxima: quantidade de consultas em andamento ao mesmo tempo (padrão: <FONTE>_MAX_CONCURRENCY = 4)
+    # - taxa máxima: consultas iniciadas por segundo (padrão: <FONTE>_RATE_LIMIT = 0, sem limite)
+    #
+    # Dentro desse orçamento, o limite de concorrência é ajustado no estilo AIMD (aumento aditivo, redução
+    # multiplicativa), a partir da latência e dos erros observados:
+    # - cada 'limit' consultas seguidas abaixo da latência alvo (padrão: <FONTE>_TARGET_LATENCY = 2 segundos) aumentam
+    #   o limite em 1, até a concorrência máxima
+    # - uma consulta acima da latência alvo ou um erro de conexão/operação reduz o limite pela metade, até a
+    #   concorrência mínima. Depois de uma redução, novas reduções esperam um intervalo (a latência alvo), para que as
+    #   consultas que já estavam em andamento não derrubem o limite várias vezes pelo mesmo pico.
+    #
+    # Assim, o comparativo usa toda a concorrência permitida nos horários tranquilos e recua sozinho quando o banco de
+    # produção está sob carga. As decisões são registradas no log e os contadores ficam disponíveis em 'get_stats'.
+
+    def __init__(self, source_name: str, max_concurrency: int = None, min_concurrency: int = 1, rate_limit: float = None,
+                 target_latency: float = None):
+        prefix = (source_name or "db").upper()
+
+        if max_concurrency is None:
+            max_concurrency = int(os.getenv(f"{prefix}_MAX_CONCURRENCY", "4"))
+
+        if rate_limit is None:
+            rate_limit = float(os.getenv(f"{prefix}_RATE_LIMIT", "0"))
+
+        if target_latency is None:
+            target_latency = float(os.getenv(f"{prefix}_TARGET_LATENCY", "2"))
+
+        self.source_name = source_name
+        self.max_concurrency = max(max_concurrency, 1)
+        self.min_concurrency = min(max(min_concurrency, 1), self.max_concurrency)
+        self.rate_limit = rate_limit
+        self.target_latency = target_latency
+
+        # O limite começa na concorrência mínima e sobe conforme as consultas respondem bem
+        self.limit = self.min_concurrency
+        self.in_flight = 0
+        self.successes = 0
+        self.last_decrease_at = 0.0
+
+        # Balde de fichas para a taxa máxima: acumula até 1 segundo de consultas
+        self.tokens = max(rate_limit, 1)
+        self.refilled_at = time.monotonic()
+
+        self.condition = threading.Condition()
+        self.stats = {
+            "completed": 0,
+            "errors": 0,
+            "slow": 0,
+            "increases": 0,
+            "decreases": 0,
+            "wait_time": 0.0,
+            "latency": 0.0,
+        }
+
+    def refill(self, now: float):
+        if self.rate_limit <= 0:
+            return
+
+        self.tokens = min(self.tokens + (now - self.refilled_at) * self.rate_limit, max(self.rate_limit, 1))
+        self.refilled_at = now
+
+    def acquire(self):
+        # Bloqueia até haver uma vaga dentro do limite de concorrência e da taxa máxima da fonte.
+        started_at = time.monotonic()
+
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                self.refill(now)
+
+                if self.in_flight < self.limit and (self.rate_limit <= 0 or self.tokens >= 1):
+                    break
+
+                if self.in_flight < self.limit:
+                    # Há vaga, mas a taxa máxima foi atingida: espera a próxima ficha do balde
+                    self.condition.wait(timeout=(1 - self.tokens) / self.rate_limit)
+                else:
+                    self.condition.wait()
+
+            self.in_flight += 1
+
+            if self.rate_limit > 0:
+                self.tokens -= 1
+
+            self.stats["wait_time"] += time.monotonic() - started_at
+
+    def release(self, elapsed: float, error: bool = False):
+        # Devolve a vaga e ajusta o limite de concorrência a partir do resultado da consulta.
+        with self.condition:
+            self.in_flight -= 1
+            self.stats["completed"] += 1
+            self.stats["latency"] = elapsed if self.stats["completed"] == 1 else 0.8 * self.stats["latency"] + 0.2 * elapsed
+
+            if error or elapsed > self.target_latency:
+                self.stats["errors" if error else "slow"] += 1
+                self.successes = 0
+                now = time.monotonic()
+
+                if now - self.last_decrease_at >= self.target_latency and self.limit > self.min_concurrency:
+                    previous_limit = self.limit
+                    self.limit = max(self.limit // 2, self.min_concurrency)
+                    self.last_decrease_at = now
+                    self.stats["decreases"] += 1
+
+                    reason = "erro na consulta" if error else f"latência de {elapsed:.2f} s"
+                    logger.warning(f"Escalonador {self.source_name}: concorrência reduzida de {previous_limit} para {self.limit} ({reason}).")
+            else:
+                self.successes += 1
+
+                if self.successes >= self.limit and self.limit < self.max_concurrency:
+                    self.limit += 1
+                    self.successes = 0
+                    self.stats["increases"] += 1
+                    logger.info(f"Escalonador {self.source_name}: concorrência aumentada para {self.limit} (latência média de {self.stats["latency"]:.2f} s).")
+
+            self.condition.notify_all()
+
+    @contextmanager
+    def slot(self):
+        # Reserva uma vaga durante o bloco 'with'. Apenas erros operacionais (conexão, tempo limite, banco indisponível)
+        # contam como sinal de carga; outros erros apenas devolvem a vaga.
+        #
+        # O bloco recebe um objeto com o campo 'elapsed'. Quem executa a consulta deve preenchê-lo com o tempo de
+        # execução no banco, sem a leitura das linhas, para que resultados grandes não sejam tomados como sinal de
+        # carga. Se ele não for preenchido, vale o tempo do bloco inteiro.
+        self.acquire()
+        started_at = time.perf_counter()
+        timing = SimpleNamespace(elapsed=None)
+        error = False
+
+        try:
+            yield timing
+        except OperationalError:
+            error = True
+            raise
+        finally:
+            elapsed = timing.elapsed if timing.elapsed is not None else time.perf_counter() - started_at
+            self.release(elapsed, error=error)
+
+    def get_stats(self) -> dict:
+        with self.condition:
+            return {
+                "source": self.source_name,
+                "limit": self.limit,
+                "max_concurrency": self.max_concurrency,
+                "rate_limit": self.rate_limit,
+                "in_flight": self.in_flight,
+                **self.stats,
+            }
@@ -0,0 +1,94 @@
+from dataclasses import dataclass
+
+# Registros tipados usados ao longo do comparativo. São dataclasses com __slots__, para que cada linha ocupe apenas
+# o espaço dos seus campos (sem __dict__ por instância) em execuções com dezenas de milhares de fichas.
+#
+# Os valores monetários (campos *_cents) são inteiros em centavos, já convertidos nas consultas (ver utils/money.py).
+
+@dataclass(slots=True)
+class ShippingTicket:
+    # Ficha de remessa do Protheus (protheus_shipping_tickets.sql)
+    associated_company: str
+    agency_name: str
+    agency_code: str
+    ticket_number: str
+    receipt_cents: int
+    expenses_cents: int
+    net_value_cents: int
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(
+            associated_company=row.associated_company,
+            agency_name=row.agency_name,
+            agency_code=row.agency_code,
+            ticket_number=row.ticket_number,
+            receipt_cents=row.receipt_cents,
+            expenses_cents=row.expenses_cents,
+            net_value_cents=row.net_value_cents,
+        )
+
+@dataclass(slots=True)
+class TotalBusAggregate:
+    # Totais de uma agência no TotalBus, por empresa (totalbus_agency_shipping_report.sql e
+    # totalbus_agency_cancelled_transactions.sql). 'total_cents' é a soma de passagens e taxas.
+    associated_company: str
+    ticket_total_cents: int
+    boarding_tax_total_cents: int
+    toll_tax_total_cents: int
+    others_total_cents: int
+    insurance_total_cents: int
+    total_cents: int
+
+    @classmethod
+    def from_row(cls, row):
+        values = (
+            row.ticket_total_cents,
+            row.boarding_tax_total_cents,
+            row.toll_tax_total_cents,
+            row.others_total_cents,
+            row.insurance_total_cents,
+        )
+
+        return cls(row.associated_company, *values, total_cents=sum(values))
+
+@dataclass(slots=True)
+class ExtraEvent:
+    # Transação extra de uma agência no TotalBus (totalbus_agency_extra_events.sql)
+    associated_company: str
+    description: str
+    nature: str
+    total_cents: int
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(
+            associated_company=row.associated_company,
+            description=row.bill_description.strip(),
+            nature=row.nature,
+            total_cents=row.bill_value_cents,
+        )
+
+@dataclass(slots=True)
+class ReconciliationResult:
+    # Resultado do comparativo de uma ficha de remessa. Fichas válidas levam uma observação em 'message', e fichas
+    # discrepantes levam o motivo da discrepância.
+    agency_name: str
+    agency_code: str
+    ticket_number: str
+    associated_company: str
+    valid: bool
+    message: str
+
+def results_to_dataframe(results: list, message_column: str):
+    # Monta o DataFrame no formato das tabelas valid_tickets/incongruent_tickets coluna a coluna, sem criar um
+    # dicionário por resultado. 'message_column' é 'observacao' para as válidas e 'motivo_erro' para as discrepantes.
+    import pandas as pd
+
+    return pd.DataFrame({
+        "nome_agencia": [result.agency_name for result in results],
+        "cod_agencia_protheus": [result.agency_code for result in results],
+        "num_ficha_protheus": [result.ticket_number for result in results],
+        "empresa": [result.associated_company for result in results],
+        message_column: [result.message for result in results],
+    })
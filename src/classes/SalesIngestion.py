@@ -0,0 +1,309 @@
+import os
+from datetime import datetime, time, timedelta
+
+from .Records import ExtraEvent, TotalBusAggregate
+from src.utils.logger import logger
+from src.utils.templates import read_template
+from src.utils.constants import SQL_PATH
+
+class SalesIngestion():
+    # Ingestão incremental das vendas (caja) e transações extras (caja_diversos) do TotalBus no duck.db.
+    #
+    # Em vez de agregar o dia inteiro no Oracle no horário do comparativo, a ingestão lê apenas as linhas posteriores
+    # à marca d'água (watermark) de cada fonte e soma essas linhas aos totais por agência guardados no duck.db. Ela
+    # pode ser executada várias vezes ao longo do dia (subcomando 'ingest' ou passadas do modo serviço), e no
+    # comparativo só falta ler o último trecho.
+    #
+    # A marca d'água é o par (horário, id) da última linha lida: fechorventa/caja_id para as vendas e
+    # feccorte/cajadiversos_id para as transações extras. Cada leitura vai até 'agora - lag_minutes' (padrão:
+    # INGESTION_LAG_MINUTES = 10), para dar tempo das transações em andamento no Oracle serem gravadas. Os totais e a
+    # marca d'água são gravados na mesma transação do duck.db, então uma ingestão interrompida não soma nada.
+    #
+    # As consultas do trecho devolvem os valores do Oracle sem arredondar, e os totais guardam as somas sem
+    # arredondar (DECIMAL(38,10), ver src/utils/money.py). load_totals arredonda cada total para centavos uma única
+    # vez, como o ROUND(SUM(valor) * 100) das consultas do TotalBus, para que os totais locais e os do Oracle sejam
+    # iguais também quando os valores têm mais de duas casas decimais.
+    #
+    # Cada fonte também guarda até onde já foi lida ('lido_ate'). Os totais só representam o dia inteiro depois que as
+    # duas fontes foram lidas até o fim do dia de vendas (ver covers_sales_day). Antes disso, o comparativo consulta o
+    # Oracle diretamente.
+    #
+    # Limitações, corrigidas apenas com 'rebuild' (que descarta os totais do dia e lê o dia inteiro novamente):
+    # - linhas alteradas no Oracle depois de lidas (ex: uma venda desativada) não são relidas
+    # - linhas gravadas com atraso e com um horário antigo (ex: vendas de uma agência offline sincronizadas mais tarde,
+    #   com fechorventa/feccorte anterior à marca d'água) ficam atrás da marca d'água e não são lidas
+
+    SALES_TABLE = "totalbus_sales_totals"
+    EXTRA_TABLE = "totalbus_extra_totals"
+    WATERMARK_TABLE = "ingestion_watermarks"
+
+    SOURCES = ["caja", "caja_diversos"]
+
+    MONEY_COLUMNS = ["ticket_total", "boarding_tax_total", "toll_tax_total", "others_total", "insurance_total"]
+    MONEY_TYPE = "DECIMAL(38,10)"
+
+    def __init__(self, totalbus_connector, duck_connector, lag_minutes: int = None, chunk_size: int = None):
+        if lag_minutes is None:
+            lag_minutes = int(os.getenv("INGESTION_LAG_MINUTES", "10"))
+
+        if chunk_size is None:
+            chunk_size = int(os.getenv("INGESTION_CHUNK_SIZE", "5000"))
+
+        self.totalbus_connector = totalbus_connector
+        self.duck_connector = duck_connector
+        self.duck_connection = duck_connector.duck_connection
+        self.lag = timedelta(minutes=lag_minutes)
+        self.chunk_size = chunk_size
+
+        self.create_tables()
+
+    def create_tables(self):
+        self.drop_outdated_totals()
+
+        self.duck_connection.execute(f"""
+            CREATE TABLE IF NOT EXISTS {self.SALES_TABLE} (
+                data_venda DATE,
+                nome_agencia VARCHAR,
+                empresa VARCHAR,
+                cancelado BOOLEAN,
+                {", ".join(f"{column} {self.MONEY_TYPE}" for column in self.MONEY_COLUMNS)},
+                linhas BIGINT,
+                PRIMARY KEY (data_venda, nome_agencia, empresa, cancelado)
+            )
+        """)
+        self.duck_connection.execute(f"""
+            CREATE TABLE IF NOT EXISTS {self.EXTRA_TABLE} (
+                data_venda DATE,
+                nome_agencia VARCHAR,
+                empresa VARCHAR,
+                descricao VARCHAR,
+                natureza VARCHAR,
+                valor {self.MONEY_TYPE},
+                linhas BIGINT,
+                PRIMARY KEY (data_venda, nome_agencia, empresa, descricao, natureza)
+            )
+        """)
+        self.duck_connection.execute(f"""
+            CREATE TABLE IF NOT EXISTS {self.WATERMARK_TABLE} (
+                fonte VARCHAR,
+                data_venda DATE,
+                ultimo_horario TIMESTAMP,
+                ultimo_id BIGINT,
+                linhas BIGINT,
+                atualizado_em TIMESTAMP,
+                lido_ate TIMESTAMP,
+                PRIMARY KEY (fonte, data_venda)
+            )
+        """)
+        # Tabelas criadas antes da coluna lido_ate existir
+        self.duck_connection.execute(f"ALTER TABLE {self.WATERMARK_TABLE} ADD COLUMN IF NOT EXISTS lido_ate TIMESTAMP")
+
+    def drop_outdated_totals(self):
+        # Tabelas de totais criadas com outro tipo para os valores (ex: BIGINT em centavos) são descartadas junto com
+        # as marcas d'água, e os dias são lidos novamente na próxima ingestão
+        columns = self.duck_connection.execute(
+            "SELECT table_name, data_type FROM information_schema.columns WHERE table_name IN (?, ?) AND column_name IN ('ticket_total', 'valor')",
+            [self.SALES_TABLE, self.EXTRA_TABLE],
+        ).fetchall()
+        existing_tables = self.duck_connection.execute(
+            "SELECT COUNT(*) FROM information_schema.tables WHERE table_name IN (?, ?)",
+            [self.SALES_TABLE, self.EXTRA_TABLE],
+        ).fetchone()[0]
+
+        if existing_tables == len(columns) and all(data_type == self.MONEY_TYPE for _, data_type in columns):
+            return
+
+        logger.info("Descartando os totais incrementais gravados em um formato antigo. Os dias serão lidos novamente.")
+
+        self.duck_connection.execute(f"DROP TABLE IF EXISTS {self.SALES_TABLE}")
+        self.duck_connection.execute(f"DROP TABLE IF EXISTS {self.EXTRA_TABLE}")
+        self.duck_connection.execute(f"DROP TABLE IF EXISTS {self.WATERMARK_TABLE}")
+
+    def get_sales_day(self, date: datetime):
+        # As consultas do TotalBus para a ficha do dia 'date' leem as vendas do dia anterior (ver TotalBus)
+        return (date - timedelta(days=1)).date()
+
+    def get_watermark(self, source: str, sales_day) -> tuple:
+        row = self.duck_connection.execute(
+            f"SELECT ultimo_horario, ultimo_id FROM {self.WATERMARK_TABLE} WHERE fonte = ? AND data_venda = ?",
+            [source, sales_day],
+        ).fetchone()
+
+        if row is None:
+            # Sem marca d'água, a leitura começa no início do dia
+            return datetime.combine(sales_day, time.min), -1
+
+        return row[0], row[1]
+
+    def covers_sales_day(self, date: datetime) -> bool:
+        # Retorna True se as duas fontes já foram lidas até o fim do dia de vendas da ficha 'date'
+        sales_day = self.get_sales_day(date)
+        end_of_day = datetime.combine(sales_day + timedelta(days=1), time.min)
+
+        read_until = self.duck_connection.execute(
+            f"SELECT fonte, lido_ate FROM {self.WATERMARK_TABLE} WHERE data_venda = ?",
+            [sales_day],
+        ).fetchall()
+        read_until = dict(read_until)
+
+        return all(read_until.get(source) is not None and read_until[source] >= end_of_day for source in self.SOURCES)
+
+    def reset(self, sales_day):
+        # Descarta os totais e as marcas d'água do dia, para que ele seja lido do zero
+        self.duck_connection.execute("BEGIN TRANSACTION")
+        try:
+            for table in (self.SALES_TABLE, self.EXTRA_TABLE, self.WATERMARK_TABLE):
+                self.duck_connection.execute(f"DELETE FROM {table} WHERE data_venda = ?", [sales_day])
+            self.duck_connection.execute("COMMIT")
+        except Exception:
+            self.duck_connection.execute("ROLLBACK")
+            raise
+
+    def ingest(self, date: datetime, rebuild: bool = False) -> int:
+        # Lê o trecho novo das vendas e das transações extras do dia de vendas da ficha 'date' e retorna a quantidade
+        # de linhas lidas. Erros são lançados para quem chamou.
+        sales_day = self.get_sales_day(date)
+
+        if rebuild:
+            logger.info(f"Descartando os totais incrementais do dia {sales_day.strftime("%d/%m/%Y")}...")
+            self.reset(sales_day)
+
+        # A leitura vai até 'agora - lag', limitada ao fim do dia de vendas
+        upper_bound = min(datetime.now() - self.lag, datetime.combine(sales_day + timedelta(days=1), time.min))
+
+        rows = self.ingest_source("caja", "totalbus_sales_delta", date, sales_day, upper_bound, self.merge_sales)
+        rows += self.ingest_source("caja_diversos", "totalbus_extra_events_delta", date, sales_day, upper_bound, self.merge_extra_events)
+
+        self.duck_connector.mark_data_changed()
+        return rows
+
+    def ingest_source(self, source: str, template: str, date: datetime, sales_day, upper_bound: datetime, merge) -> int:
+        import pandas as pd
+
+        watermark_time, watermark_id = self.get_watermark(source, sales_day)
+
+        if upper_bound <= watermark_time:
+            logger.debug(f"Ingestão de {source}: nenhum trecho novo até {upper_bound.strftime("%H:%M:%S")}.")
+            return 0
+
+        # Mesma janela de datas das consultas do TotalBus, mais o trecho entre a marca d'água e o limite superior
+        query = read_template(os.path.join(SQL_PATH, f"{template}.sql")).format(
+            start_date=(date - timedelta(days=1)).strftime("%d-%b-%y"),
+            end_date=date.strftime("%d-%b-%y"),
+            watermark_time=watermark_time.strftime("%Y-%m-%d %H:%M:%S.%f"),
+            watermark_id=watermark_id,
+            upper_bound=upper_bound.strftime("%Y-%m-%d %H:%M:%S.%f"),
+        )
+
+        rows = 0
+        last_row = None
+
+        self.duck_connection.execute("BEGIN TRANSACTION")
+
+        try:
+            for partition in self.totalbus_connector.stream_rows(query, chunk_size=self.chunk_size, template=template):
+                merge(sales_day, pd.DataFrame(partition, columns=list(partition[0]._fields)))
+                rows += len(partition)
+
+                # As linhas vêm ordenadas por (horário, id), então a última linha lida é a nova marca d'água
+                last_row = partition[-1]
+
+            # Sem linhas novas, a marca d'água continua a mesma, mas o trecho até 'upper_bound' conta como lido
+            if last_row is not None:
+                watermark_time, watermark_id = last_row.row_time, last_row.row_id
+
+            self.duck_connection.execute(
+                f"""
+                INSERT INTO {self.WATERMARK_TABLE} (fonte, data_venda, ultimo_horario, ultimo_id, linhas, atualizado_em, lido_ate)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (fonte, data_venda) DO UPDATE SET
+                    ultimo_horario = EXCLUDED.ultimo_horario,
+                    ultimo_id = EXCLUDED.ultimo_id,
+                    linhas = linhas + EXCLUDED.linhas,
+                    atualizado_em = EXCLUDED.atualizado_em,
+                    lido_ate = EXCLUDED.lido_ate
+                """,
+                [source, sales_day, watermark_time, watermark_id, rows, datetime.now(), upper_bound],
+            )
+
+            self.duck_connection.execute("COMMIT")
+        except Exception:
+            self.duck_connection.execute("ROLLBACK")
+            raise
+
+        logger.info(f"Ingestão de {source}: {rows} linhas novas do dia {sales_day.strftime("%d/%m/%Y")} até {upper_bound.strftime("%H:%M:%S")}.")
+        return rows
+
+    def merge_sales(self, sales_day, delta_df):
+        # Soma o trecho lido aos totais por agência, empresa e situação (vendida ou cancelada)
+        self.duck_connection.register("sales_delta_df", delta_df)
+
+        try:
+            self.duck_connection.execute(f"""
+                INSERT INTO {self.SALES_TABLE}
+                SELECT
+                    ?,
+                    agency_name,
+                    CAST(associated_company AS VARCHAR),
+                    cancelled = 1,
+                    {", ".join(f"SUM(CAST({column} AS {self.MONEY_TYPE}))" for column in self.MONEY_COLUMNS)},
+                    COUNT(*)
+                FROM sales_delta_df
+                GROUP BY agency_name, associated_company, cancelled
+                ON CONFLICT (data_venda, nome_agencia, empresa, cancelado) DO UPDATE SET
+                    {", ".join(f"{column} = {column} + EXCLUDED.{column}" for column in self.MONEY_COLUMNS)},
+                    linhas = linhas + EXCLUDED.linhas
+            """, [sales_day])
+        finally:
+            self.duck_connection.unregister("sales_delta_df")
+
+    def merge_extra_events(self, sales_day, delta_df):
+        # Soma o trecho lido aos totais por agência, empresa e tipo de transação extra
+        self.duck_connection.register("extra_delta_df", delta_df)
+
+        try:
+            self.duck_connection.execute(f"""
+                INSERT INTO {self.EXTRA_TABLE}
+                SELECT
+                    ?,
+                    agency_name,
+                    CAST(associated_company AS VARCHAR),
+                    bill_description,
+                    COALESCE(CAST(nature AS VARCHAR), ''),
+                    SUM(CAST(bill_value AS {self.MONEY_TYPE})),
+                    COUNT(*)
+                FROM extra_delta_df
+                GROUP BY agency_name, associated_company, bill_description, nature
+                ON CONFLICT (data_venda, nome_agencia, empresa, descricao, natureza) DO UPDATE SET
+                    valor = valor + EXCLUDED.valor,
+                    linhas = linhas + EXCLUDED.linhas
+            """, [sales_day])
+        finally:
+            self.duck_connection.unregister("extra_delta_df")
+
+    def load_totals(self, date: datetime) -> dict:
+        # Carrega os totais do dia de vendas da ficha 'date' no formato usado por TotalBus.set_local_totals:
+        # {"shipping_report" | "cancelled_transactions" | "extra_events": {nome da agência: lista de registros}}
+        sales_day = self.get_sales_day(date)
+        totals = {"shipping_report": {}, "cancelled_transactions": {}, "extra_events": {}}
+
+        sales = self.duck_connection.execute(
+            f"SELECT nome_agencia, empresa, cancelado, {", ".join(f"CAST(ROUND({column} * 100) AS BIGINT)" for column in self.MONEY_COLUMNS)} FROM {self.SALES_TABLE} WHERE data_venda = ?",
+            [sales_day],
+        ).fetchall()
+
+        for agency_name, company, cancelled, *values in sales:
+            kind = "cancelled_transactions" if cancelled else "shipping_report"
+            totals[kind].setdefault(agency_name, []).append(TotalBusAggregate(company, *values, total_cents=sum(values)))
+
+        extra_events = self.duck_connection.execute(
+            f"SELECT nome_agencia, empresa, descricao, natureza, CAST(ROUND(valor * 100) AS BIGINT) FROM {self.EXTRA_TABLE} WHERE data_venda = ? ORDER BY descricao",
+            [sales_day],
+        ).fetchall()
+
+        for agency_name, company, description, nature, value_cents in extra_events:
+            totals["extra_events"].setdefault(agency_name, []).append(
+                ExtraEvent(company, description.strip(), nature or None, value_cents)
+            )
+
+        return totals
@@ -1,30 +1,122 @@
 import os
+import threading
 import traceback
-import sqlalchemy as sqla
+import uuid
+from collections import OrderedDict
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
 
 from .BaseClasses import BaseDBConnector
+from .Records import TotalBusAggregate, ExtraEvent
 from src.utils.logger import logger
-from src.utils.constants import YESTERDAY, SQL_PATH
+from src.utils.templates import read_template
+from src.utils import constants
+from src.utils.constants import SQL_PATH
 
 load_dotenv()
 
 class TotalBus(BaseDBConnector):
-    def __init__(self):
+    def __init__(self, cache_size: int = None, env_prefix: str = ""):
         super().__init__()
+
+        # Cache dos resultados por (template, janela de datas, agência). Várias fichas do Protheus podem apontar para a
+        # mesma agência, e sem o cache a mesma consulta seria repetida no Oracle. O cache deve ser limpo a cada execução
+        # (clear_cache), e 'cache_size' limita a quantidade de entradas (padrão: TOTALBUS_CACHE_SIZE, 0 = sem limite).
+        if cache_size is None:
+            cache_size = int(os.getenv("TOTALBUS_CACHE_SIZE", "0"))
+
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_lock = threading.Lock()
+
+        # Totais pré-agregados no duck.db pela ingestão incremental (ver SalesIngestion e set_local_totals)
+        self.local_totals = None
+        self.local_totals_date = None
         
-        self.server = os.getenv("ORACLE_SERVER")
-        self.service = os.getenv("ORACLE_SID")
-        self.username = os.getenv("ORACLE_USERNAME")
-        self.password = os.getenv("ORACLE_PASSWORD")
-        self.port = os.getenv("ORACLE_PORT")
+        # 'env_prefix' seleciona as credenciais de um tenant (ex: GRUPO_A_ORACLE_SERVER, ver Tenants)
+        self.server = os.getenv(f"{env_prefix}ORACLE_SERVER")
+        self.service = os.getenv(f"{env_prefix}ORACLE_SID")
+        self.username = os.getenv(f"{env_prefix}ORACLE_USERNAME")
+        self.password = os.getenv(f"{env_prefix}ORACLE_PASSWORD")
+        self.port = os.getenv(f"{env_prefix}ORACLE_PORT")
 
+        self.source_name = "totalbus"
+        self.probe_query = "SELECT 1 FROM DUAL"
+        self.connect_args = {"tcp_connect_timeout": self.connect_timeout}
         self.conn_string = f"oracle+oracledb://{self.username}:{self.password}@{self.server}:{self.port}/?service_name={self.service}"
 
     def print_connection(self):
         print(self.conn_string)
 
+    def explain(self, conn, query: str):
+        # Plano estimado do Oracle: EXPLAIN PLAN grava o plano na PLAN_TABLE (sem executar a consulta) com um
+        # identificador próprio, e o DBMS_XPLAN formata esse plano como texto, incluindo o "Plan hash value".
+        statement_id = f"EPC_{uuid.uuid4().hex[:20]}"
+
+        conn.exec_driver_sql(f"EXPLAIN PLAN SET STATEMENT_ID = '{statement_id}' FOR {query}")
+        rows = conn.exec_driver_sql(
+            f"SELECT plan_table_output FROM TABLE(DBMS_XPLAN.DISPLAY('PLAN_TABLE', '{statement_id}', 'TYPICAL'))"
+        ).fetchall()
+
+        return "\n".join(row[0] for row in rows if row[0] is not None)
+
+    def clear_cache(self):
+        # Descarta os resultados guardados e zera os contadores. Deve ser chamada no início de cada execução.
+        with self.cache_lock:
+            self.cache.clear()
+            self.cache_hits = 0
+            self.cache_misses = 0
+
+    def get_cache_stats(self) -> dict:
+        with self.cache_lock:
+            return {
+                "hits": self.cache_hits,
+                "misses": self.cache_misses,
+                "size": len(self.cache),
+            }
+
+    def get_from_cache(self, key: tuple):
+        # Retorna o resultado guardado para a chave, ou None se a consulta ainda não foi feita nesta execução.
+        with self.cache_lock:
+            if key in self.cache:
+                self.cache_hits += 1
+                self.cache.move_to_end(key)
+                return self.cache[key]
+
+            self.cache_misses += 1
+            return None
+
+    def add_to_cache(self, key: tuple, value):
+        # Apenas resultados válidos são guardados. Erros (None) não entram no cache, para que a consulta seja refeita.
+        if value is None:
+            return
+
+        with self.cache_lock:
+            self.cache[key] = value
+            self.cache.move_to_end(key)
+
+            if self.cache_size > 0 and len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def set_local_totals(self, date: datetime, totals: dict):
+        # Passa a responder as consultas da ficha do dia 'date' com os totais da ingestão incremental, sem consultar o
+        # Oracle. Agências sem nenhuma linha nos totais não tiveram movimento no dia.
+        self.local_totals = totals
+        self.local_totals_date = date.date()
+
+    def clear_local_totals(self):
+        self.local_totals = None
+        self.local_totals_date = None
+
+    def get_local_totals(self, kind: str, date: datetime, agency_name: str):
+        # Retorna a lista de registros da agência nos totais locais, ou None se eles não valem para a data
+        if self.local_totals is None or self.local_totals_date != date.date():
+            return None
+
+        return self.local_totals[kind].get(agency_name, [])
+
     def get_agency_shipping_report(self, date: datetime = None, agency_name: str = None):
         # Essa função tem como objetivo buscar a receita de uma ficha de remessa de uma agência no TotalBus (RJ)
         # a partir do seu nome e de uma data específica.
@@ -33,7 +125,7 @@ class TotalBus(BaseDBConnector):
         #
         # A função não irá executar se o nome da agência ou a empresa associada não forem passados, assim retornando None.
         #
-        # Ao passar os parâmetros, a função deve retornar em um dicionário os valores totais de:
+        # Ao passar os parâmetros, a função deve retornar uma lista de TotalBusAggregate, uma por empresa, com os valores totais de:
         # - Id da empresa (Cantelle ou Princesa)
         # - Passagens
         # - Taxas de embarque
@@ -50,30 +142,34 @@ class TotalBus(BaseDBConnector):
 
         if date is None:
             logger.warning("Data não especificada, usando D-1...")
-            date = YESTERDAY
+            date = constants.get_yesterday()
 
         start_date = (date - timedelta(days=1)).strftime("%d-%b-%y")
         end_date = date.strftime("%d-%b-%y")
 
+        local_result = self.get_local_totals("shipping_report", date, agency_name)
+
+        if local_result is not None:
+            return local_result
+
+        cache_key = ("totalbus_agency_shipping_report.sql", start_date, end_date, agency_name)
+        cached_result = self.get_from_cache(cache_key)
+
+        if cached_result is not None:
+            logger.debug(f"Resultado de totalbus_agency_shipping_report.sql para a agência {agency_name} reaproveitado do cache.")
+            return cached_result
+
         try:
             file_path = os.path.join(SQL_PATH, "totalbus_agency_shipping_report.sql")
-            with open(file_path) as file:
-                logger.debug(f"Buscando a ficha de remessa da agência {agency_name} - Data: {date.strftime("%d/%m/%Y")}...")
-                query = file.read().format(**locals())
+            logger.debug(f"Buscando a ficha de remessa da agência {agency_name} - Data: {date.strftime("%d/%m/%Y")}...")
+            query = read_template(file_path).format(**locals())
 
-                result = self.fetchmany_read_query(query=query)
+            result = self.fetch_rows(query=query, template="totalbus_agency_shipping_report")
                 
-                result_list = [{
-                    "associated_company": ticket[1]["associated_company"],
-                    "ticket_total": ticket[1]["ticket_total"],
-                    "boarding_tax_total": ticket[1]["boarding_tax_total"],
-                    "toll_tax_total": ticket[1]["toll_tax_total"],
-                    "others_total": ticket[1]["others_total"],
-                    "insurance_total": ticket[1]["insurance_total"],
-                    "receipt_total": sum(map(lambda x: float(x) if x is not None else 0.0, ticket[1][1::]))
-                } for ticket in result.iterrows()]
-
-                return result_list
+            result_list = [TotalBusAggregate.from_row(row) for row in result]
+
+            self.add_to_cache(cache_key, result_list)
+            return result_list
         except Exception as e:
             logger.error(f"Não foi possível buscar a ficha da agência {agency_name}. Cheque os logs de debug!")
             logger.error(f"Motivo: {e}")
@@ -92,7 +188,7 @@ class TotalBus(BaseDBConnector):
         #
         # A função não irá executar se o nome da agência não for passado, assim retornando None.
         #
-        # Ao passar os parâmetros, a função deve retornar as transações canceladas em um dicionário, contendo as seguintes chaves:
+        # Ao passar os parâmetros, a função deve retornar as transações canceladas em uma lista de TotalBusAggregate, com os campos:
         # - Id da empresa (Cantelle ou Princesa)
         # - Passagens
         # - Taxas de embarque
@@ -109,30 +205,34 @@ class TotalBus(BaseDBConnector):
 
         if date is None:
             logger.warning("Data não especificada, usando D-1...")
-            date = YESTERDAY
+            date = constants.get_yesterday()
         
         start_date = (date - timedelta(days=1)).strftime("%d-%b-%y")
         end_date = date.strftime("%d-%b-%y")
 
+        local_result = self.get_local_totals("cancelled_transactions", date, agency_name)
+
+        if local_result is not None:
+            return local_result
+
+        cache_key = ("totalbus_agency_cancelled_transactions.sql", start_date, end_date, agency_name)
+        cached_result = self.get_from_cache(cache_key)
+
+        if cached_result is not None:
+            logger.debug(f"Resultado de totalbus_agency_cancelled_transactions.sql para a agência {agency_name} reaproveitado do cache.")
+            return cached_result
+
         try:
             file_path = os.path.join(SQL_PATH, "totalbus_agency_cancelled_transactions.sql")
-            with open(file_path) as file:
-                logger.debug(f"Buscando transações canceladas da ficha de remessa da agência {agency_name} - Data: {date.strftime("%d/%m/%Y")}...")
-                query = file.read().format(**locals())
-
-                cancelled_transactions = self.fetchmany_read_query(query=query)
-
-                cancelled_transactions = [{
-                    "associated_company": ticket[1]["associated_company"],
-                    "ticket_total": ticket[1]["ticket_total"],
-                    "boarding_tax_total": ticket[1]["boarding_tax_total"],
-                    "toll_tax_total": ticket[1]["toll_tax_total"],
-                    "others_total": ticket[1]["others_total"],
-                    "insurance_total": ticket[1]["insurance_total"],
-                    "cancelled_total": sum(map(lambda x: float(x) if x is not None else 0.0, ticket[1][1::]))
-                } for ticket in cancelled_transactions.iterrows()]
-
-                return cancelled_transactions
+            logger.debug(f"Buscando transações canceladas da ficha de remessa da agência {agency_name} - Data: {date.strftime("%d/%m/%Y")}...")
+            query = read_template(file_path).format(**locals())
+
+            cancelled_transactions = self.fetch_rows(query=query, template="totalbus_agency_cancelled_transactions")
+
+            cancelled_transactions = [TotalBusAggregate.from_row(row) for row in cancelled_transactions]
+
+            self.add_to_cache(cache_key, cancelled_transactions)
+            return cancelled_transactions
         except Exception as e:
             logger.error(f"Não foi possível buscar as transações da agência {agency_name}. Cheque os logs de debug!")
             logger.error(f"Motivo: {e}")
@@ -147,7 +247,7 @@ class TotalBus(BaseDBConnector):
         #
         # A função não irá executar se o nome da agência não for passado, assim retornando None.
         #
-        # Ao passar os parâmetros, a função deve retornar as transações extras em um dicionário, contendo as seguintes chaves:
+        # Ao passar os parâmetros, a função deve retornar as transações extras em uma lista de ExtraEvent, com os campos:
         # - Descrição - O que é a transação (ex: multa, excesso de bagagem, etc.)
         # - Natureza - Se é receita ou despesa (obs: pode vir como [NULL])
         # - Valor total - Valor total daquele tipo de transação, já somado se houver mais de uma do mesmo tipo
@@ -160,26 +260,34 @@ class TotalBus(BaseDBConnector):
 
         if date is None:
             logger.warning("Data não especificada, usando D-1...")
-            date = YESTERDAY
+            date = constants.get_yesterday()
 
         start_date = (date - timedelta(days=1)).strftime("%d-%b-%y")
         end_date = date.strftime("%d-%b-%y")
 
+        local_result = self.get_local_totals("extra_events", date, agency_name)
+
+        if local_result is not None:
+            return local_result
+
+        cache_key = ("totalbus_agency_extra_events.sql", start_date, end_date, agency_name)
+        cached_result = self.get_from_cache(cache_key)
+
+        if cached_result is not None:
+            logger.debug(f"Resultado de totalbus_agency_extra_events.sql para a agência {agency_name} reaproveitado do cache.")
+            return cached_result
+
         try:
             file_path = os.path.join(SQL_PATH, "totalbus_agency_extra_events.sql")
-            with open(file_path) as file:
-                logger.debug(f"Buscando todas as transações extras da agência {agency_name} - Data: {date.strftime("%d/%m/%Y")}...")
-                query = file.read().format(**locals())
-
-                extra_events = self.fetchmany_read_query(query=query)
-
-                extra_events = [{
-                    "associated_company": event.associated_company,
-                    "description": event.bill_description.strip(),
-                    "nature": event.nature,
-                    "total": float(event.bill_value) or 0.0
-                } for event in extra_events.itertuples()]
-                return extra_events
+            logger.debug(f"Buscando todas as transações extras da agência {agency_name} - Data: {date.strftime("%d/%m/%Y")}...")
+            query = read_template(file_path).format(**locals())
+
+            extra_events = self.fetch_rows(query=query, template="totalbus_agency_extra_events")
+
+            extra_events = [ExtraEvent.from_row(row) for row in extra_events]
+
+            self.add_to_cache(cache_key, extra_events)
+            return extra_events
         except Exception as e:
             logger.error(f"Não foi possível buscar as transações extras da ficha de remessa da agência {agency_name}. Cheque os logs de debug!")
             logger.error(f"Motivo: {e}")
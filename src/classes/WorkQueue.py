@@ -0,0 +1,233 @@
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+
+from src.utils import constants
+from src.utils.logger import logger
+
+class WorkQueue():
+    # Fila de trabalho durável para o modo distribuído (coordenador e workers), gravada em um arquivo SQLite.
+    #
+    # Cada item da fila corresponde a uma agência em uma data, com as fichas de remessa da agência no campo 'payload'.
+    # Um worker reserva um item por um tempo limitado (lease) e renova a reserva periodicamente (heartbeat). Se o
+    # worker cair, a reserva expira e outro worker assume o item, sem que o dia inteiro precise ser refeito.
+    #
+    # O SQLite faz o controle de concorrência entre processos pelo travamento do arquivo. Para workers em mais de um
+    # servidor, o arquivo deve ficar em um compartilhamento que suporte esse travamento corretamente (SMB/NFS com
+    # locks habilitados), apontado por WORK_QUEUE_PATH.
+    #
+    # Estados de um item: pending -> leased -> done, ou failed após 'max_attempts' tentativas.
+
+    def __init__(self, path: str = None, lease_seconds: int = None, max_attempts: int = 3):
+        if path is None:
+            path = os.getenv("WORK_QUEUE_PATH", os.path.join(constants.DATA_PATH, "work_queue.db"))
+
+        if lease_seconds is None:
+            lease_seconds = int(os.getenv("WORK_QUEUE_LEASE_SECONDS", "300"))
+
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.create_tables()
+
+    @contextmanager
+    def connect(self):
+        # Uma conexão por operação: conexões SQLite não podem ser compartilhadas entre threads (o heartbeat roda em
+        # uma thread separada), e abrir o arquivo é barato.
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            yield conn
+        finally:
+            conn.close()
+
+    def create_tables(self):
+        with self.connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS work_items (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    run_date TEXT NOT NULL,
+                    agency_name TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    worker_id TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    lease_expires_at REAL,
+                    heartbeat_at REAL,
+                    result TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    UNIQUE (run_date, agency_name)
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_work_items_status ON work_items (status, lease_expires_at)")
+
+    def enqueue(self, run_date: str, items: dict) -> int:
+        # Enfileira os itens de uma data ({nome da agência: lista de fichas}). Os itens que já existiam para a data
+        # são descartados, então enfileirar novamente uma data recomeça o processamento dela do zero.
+        now = time.time()
+
+        with self.connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM work_items WHERE run_date = ?", (run_date,))
+            conn.executemany(
+                "INSERT INTO work_items (run_date, agency_name, payload, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                [(run_date, agency_name, json.dumps(payload, default=str), now, now) for agency_name, payload in items.items()],
+            )
+            conn.execute("COMMIT")
+
+        return len(items)
+
+    def claim(self, worker_id: str):
+        # Reserva o próximo item disponível (pendente ou com a reserva expirada) para o worker. O BEGIN IMMEDIATE
+        # garante que dois workers não reservem o mesmo item. Retorna o item (sqlite3.Row) ou None se a fila estiver vazia.
+        now = time.time()
+
+        with self.connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            self.release_expired_leases(conn, now)
+
+            item = conn.execute(
+                "SELECT id FROM work_items WHERE status = 'pending' ORDER BY id LIMIT 1"
+            ).fetchone()
+
+            if item is None:
+                conn.execute("COMMIT")
+                return None
+
+            item = conn.execute(
+                """
+                UPDATE work_items
+                SET status = 'leased', worker_id = ?, attempts = attempts + 1, lease_expires_at = ?, heartbeat_at = ?, updated_at = ?
+                WHERE id = ?
+                RETURNING *
+                """,
+                (worker_id, now + self.lease_seconds, now, now, item["id"]),
+            ).fetchall()[0]
+            conn.execute("COMMIT")
+
+        return item
+
+    def release_expired_leases(self, conn: sqlite3.Connection, now: float):
+        # Devolve para a fila os itens cuja reserva expirou (worker caído), ou os dá como falhos se já atingiram o
+        # limite de tentativas. Deve ser chamada dentro de uma transação (BEGIN IMMEDIATE).
+        conn.execute(
+            """
+            UPDATE work_items
+            SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+                error = CASE WHEN attempts >= ? THEN COALESCE(error, 'Reserva expirada após o limite de tentativas.') ELSE error END,
+                worker_id = NULL, lease_expires_at = NULL, updated_at = ?
+            WHERE status = 'leased' AND lease_expires_at < ?
+            """,
+            (self.max_attempts, self.max_attempts, now, now),
+        )
+
+    def heartbeat(self, item_id: int, worker_id: str) -> bool:
+        # Renova a reserva do item. Retorna False se o item não pertence mais ao worker (reserva expirada e assumida
+        # por outro worker), caso em que o resultado dele deve ser descartado.
+        now = time.time()
+
+        with self.connect() as conn:
+            cursor = conn.execute(
+                """
+                UPDATE work_items
+                SET lease_expires_at = ?, heartbeat_at = ?, updated_at = ?
+                WHERE id = ? AND worker_id = ? AND status = 'leased'
+                """,
+                (now + self.lease_seconds, now, now, item_id, worker_id),
+            )
+
+        return cursor.rowcount == 1
+
+    def complete(self, item_id: int, worker_id: str, result: list) -> bool:
+        now = time.time()
+
+        with self.connect() as conn:
+            cursor = conn.execute(
+                """
+                UPDATE work_items
+                SET status = 'done', result = ?, error = NULL, lease_expires_at = NULL, updated_at = ?
+                WHERE id = ? AND worker_id = ? AND status = 'leased'
+                """,
+                (json.dumps(result, default=str), now, item_id, worker_id),
+            )
+
+        return cursor.rowcount == 1
+
+    def fail(self, item_id: int, worker_id: str, error: str) -> bool:
+        # Devolve o item para a fila, ou o marca como falho se ele já atingiu o limite de tentativas.
+        now = time.time()
+
+        with self.connect() as conn:
+            cursor = conn.execute(
+                """
+                UPDATE work_items
+                SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+                    error = ?, worker_id = NULL, lease_expires_at = NULL, updated_at = ?
+                WHERE id = ? AND worker_id = ? AND status = 'leased'
+                """,
+                (self.max_attempts, error, now, item_id, worker_id),
+            )
+
+        return cursor.rowcount == 1
+
+    def get_progress(self, run_date: str) -> dict:
+        # Quantidade de itens da data em cada estado
+        with self.connect() as conn:
+            rows = conn.execute(
+                "SELECT status, COUNT(*) AS total FROM work_items WHERE run_date = ? GROUP BY status",
+                (run_date,),
+            ).fetchall()
+
+        return {row["status"]: row["total"] for row in rows}
+
+    def get_items(self, run_date: str, status: str) -> list:
+        with self.connect() as conn:
+            return conn.execute(
+                "SELECT * FROM work_items WHERE run_date = ? AND status = ? ORDER BY id",
+                (run_date, status),
+            ).fetchall()
+
+    def wait(self, run_date: str, timeout: float = None, poll_seconds: float = 5) -> bool:
+        # Aguarda até que todos os itens da data sejam concluídos ou falhem. Retorna False se o tempo limite acabar.
+        #
+        # As reservas expiradas são liberadas aqui também, não só no claim: se todos os workers caírem, ninguém mais
+        # chamaria o claim. Mesmo sem tempo limite, a espera é abandonada (False) quando há itens em aberto, nenhum
+        # reservado, e nenhum worker reservou ou renovou um item há mais que o tempo de reserva.
+        started_at = time.monotonic()
+        waiting_since = time.time()
+
+        while True:
+            now = time.time()
+
+            with self.connect() as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                self.release_expired_leases(conn, now)
+                last_heartbeat = conn.execute(
+                    "SELECT MAX(heartbeat_at) AS last_heartbeat FROM work_items WHERE run_date = ?",
+                    (run_date,),
+                ).fetchone()["last_heartbeat"]
+                conn.execute("COMMIT")
+
+            progress = self.get_progress(run_date)
+            open_items = progress.get("pending", 0) + progress.get("leased", 0)
+
+            if open_items == 0:
+                return True
+
+            if timeout is not None and time.monotonic() - started_at > timeout:
+                return False
+
+            if progress.get("leased", 0) == 0 and now - max(last_heartbeat or 0, waiting_since) > self.lease_seconds:
+                logger.error(f"Nenhum worker ativo há mais de {self.lease_seconds} segundos. Abandonando a espera...")
+                return False
+
+            logger.info(f"Aguardando workers... Progresso: {progress}")
+            time.sleep(poll_seconds)
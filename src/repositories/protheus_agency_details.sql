@@ -8,7 +8,7 @@ SELECT
 		ELSE 'ERRO'
 	END AS transaction_type,
 	gzg.GZG_DESCRI AS transaction_description,
-	gzg.GZG_VALOR AS transaction_value
+	CAST(ROUND(COALESCE(gzg.GZG_VALOR, 0) * 100, 0) AS BIGINT) AS transaction_value_cents
 FROM G6X010 g6x
 INNER JOIN GI6010 gi6
 	ON gi6.GI6_CODIGO = g6x.G6X_AGENCI
@@ -3,9 +3,9 @@ SELECT
 	gi6.GI6_DESCRI AS agency_name,
 	g6x.G6X_AGENCI AS agency_code,
 	g6x.G6X_NUMFCH AS ticket_number,
-	g6x.G6X_VLRREI AS receipt,
-	g6x.G6X_VLRDES AS expenses,
-	g6x.G6X_VLRLIQ AS net_value
+	CAST(ROUND(COALESCE(g6x.G6X_VLRREI, 0) * 100, 0) AS BIGINT) AS receipt_cents,
+	CAST(ROUND(COALESCE(g6x.G6X_VLRDES, 0) * 100, 0) AS BIGINT) AS expenses_cents,
+	CAST(ROUND(COALESCE(g6x.G6X_VLRLIQ, 0) * 100, 0) AS BIGINT) AS net_value_cents
 FROM G6X010 g6x
 INNER JOIN GI6010 gi6
 	ON gi6.GI6_CODIGO = g6x.G6X_AGENCI
@@ -1,10 +1,10 @@
 SELECT 
 	pv.empresa_id AS associated_company,
-	SUM(cj.preciopagado) AS ticket_total,
-	SUM(cj.importetaxaembarque) AS boarding_tax_total,
-	SUM(cj.importepedagio) AS toll_tax_total,
-	SUM(cj.importeoutros) AS others_total,
-	SUM(cj.importeseguro) AS insurance_total
+	CAST(ROUND(COALESCE(SUM(cj.preciopagado), 0) * 100) AS NUMBER(18)) AS ticket_total_cents,
+	CAST(ROUND(COALESCE(SUM(cj.importetaxaembarque), 0) * 100) AS NUMBER(18)) AS boarding_tax_total_cents,
+	CAST(ROUND(COALESCE(SUM(cj.importepedagio), 0) * 100) AS NUMBER(18)) AS toll_tax_total_cents,
+	CAST(ROUND(COALESCE(SUM(cj.importeoutros), 0) * 100) AS NUMBER(18)) AS others_total_cents,
+	CAST(ROUND(COALESCE(SUM(cj.importeseguro), 0) * 100) AS NUMBER(18)) AS insurance_total_cents
 FROM caja cj
 INNER JOIN tipo_venta tv
 	ON cj.tipoventa_id = tv.tipoventa_id
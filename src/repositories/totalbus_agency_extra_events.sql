@@ -2,7 +2,7 @@ SELECT
 	pv.empresa_id AS associated_company,
 	tee.desctipoevento AS bill_description,
     tee.natureza AS nature,
-	sum(COALESCE(cdp.importe,0)) AS bill_value
+	CAST(ROUND(sum(COALESCE(cdp.importe,0)) * 100) AS NUMBER(18)) AS bill_value_cents
 FROM
 	caja_diversos cd
 JOIN evento_extra ee
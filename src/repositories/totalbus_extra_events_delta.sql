@@ -0,0 +1,47 @@
+SELECT
+	cd.cajadiversos_id AS row_id,
+	ccp.feccorte AS row_time,
+	pv.nombpuntoventa AS agency_name,
+	pv.empresa_id AS associated_company,
+	tee.desctipoevento AS bill_description,
+    tee.natureza AS nature,
+	sum(COALESCE(cdp.importe,0)) AS bill_value
+FROM
+	caja_diversos cd
+JOIN evento_extra ee
+ON
+	ee.eventoextra_id = cd.eventoextra_id
+JOIN tipo_evento_extra tee
+ON
+	tee.tipoeventoextra_id = ee.tipoeventoextra_id
+JOIN caja_diversos_pago cdp
+	ON cdp.cajadiversos_id = cd.cajadiversos_id
+ JOIN conta_corrente_ptovta ccp
+	ON ccp.empresa_id = ee.empresa_id
+	AND ccp.puntoventa_id = cd.puntoventa_id
+	AND ccp.turno_id      = cd.turno_id
+	AND ccp.usuario_id    = cd.usuario_id
+	AND ccp.feccorte      = cd.feccorte
+JOIN punto_venta pv
+	ON pv.puntoventa_id = cd.puntoventa_id
+WHERE (
+	cd.indreimpresion = 0
+	OR cd.indreimpresion IS NULL
+)
+	AND ccp.feccorte >= '{start_date}'
+    AND ccp.feccorte < '{end_date}'
+	AND (
+		ccp.feccorte > TO_TIMESTAMP('{watermark_time}', 'YYYY-MM-DD HH24:MI:SS.FF6')
+		OR (ccp.feccorte = TO_TIMESTAMP('{watermark_time}', 'YYYY-MM-DD HH24:MI:SS.FF6') AND cd.cajadiversos_id > {watermark_id})
+	)
+	AND ccp.feccorte < TO_TIMESTAMP('{upper_bound}', 'YYYY-MM-DD HH24:MI:SS.FF6')
+GROUP BY
+	cd.cajadiversos_id,
+	ccp.feccorte,
+	pv.nombpuntoventa,
+	pv.empresa_id,
+	tee.desctipoevento,
+    tee.natureza
+ORDER BY
+	ccp.feccorte,
+	cd.cajadiversos_id
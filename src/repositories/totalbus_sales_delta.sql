@@ -0,0 +1,27 @@
+SELECT
+	cj.caja_id AS row_id,
+	cj.fechorventa AS row_time,
+	pv.nombpuntoventa AS agency_name,
+	pv.empresa_id AS associated_company,
+	CASE WHEN cj.indstatusboleto = 'C' THEN 1 ELSE 0 END AS cancelled,
+	COALESCE(cj.preciopagado, 0) AS ticket_total,
+	COALESCE(cj.importetaxaembarque, 0) AS boarding_tax_total,
+	COALESCE(cj.importepedagio, 0) AS toll_tax_total,
+	COALESCE(cj.importeoutros, 0) AS others_total,
+	COALESCE(cj.importeseguro, 0) AS insurance_total
+FROM caja cj
+INNER JOIN tipo_venta tv
+	ON cj.tipoventa_id = tv.tipoventa_id
+INNER JOIN punto_venta pv
+	ON pv.puntoventa_id = cj.puntoventa_id
+WHERE cj.activo = 1
+    AND cj.fechorventa >= '{start_date}'
+    AND cj.fechorventa < '{end_date}'
+	AND (
+		cj.fechorventa > TO_TIMESTAMP('{watermark_time}', 'YYYY-MM-DD HH24:MI:SS.FF6')
+		OR (cj.fechorventa = TO_TIMESTAMP('{watermark_time}', 'YYYY-MM-DD HH24:MI:SS.FF6') AND cj.caja_id > {watermark_id})
+	)
+	AND cj.fechorventa < TO_TIMESTAMP('{upper_bound}', 'YYYY-MM-DD HH24:MI:SS.FF6')
+ORDER BY
+	cj.fechorventa,
+	cj.caja_id
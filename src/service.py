@@ -0,0 +1,239 @@
+import json
+import os
+import signal
+import threading
+import traceback
+from datetime import datetime, time, timedelta
+
+from .app import App
+from .utils import constants
+from .utils.logger import logger
+
+class Service():
+    # Modo serviço: mantém uma única instância de App (e, com ela, as engines, os pools de conexão, a conexão com o
+    # duck.db e os templates em cache) e executa o comparativo em intervalos ao longo do dia.
+    #
+    # Agenda:
+    # - Antes do horário de corte, o comparativo do dia corrente é refeito a cada 'interval_minutes' minutos.
+    # - Depois do horário de corte, é feita uma passada final (comparativo, exportação e, se houver destinatários,
+    #   envio do e-mail), uma única vez por dia. Depois disso o serviço aguarda o dia seguinte.
+    # - Se a passada final de um dia não for concluída com sucesso até a meia-noite (falha, ou passada longa que
+    #   atravessou o corte), ela continua pendente e é tentada novamente a cada intervalo, antes das passadas do dia
+    #   novo, até ser concluída ou até falhar 'max_final_attempts' vezes (SERVICE_FINAL_MAX_ATTEMPTS, padrão: 5).
+    #   Nesse caso o dia é registrado como falho no log e no arquivo de status, e o serviço segue para o dia corrente.
+    #
+    # O estado do serviço é gravado em um arquivo JSON ('status_path'), que pode ser usado como health check pelo
+    # agendador ou pelo monitoramento. O dia com passada final pendente também fica nesse arquivo, e é restaurado
+    # quando o serviço é reiniciado. SIGINT e SIGTERM encerram o serviço ao fim da passada em andamento.
+
+    def __init__(self, interval_minutes: int = None, cutoff: time = None, recipients: list = None, status_path: str = None,
+                 max_final_attempts: int = None):
+        if interval_minutes is None:
+            interval_minutes = int(os.getenv("SERVICE_INTERVAL_MINUTES", "60"))
+
+        if cutoff is None:
+            cutoff = datetime.strptime(os.getenv("SERVICE_CUTOFF", "23:30"), "%H:%M").time()
+
+        if max_final_attempts is None:
+            max_final_attempts = int(os.getenv("SERVICE_FINAL_MAX_ATTEMPTS", "5"))
+
+        self.interval = timedelta(minutes=interval_minutes)
+        self.max_final_attempts = max_final_attempts
+        self.cutoff = cutoff
+        self.recipients = recipients or []
+        self.status_path = status_path or os.path.join(constants.DATA_PATH, "service_status.json")
+
+        self.app = App()
+        self.stop_event = threading.Event()
+        self.started_at = None
+        self.last_pass = None
+        self.final_pass_date = None
+        self.pending_final_date = None
+        self.final_attempts = 0
+        self.failed_final_date = None
+
+    def stop(self, signum=None, frame=None):
+        if not self.stop_event.is_set():
+            logger.warning("Sinal de encerramento recebido. O serviço será finalizado ao fim da passada em andamento...")
+            self.stop_event.set()
+
+    def write_status(self, state: str, next_pass_at: datetime = None, error: str = None):
+        # O arquivo é gravado em um temporário e depois renomeado, para que um leitor nunca veja um JSON pela metade.
+        status = {
+            "pid": os.getpid(),
+            "state": state,
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "updated_at": datetime.now().isoformat(),
+            "next_pass_at": next_pass_at.isoformat() if next_pass_at else None,
+            "final_pass_date": self.final_pass_date.isoformat() if self.final_pass_date else None,
+            "pending_final_date": self.pending_final_date.isoformat() if self.pending_final_date else None,
+            "final_attempts": self.final_attempts,
+            "failed_final_date": self.failed_final_date.isoformat() if self.failed_final_date else None,
+            "last_pass": self.last_pass,
+            "last_error": error,
+            "schedulers": self.app.get_scheduler_stats(),
+        }
+
+        try:
+            os.makedirs(os.path.dirname(self.status_path) or ".", exist_ok=True)
+            temp_path = f"{self.status_path}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as file:
+                json.dump(status, file, indent=2, ensure_ascii=False)
+            os.replace(temp_path, self.status_path)
+        except Exception as e:
+            logger.error(f"Não foi possível gravar o arquivo de status do serviço: {e}")
+
+    def restore_status(self):
+        # Restaura do arquivo de status da execução anterior os dias da última passada final e da passada final
+        # pendente, para que um reinício do serviço não perca uma passada final que ainda precisa ser refeita.
+        if not os.path.exists(self.status_path):
+            return None
+
+        try:
+            with open(self.status_path, "r", encoding="utf-8") as file:
+                previous = json.load(file)
+
+            def read_date(key):
+                return datetime.fromisoformat(previous[key]).date() if previous.get(key) else None
+
+            self.final_pass_date = read_date("final_pass_date")
+            self.pending_final_date = read_date("pending_final_date")
+            self.failed_final_date = read_date("failed_final_date")
+            self.final_attempts = int(previous.get("final_attempts") or 0)
+        except Exception as e:
+            logger.error(f"Não foi possível ler o arquivo de status anterior do serviço: {e}")
+            return None
+
+        if self.pending_final_date is not None:
+            logger.warning(
+                f"Passada final do dia {self.pending_final_date.strftime("%d/%m/%Y")} pendente desde a execução anterior "
+                f"({self.final_attempts} tentativas)."
+            )
+
+    def release_pending_final(self, today):
+        # Desiste da passada final pendente de um dia anterior que já falhou 'max_final_attempts' vezes
+        if self.pending_final_date is None or self.pending_final_date >= today or self.final_attempts < self.max_final_attempts:
+            return None
+
+        logger.error(
+            f"A passada final do dia {self.pending_final_date.strftime("%d/%m/%Y")} falhou {self.final_attempts} vezes e não "
+            f"será mais tentada. Execute o comparativo desse dia manualmente."
+        )
+        self.failed_final_date = self.pending_final_date
+        self.pending_final_date = None
+        self.final_attempts = 0
+
+    def run_pass(self, date: datetime, final: bool):
+        # Executa uma passada do comparativo. Na passada final também gera as planilhas e envia o e-mail.
+        started_at = datetime.now()
+        kind = "final" if final else "intradiária"
+        logger.info(f"Iniciando passada {kind} do dia {date.strftime("%d/%m/%Y")}...")
+
+        try:
+            status = self.app.check_shipping_tickets(date=date)
+
+            if final and status == 0:
+                status = self.app.generate_csv_files(date=date)
+
+                if status == 0 and len(self.recipients) > 0:
+                    status = self.app.send_email(date=date, recipients=self.recipients)
+        finally:
+            # Entre as passadas, o duck.db fica livre para leitura por outros processos (ex: a API de status)
+            self.app.release_duck_connector()
+
+        self.last_pass = {
+            "date": date.strftime("%Y-%m-%d"),
+            "final": final,
+            "started_at": started_at.isoformat(),
+            "finished_at": datetime.now().isoformat(),
+            "status": status,
+        }
+
+        return status
+
+    def next_pass_at(self, now: datetime) -> datetime:
+        # Antes do corte, a próxima passada é a que vier primeiro: o próximo intervalo ou o próprio horário de corte.
+        # Depois da passada final, o serviço só volta a executar no dia seguinte. Se a passada final falhar, ela é
+        # tentada novamente após um intervalo, inclusive depois da meia-noite (até 'max_final_attempts' tentativas).
+        cutoff_at = datetime.combine(now.date(), self.cutoff)
+
+        if self.pending_final_date is not None and self.pending_final_date < now.date():
+            return now + self.interval
+
+        if self.final_pass_date == now.date():
+            return datetime.combine(now.date() + timedelta(days=1), time())
+
+        if now < cutoff_at:
+            return min(now + self.interval, cutoff_at)
+
+        return now + self.interval
+
+    def run(self):
+        # Laço principal do serviço. Ao ser encerrado, retorna o status da última passada (0 para sucesso e 1 para erro).
+        self.started_at = datetime.now()
+        self.restore_status()
+
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGINT, self.stop)
+            signal.signal(signal.SIGTERM, self.stop)
+
+        logger.info(f"Serviço iniciado. Intervalo: {self.interval}. Horário de corte: {self.cutoff.strftime("%H:%M")}.")
+        self.write_status("starting")
+
+        status = 0
+
+        try:
+            while not self.stop_event.is_set():
+                now = datetime.now()
+
+                self.release_pending_final(today=now.date())
+
+                if self.pending_final_date is not None and self.pending_final_date < now.date():
+                    # A passada final de um dia anterior ainda não foi concluída e tem prioridade sobre o dia novo
+                    pass_date = self.pending_final_date
+                    final = True
+                else:
+                    pass_date = now.date()
+                    final = now >= datetime.combine(pass_date, self.cutoff)
+
+                if self.final_pass_date != pass_date:
+                    # O dia fica pendente até que a sua passada final seja concluída com sucesso
+                    if self.pending_final_date != pass_date:
+                        self.pending_final_date = pass_date
+                        self.final_attempts = 0
+
+                    self.write_status("running")
+
+                    try:
+                        status = self.run_pass(date=datetime.combine(pass_date, time()), final=final)
+                        error = None
+                    except Exception as e:
+                        logger.error(f"Erro durante a passada do serviço: {e}")
+                        tb_str = traceback.format_exc()
+                        logger.error(f"\n{tb_str}")
+                        status = 1
+                        error = str(e)
+
+                    if final and status == 0:
+                        self.final_pass_date = pass_date
+                        self.pending_final_date = None
+                        self.final_attempts = 0
+                    elif final:
+                        self.final_attempts += 1
+                        self.release_pending_final(today=datetime.now().date())
+                else:
+                    error = None
+
+                next_pass_at = self.next_pass_at(datetime.now())
+                self.write_status("idle", next_pass_at=next_pass_at, error=error)
+                logger.info(f"Próxima passada às {next_pass_at.strftime("%d/%m/%Y %H:%M")}.")
+
+                # Event.wait acorda imediatamente quando um sinal de encerramento chega
+                self.stop_event.wait(max((next_pass_at - datetime.now()).total_seconds(), 1))
+        finally:
+            self.write_status("stopping")
+            self.app.close()
+            self.write_status("stopped")
+            logger.info("Serviço encerrado.")
+
+        return status
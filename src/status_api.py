@@ -0,0 +1,319 @@
+import json
+import os
+import re
+import threading
+import traceback
+from collections import OrderedDict
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from .utils import constants
+from .utils.logger import logger
+
+class StatusAPI():
+    # API HTTP/JSON somente leitura sobre o duck.db, para consultas pontuais aos resultados do comparativo sem
+    # precisar gerar as planilhas de novo ou consultar o Protheus e o TotalBus.
+    #
+    # Rotas (todas GET, com paginação por 'page' e 'page_size'):
+    # - /health: estado da API e versão dos dados
+    # - /tickets: fichas verificadas e pendentes, com filtros 'status' (valid, incongruent ou unchecked), 'date'
+    #   (data da ficha, YYYY-MM-DD), 'agency' (nome ou código da agência) e 'company' (empresa)
+    # - /agencies: resumos diários por agência (daily_agency_summary), com filtros 'date' ou 'start'/'end', 'agency',
+    #   'company' e 'status' (valid ou incongruent)
+    #
+    # Nas rotas /tickets e /agencies, o filtro 'tenant' consulta os resultados de um tenant da execução multi-tenant
+    # (schema tenant_<nome>, ver tenants.py) em vez do schema principal.
+    #
+    # Cada consulta abre uma conexão somente leitura com o duck.db e a fecha em seguida, para que o arquivo fique
+    # livre para as execuções do comparativo. Enquanto uma execução estiver gravando, a API responde 503.
+    #
+    # As respostas ficam em cache (padrão: STATUS_API_CACHE_SIZE = 256 respostas). O cache é descartado sempre que a
+    # versão dos dados muda, ou seja, quando o DuckConnector grava uma nova execução (ver mark_data_changed).
+
+    MAX_PAGE_SIZE = 1000
+
+    TICKET_TABLES = {
+        "valid": ("valid_tickets", "observacao"),
+        "incongruent": ("incongruent_tickets", "motivo_erro"),
+        "unchecked": ("unchecked_tickets", "motivo"),
+    }
+
+    def __init__(self, host: str = None, port: int = None, cache_size: int = None, db_path: str = None):
+        if host is None:
+            host = os.getenv("STATUS_API_HOST", "127.0.0.1")
+
+        if port is None:
+            port = int(os.getenv("STATUS_API_PORT", "8080"))
+
+        if cache_size is None:
+            cache_size = int(os.getenv("STATUS_API_CACHE_SIZE", "256"))
+
+        self.host = host
+        self.port = port
+        self.db_path = db_path or os.path.join(constants.DATA_PATH, "duck.db")
+        self.version_path = f"{self.db_path}.version"
+
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.cache_version = None
+        self.cache_lock = threading.Lock()
+
+    def get_data_version(self):
+        # A versão dos dados é o conteúdo do arquivo de versão gravado pelo DuckConnector a cada escrita
+        try:
+            with open(self.version_path, encoding="utf-8") as file:
+                return file.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def get_cached(self, key, version):
+        with self.cache_lock:
+            if self.cache_version != version:
+                self.cache.clear()
+                self.cache_version = version
+                return None
+
+            if key not in self.cache:
+                return None
+
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+    def add_to_cache(self, key, version, response):
+        with self.cache_lock:
+            if self.cache_version != version:
+                return
+
+            self.cache[key] = response
+
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def get_schema(self, filters: dict) -> str:
+        if "tenant" not in filters:
+            return "main"
+
+        if not re.fullmatch(r"[a-z][a-z0-9_]*", filters["tenant"]):
+            raise ValueError(f"Tenant inválido: '{filters["tenant"]}'.")
+
+        return f"tenant_{filters["tenant"]}"
+
+    def query(self, sql: str, params: list, schema: str = "main") -> tuple:
+        # Executa a consulta em uma conexão somente leitura e retorna (colunas, linhas)
+        import duckdb
+
+        duck_connection = duckdb.connect(self.db_path, read_only=True)
+
+        try:
+            if schema != "main":
+                duck_connection.execute(f"SET schema = '{schema}'")
+
+            result = duck_connection.execute(sql, params)
+            columns = [column[0] for column in result.description]
+            return columns, result.fetchall()
+        finally:
+            duck_connection.close()
+
+    def get_tables(self, schema: str = "main") -> dict:
+        # Retorna {tabela: colunas} do schema. As tabelas de resultados gravadas antes da coluna empresa existir
+        # ainda não a têm.
+        _, rows = self.query("SELECT table_name, column_name FROM information_schema.columns WHERE table_schema = ?", [schema])
+        tables = {}
+
+        for table_name, column_name in rows:
+            tables.setdefault(table_name, set()).add(column_name)
+
+        return tables
+
+    def paginate(self, sql: str, params: list, filters: dict) -> dict:
+        page = max(int(filters.get("page", "1")), 1)
+        page_size = min(max(int(filters.get("page_size", "100")), 1), self.MAX_PAGE_SIZE)
+
+        schema = self.get_schema(filters)
+        _, total = self.query(f"SELECT COUNT(*) FROM ({sql})", params, schema)
+        columns, rows = self.query(f"{sql} LIMIT ? OFFSET ?", params + [page_size, (page - 1) * page_size], schema)
+
+        return {
+            "page": page,
+            "page_size": page_size,
+            "total": total[0][0],
+            "items": [dict(zip(columns, row)) for row in rows],
+        }
+
+    def get_tickets(self, filters: dict) -> dict:
+        statuses = [filters["status"]] if "status" in filters else list(self.TICKET_TABLES)
+
+        for status in statuses:
+            if status not in self.TICKET_TABLES:
+                raise ValueError(f"Status inválido: '{status}'. Utilize valid, incongruent ou unchecked.")
+
+        tables = self.get_tables(self.get_schema(filters))
+        selects = []
+
+        for status in statuses:
+            table_name, message_column = self.TICKET_TABLES[status]
+
+            if table_name not in tables:
+                continue
+
+            company_column = "empresa" if "empresa" in tables[table_name] else "CAST(NULL AS VARCHAR)"
+            selects.append(f"""
+                SELECT
+                    '{status}' AS status,
+                    nome_agencia,
+                    cod_agencia_protheus,
+                    num_ficha_protheus,
+                    {company_column} AS empresa,
+                    {message_column} AS mensagem,
+                    data_processamento
+                FROM {table_name}
+            """)
+
+        if len(selects) == 0:
+            return {"page": 1, "page_size": 0, "total": 0, "items": []}
+
+        conditions = []
+        params = []
+
+        if "date" in filters:
+            # O número da ficha do Protheus é a data da ficha (YYYYMMDD)
+            conditions.append("num_ficha_protheus = ?")
+            params.append(parse_date(filters["date"]).strftime("%Y%m%d"))
+
+        if "agency" in filters:
+            conditions.append("(nome_agencia ILIKE ? OR cod_agencia_protheus = ?)")
+            params += [f"%{filters["agency"]}%", filters["agency"]]
+
+        if "company" in filters:
+            conditions.append("empresa = ?")
+            params.append(filters["company"])
+
+        sql = f"""
+            SELECT *
+            FROM ({" UNION ALL ".join(selects)})
+            WHERE {" AND ".join(conditions) or "1=1"}
+            ORDER BY num_ficha_protheus DESC, status, nome_agencia
+        """
+        return self.paginate(sql, params, filters)
+
+    def get_agencies(self, filters: dict) -> dict:
+        if "daily_agency_summary" not in self.get_tables(self.get_schema(filters)):
+            return {"page": 1, "page_size": 0, "total": 0, "items": []}
+
+        conditions = []
+        params = []
+
+        if "date" in filters:
+            conditions.append("data_ficha = ?")
+            params.append(parse_date(filters["date"]).date())
+
+        if "start" in filters:
+            conditions.append("data_ficha >= ?")
+            params.append(parse_date(filters["start"]).date())
+
+        if "end" in filters:
+            conditions.append("data_ficha <= ?")
+            params.append(parse_date(filters["end"]).date())
+
+        if "agency" in filters:
+            conditions.append("(nome_agencia ILIKE ? OR cod_agencia_protheus = ?)")
+            params += [f"%{filters["agency"]}%", filters["agency"]]
+
+        if "company" in filters:
+            conditions.append("empresa = ?")
+            params.append(filters["company"])
+
+        if "status" in filters:
+            if filters["status"] not in ("valid", "incongruent"):
+                raise ValueError(f"Status inválido: '{filters["status"]}'. Utilize valid ou incongruent.")
+
+            conditions.append("fichas_discrepantes > 0" if filters["status"] == "incongruent" else "fichas_discrepantes = 0")
+
+        sql = f"""
+            SELECT *
+            FROM daily_agency_summary
+            WHERE {" AND ".join(conditions) or "1=1"}
+            ORDER BY data_ficha DESC, empresa, nome_agencia
+        """
+        return self.paginate(sql, params, filters)
+
+    def handle(self, path: str, filters: dict) -> tuple:
+        # Retorna (código HTTP, corpo da resposta)
+        version = self.get_data_version()
+
+        if path == "/health":
+            return 200, {"status": "ok", "data_version": version}
+
+        routes = {"/tickets": self.get_tickets, "/agencies": self.get_agencies}
+
+        if path not in routes:
+            return 404, {"error": f"Rota não encontrada: {path}"}
+
+        key = (path, tuple(sorted(filters.items())))
+        cached = self.get_cached(key, version)
+
+        if cached is not None:
+            return 200, cached
+
+        import duckdb
+
+        try:
+            response = routes[path](filters)
+        except ValueError as e:
+            return 400, {"error": str(e)}
+        except (duckdb.IOException, duckdb.ConnectionException) as e:
+            logger.warning(f"duck.db indisponível para leitura: {e}")
+            return 503, {"error": "O duck.db está em uso por uma execução do comparativo. Tente novamente em instantes."}
+
+        response["data_version"] = version
+        self.add_to_cache(key, version, response)
+        return 200, response
+
+    def run(self):
+        # Sobe o servidor HTTP e atende até receber SIGINT (Ctrl+C). Retorna 0 ao ser encerrado.
+        server = ThreadingHTTPServer((self.host, self.port), StatusRequestHandler)
+        server.api = self
+
+        logger.info(f"API de status disponível em http://{self.host}:{self.port} (duck.db: {self.db_path}).")
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logger.info("Encerrando a API de status...")
+        finally:
+            server.server_close()
+
+        return 0
+
+class StatusRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        filters = {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+        try:
+            status, body = self.server.api.handle(url.path.rstrip("/") or "/", filters)
+        except Exception as e:
+            logger.error(f"Erro ao atender a requisição {self.path}.")
+            logger.error(f"Motivo: {e}")
+            tb_str = traceback.format_exc()
+            logger.error(f"\n{tb_str}")
+            status, body = 500, {"error": "Erro interno."}
+
+        payload = json.dumps(body, default=str, ensure_ascii=False).encode("utf-8")
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} - {format % args}")
+
+def parse_date(value: str) -> datetime:
+    '''converte a data de um filtro (YYYY-MM-DD) em datetime'''
+    try:
+        return datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        raise ValueError(f"Data inválida: '{value}'. Utilize YYYY-MM-DD.")
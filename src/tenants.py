@@ -0,0 +1,308 @@
+import json
+import os
+import re
+import time
+import traceback
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+
+from .app import App
+from .utils import constants
+from .utils.logger import logger
+from .utils.profiler import profiler
+
+# Variáveis do .env (sem o prefixo do tenant) necessárias para montar a conexão com cada banco
+REQUIRED_SETTINGS = {
+    "protheus": ["PROTHEUS_SERVER", "PROTHEUS_DB", "PROTHEUS_USERNAME", "PROTHEUS_PASSWORD", "PROTHEUS_PORT"],
+    "totalbus": ["ORACLE_SERVER", "ORACLE_SID", "ORACLE_USERNAME", "ORACLE_PASSWORD", "ORACLE_PORT"],
+}
+
+@dataclass(slots=True)
+class Tenant:
+    # Um grupo de empresas/ambiente com o seu próprio Protheus e TotalBus.
+    #
+    # As credenciais continuam no .env, com o prefixo do tenant (ex: GRUPO_A_PROTHEUS_SERVER, GRUPO_A_ORACLE_SERVER).
+    # Os resultados são gravados no schema 'tenant_<nome>' do duck.db e as planilhas em 'output_path'.
+    name: str
+    env_prefix: str
+    recipients: list = field(default_factory=list)
+    output_path: str = None
+
+    @property
+    def schema(self) -> str:
+        return f"tenant_{self.name}"
+
+    def get_missing_settings(self) -> list:
+        '''retorna as variáveis de conexão do tenant que não estão definidas no ambiente'''
+        return [
+            f"{self.env_prefix}{setting}"
+            for settings in REQUIRED_SETTINGS.values()
+            for setting in settings
+            if not os.getenv(f"{self.env_prefix}{setting}")
+        ]
+
+def load_tenants(path: str = None) -> list:
+    '''lê a configuração dos tenants (padrão: TENANTS_FILE ou tenants.json) e retorna a lista de Tenant'''
+    # Formato do arquivo:
+    # [
+    #     {"name": "grupo_a", "env_prefix": "GRUPO_A_", "recipients": ["..."], "output_path": "database/csv/grupo_a"},
+    #     ...
+    # ]
+    # Apenas 'name' é obrigatório. Por padrão, 'env_prefix' é o nome em maiúsculas seguido de "_", e 'output_path'
+    # é 'database/csv/<nome>'.
+    if path is None:
+        path = os.getenv("TENANTS_FILE", "tenants.json")
+
+    with open(path, encoding="utf-8") as file:
+        entries = json.load(file)
+
+    tenants = []
+    for entry in entries:
+        name = str(entry.get("name", "")).lower()
+
+        # O nome vira parte do schema no duck.db, então só são aceitos letras, números e "_"
+        if not re.fullmatch(r"[a-z][a-z0-9_]*", name):
+            raise ValueError(f"Nome de tenant inválido: '{entry.get("name")}'. Utilize letras, números e '_'.")
+
+        if name in (tenant.name for tenant in tenants):
+            raise ValueError(f"Tenant duplicado na configuração: '{name}'.")
+
+        tenants.append(Tenant(
+            name=name,
+            env_prefix=entry.get("env_prefix", f"{name.upper()}_"),
+            recipients=entry.get("recipients", []),
+            output_path=entry.get("output_path", os.path.join(constants.CSV_PATH, name)),
+        ))
+
+    return tenants
+
+class TenantRunner():
+    # Execução multi-tenant: faz o fluxo completo (comparativo, exportação e envio do e-mail) de todos os tenants em um
+    # único processo, com até 'workers' tenants ao mesmo tempo (padrão: TENANT_WORKERS ou a quantidade de tenants).
+    #
+    # Um tenant sem as variáveis de conexão no .env (ver REQUIRED_SETTINGS) ou com uma conexão inválida é registrado
+    # com erro na etapa 'config', e os demais tenants são executados normalmente.
+    #
+    # Em vez de um processo por tenant, os tenants compartilham:
+    # - a conexão com o duck.db: cada tenant grava no seu schema (tenant_<nome>) com um cursor próprio
+    # - as engines, os pools de conexão e os escalonadores de consultas dos bancos em comum: tenants cujas credenciais
+    #   apontam para o mesmo Protheus ou TotalBus usam o mesmo pool e dividem o mesmo orçamento de concorrência
+    # - o log: cada mensagem leva o nome do tenant
+    #
+    # O resultado de cada tenant (status, etapa com erro, quantidade de fichas e duração) é gravado na tabela
+    # tenant_runs do schema principal do duck.db, que reúne as métricas de todos os tenants.
+
+    RUNS_TABLE = "tenant_runs"
+
+    def __init__(self, tenants: list, workers: int = None, diagnostics: bool = None):
+        if workers is None:
+            workers = int(os.getenv("TENANT_WORKERS", str(len(tenants))))
+
+        self.tenants = tenants
+        self.workers = max(workers, 1)
+        self.diagnostics = diagnostics
+
+    def config_failure(self, tenant, message: str) -> dict:
+        # Resultado de um tenant que não pôde ser iniciado (etapa 'config'). Os outros tenants seguem normalmente.
+        with logger.contextualize(tenant=f"[{tenant.name}] "):
+            logger.error(f"Tenant {tenant.name} não será executado: {message}")
+
+        return {
+            "tenant": tenant.name,
+            "status": 1,
+            "etapa_erro": "config",
+            "fichas_validas": None,
+            "fichas_discrepantes": None,
+            "duracao": 0.0,
+        }
+
+    def share_connections(self, apps: list, failures: dict) -> list:
+        # Conectores com a mesma string de conexão passam a usar a engine (pool) e o escalonador do primeiro deles.
+        #
+        # Um tenant cuja engine não pode ser criada (ex: string de conexão inválida) é registrado em 'failures' e fica
+        # de fora da execução. Retorna os tenants prontos para executar.
+        for source in ("protheus_connector", "totalbus_connector"):
+            shared = {}
+
+            for app in apps:
+                if app.tenant.name in failures:
+                    continue
+
+                try:
+                    connector = getattr(app, source)
+
+                    if connector.conn_string not in shared:
+                        connector.get_engine()
+                        connector.get_scheduler()
+                        shared[connector.conn_string] = connector
+                        continue
+
+                    connector.engine = shared[connector.conn_string].engine
+                    connector.scheduler = shared[connector.conn_string].scheduler
+                except Exception as e:
+                    failures[app.tenant.name] = self.config_failure(app.tenant, f"não foi possível criar a conexão ({source.split("_")[0]}): {e}")
+
+            logger.info(f"{len(apps) - len(failures)} tenants usando {len(shared)} pool(s) de conexão para {source.split("_")[0]}.")
+
+        return [app for app in apps if app.tenant.name not in failures]
+
+    def run_tenant(self, app, date: datetime, skip_preflight: bool = False, **check_options) -> dict:
+        # Fluxo completo de um tenant. Retorna o resultado que será gravado em tenant_runs.
+        tenant = app.tenant
+        started_at = time.perf_counter()
+        result = {"tenant": tenant.name, "status": 0, "etapa_erro": None}
+
+        with logger.contextualize(tenant=f"[{tenant.name}] "):
+            try:
+                sources = ["protheus", "totalbus", "duckdb"] + (["smtp"] if len(tenant.recipients) > 0 else [])
+                steps = [
+                    ("preflight", lambda: 0 if skip_preflight else app.preflight(sources=sources)),
+                    ("check", lambda: app.check_shipping_tickets(date=date, **check_options)),
+                    ("export", lambda: app.generate_csv_files(date=date)),
+                    ("send", lambda: app.send_email(date=date, recipients=tenant.recipients) if len(tenant.recipients) > 0 else 0),
+                ]
+
+                for step, run_step in steps:
+                    if run_step() != 0:
+                        result.update(status=1, etapa_erro=step)
+                        break
+            except Exception as e:
+                logger.error(f"Erro inesperado na execução do tenant {tenant.name}.")
+                logger.error(f"Motivo: {e}")
+                tb_str = traceback.format_exc()
+                logger.error(f"\n{tb_str}")
+                result.update(status=1, etapa_erro="inesperado")
+
+            result["fichas_validas"], result["fichas_discrepantes"] = self.count_tickets(app, date)
+            result["duracao"] = time.perf_counter() - started_at
+
+            if result["status"] == 0:
+                logger.success(f"Tenant {tenant.name} concluído em {result["duracao"]:.1f} s.")
+            else:
+                logger.error(f"Tenant {tenant.name} falhou na etapa {result["etapa_erro"]}.")
+
+        return result
+
+    def count_tickets(self, app, date: datetime) -> tuple:
+        # Quantidade de fichas válidas e discrepantes do tenant na data (mesma ficha exportada em generate_csv_files)
+        ticket_number = (date - timedelta(days=1)).strftime("%Y%m%d")
+        counts = []
+
+        try:
+            duck_connection = app.duck_connector.duck_connection
+
+            for table_name in ("valid_tickets", "incongruent_tickets"):
+                table_exists = duck_connection.execute(
+                    f"SELECT COUNT(*) FROM information_schema.tables WHERE table_name = '{table_name}' AND table_schema = current_schema()"
+                ).fetchone()[0]
+
+                counts.append(
+                    duck_connection.execute(f"SELECT COUNT(*) FROM {table_name} WHERE num_ficha_protheus = {ticket_number}").fetchone()[0]
+                    if table_exists else 0
+                )
+        except Exception as e:
+            logger.warning(f"Não foi possível contar as fichas do tenant {app.tenant.name}: {e}")
+            return None, None
+
+        return tuple(counts)
+
+    def write_runs(self, duck_connector, run_id: str, date: datetime, results: list):
+        duck_connection = duck_connector.duck_connection
+        duck_connection.execute(f"""
+            CREATE TABLE IF NOT EXISTS {self.RUNS_TABLE} (
+                run_id VARCHAR,
+                tenant VARCHAR,
+                data_ficha DATE,
+                status INTEGER,
+                etapa_erro VARCHAR,
+                fichas_validas BIGINT,
+                fichas_discrepantes BIGINT,
+                duracao DOUBLE,
+                data_execucao TIMESTAMP
+            )
+        """)
+
+        executed_at = datetime.now()
+        duck_connection.executemany(
+            f"INSERT INTO {self.RUNS_TABLE} VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                [run_id, result["tenant"], date.date(), result["status"], result["etapa_erro"], result["fichas_validas"],
+                 result["fichas_discrepantes"], result["duracao"], executed_at]
+                for result in results
+            ],
+        )
+        duck_connector.mark_data_changed()
+
+    def run(self, date: datetime = None, skip_preflight: bool = False, **check_options) -> int:
+        # Executa todos os tenants. 'check_options' é repassado ao check_shipping_tickets de cada tenant (chunk_size,
+        # workers, incremental, deadline, priority). Retorna 0 se todos os tenants forem concluídos, e 1 caso contrário.
+        from concurrent.futures import ThreadPoolExecutor
+        from .classes.DuckConnector import DuckConnector
+
+        if len(self.tenants) == 0:
+            logger.error("Nenhum tenant configurado!")
+            return 1
+
+        if date is None:
+            logger.warning("Nenhuma data foi passada! Utilizando D-1...")
+            date = constants.get_yesterday()
+
+        run_id = datetime.now().strftime("%Y%m%d%H%M%S%f")
+        duck_connector = DuckConnector()
+        apps = [App(diagnostics=self.diagnostics, tenant=tenant, duck_connection=duck_connector.duck_connection) for tenant in self.tenants]
+
+        # O perfil das etapas (ver Profiler) acompanha uma etapa por vez, então os tenants não rodam ao mesmo tempo
+        workers = self.workers
+        if profiler.enabled and workers > 1:
+            logger.warning("Perfil ligado: os tenants serão executados um de cada vez, para que cada etapa tenha o seu próprio perfil.")
+            workers = 1
+
+        logger.info(f"Execução multi-tenant {run_id}: {len(apps)} tenants, até {workers} ao mesmo tempo.")
+
+        try:
+            # Os schemas são criados antes das threads, para que os tenants não disputem o catálogo do duck.db
+            for app in apps:
+                app.duck_connector
+
+            # Tenants sem as variáveis de conexão no .env falham na etapa 'config', sem impedir os demais
+            failures = {}
+            for app in apps:
+                missing = app.tenant.get_missing_settings()
+
+                if len(missing) > 0:
+                    failures[app.tenant.name] = self.config_failure(app.tenant, f"variáveis ausentes no .env: {", ".join(missing)}.")
+
+            ready_apps = self.share_connections(apps, failures)
+
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tenant") as executor:
+                finished = {result["tenant"]: result for result in executor.map(lambda app: self.run_tenant(app, date, skip_preflight, **check_options), ready_apps)}
+
+            results = [failures.get(tenant.name) or finished[tenant.name] for tenant in self.tenants]
+
+            self.write_runs(duck_connector, run_id, date, results)
+
+            # Escalonadores compartilhados aparecem uma única vez
+            schedulers = {id(connector.scheduler): connector.scheduler for app in ready_apps for connector in (app.protheus_connector, app.totalbus_connector)}
+            for scheduler in schedulers.values():
+                stats = scheduler.get_stats()
+                logger.info(
+                    f"Escalonador {stats["source"]}: {stats["completed"]} consultas, concorrência final "
+                    f"{stats["limit"]}/{stats["max_concurrency"]}, {stats["errors"]} erros, {stats["wait_time"]:.1f} s de espera na fila."
+                )
+
+            for result in results:
+                if result["etapa_erro"] == "config":
+                    logger.info(f"Tenant {result["tenant"]}: não executado (erro de configuração).")
+                    continue
+
+                logger.info(
+                    f"Tenant {result["tenant"]}: {"sucesso" if result["status"] == 0 else f"erro em {result["etapa_erro"]}"}, "
+                    f"{result["fichas_validas"]} fichas válidas, {result["fichas_discrepantes"]} discrepantes, {result["duracao"]:.1f} s."
+                )
+        finally:
+            for app in apps:
+                app.close()
+
+            duck_connector.close()
+
+        return 0 if all(result["status"] == 0 for result in results) else 1
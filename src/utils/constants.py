@@ -5,4 +5,16 @@ DATA_PATH = "database"
 SQL_PATH = os.path.join("src", "repositories")
 HTML_PATH = os.path.join("src", "html")
 CSV_PATH = os.path.join(DATA_PATH, "csv")
-YESTERDAY = datetime.now() - timedelta(days=1)
\ No newline at end of file
+SMTP_SERVER = "smtp.office365.com"
+SMTP_PORT = 587
+
+def get_yesterday() -> datetime:
+    '''retorna a data de D-1, calculada no momento da chamada'''
+    return datetime.now() - timedelta(days=1)
+
+def __getattr__(name):
+    # YESTERDAY é calculado a cada acesso (constants.YESTERDAY), para que processos longos não fiquem presos
+    # à data do momento em que o módulo foi importado.
+    if name == "YESTERDAY":
+        return get_yesterday()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -24,17 +24,25 @@ ERROR_INFO = f"app_error_{get_timestamp()}.log"
 log_size = 5
 logger.remove()  # Remove a configuração padrão do logger
 
+# Formato padrão do loguru, com o tenant da execução antes da mensagem (vazio fora do modo multi-tenant, ver tenants.py)
+# e a ficha em verificação (preenchida apenas quando as fichas são verificadas em paralelo, ver App.check_shipping_tickets)
+LOG_FORMAT = (
+    "<green>{time:YYYY-MM-DD HH:mm:ss.SSS}</green> | <level>{level: <8}</level> | "
+    "<cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - {extra[tenant]}{extra[ticket]}<level>{message}</level>"
+)
+logger.configure(extra={"tenant": "", "ticket": ""})
+
 # Logger para o terminal apenas com mensagens de nível DEBUG
-logger.add(sys.stderr, level="DEBUG")
+logger.add(sys.stderr, level="DEBUG", format=LOG_FORMAT)
 
-# Logger para o arquivo de log com mensagens de nível DEBUG
-logger.add(os.path.join(DEBUG_FOLDER, get_date(), FILE_DEBUG), rotation=f"{log_size*2} MB", compression="zip", level='DEBUG')
+# Logger para o arquivo de log com mensagens de nível DEBUG (os arquivos só são criados na primeira mensagem)
+logger.add(os.path.join(DEBUG_FOLDER, get_date(), FILE_DEBUG), rotation=f"{log_size*2} MB", compression="zip", level='DEBUG', delay=True, format=LOG_FORMAT)
 
 # Logger para o arquivo de log com mensagens de nível INFO
-logger.add(os.path.join(INFO_FOLDER, get_date(), FILE_INFO), rotation=f"{log_size} MB", compression="zip", level='INFO')
+logger.add(os.path.join(INFO_FOLDER, get_date(), FILE_INFO), rotation=f"{log_size} MB", compression="zip", level='INFO', delay=True, format=LOG_FORMAT)
 
 # Logger para o arquivo de log com mensagens de nível INFO
-logger.add(os.path.join(ERROR_FOLDER, get_date(), ERROR_INFO), rotation=f"{log_size} MB", compression="zip", level='WARNING')
+logger.add(os.path.join(ERROR_FOLDER, get_date(), ERROR_INFO), rotation=f"{log_size} MB", compression="zip", level='WARNING', delay=True, format=LOG_FORMAT)
 
 def log_execution_time(func):
     @wraps(func)
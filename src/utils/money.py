@@ -0,0 +1,22 @@
+import os
+
+# Valores monetários circulam pelo comparativo como inteiros em centavos. A conversão é feita nas próprias consultas
+# (ROUND(valor * 100) para BIGINT/NUMBER(18)), então não há float entre o banco de origem e as comparações, e o duck.db
+# recebe os valores como DECIMAL(18,2).
+#
+# A exceção são os totais da ingestão incremental (SalesIngestion), que somam os valores do Oracle sem arredondar
+# (DECIMAL(38,10)) e só são arredondados para centavos ao serem lidos, como o ROUND(SUM(valor) * 100) das consultas.
+
+def get_tolerance_cents() -> int:
+    '''retorna a diferença máxima, em centavos, para que dois valores sejam considerados iguais (MONEY_TOLERANCE_CENTS)'''
+    return int(os.getenv("MONEY_TOLERANCE_CENTS", "0"))
+
+def matches(first_cents: int, second_cents: int, tolerance_cents: int = 0) -> bool:
+    '''retorna True se os dois valores, em centavos, diferem no máximo 'tolerance_cents' centavos'''
+    return abs(first_cents - second_cents) <= tolerance_cents
+
+def format_money(cents: int) -> str:
+    '''formata um valor em centavos como moeda brasileira (ex: 123456 -> R$ 1.234,56)'''
+    sign = "-" if cents < 0 else ""
+    reais, centavos = divmod(abs(cents), 100)
+    return f"{sign}R$ {reais:,}".replace(",", ".") + f",{centavos:02}"
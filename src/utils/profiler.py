@@ -0,0 +1,250 @@
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+from functools import wraps
+
+from .logger import LOGS_FOLDER, get_date, logger
+
+PROFILE_FOLDER = os.path.join(LOGS_FOLDER, 'profile')
+
+class Profiler():
+    # Perfil de tempo e memória das etapas do App (comparativo, exportação, envio do e-mail...), ligado por
+    # PROFILE=1 (ver App) ou pela opção --profile da CLI. Desligado, o custo é apenas o de um if por etapa.
+    #
+    # Para cada etapa (ver profile_stage), são gravados em logs/profile/<data>/:
+    # - <hora>_<seq>_<etapa>_memory.txt: os maiores alocadores da etapa (diferença entre os snapshots do tracemalloc
+    #   no início e no fim), o pico de memória rastreada e o pico de RSS do processo
+    # - <hora>_<seq>_<etapa>_wall.folded: perfil de tempo de parede (wall-clock) por amostragem, no formato "folded"
+    #   (uma pilha por linha, com a quantidade de amostras), que pode ser aberto no speedscope ou convertido pelo
+    #   flamegraph.pl. Inclui o tempo de espera por consultas e E/S, e não apenas o de CPU (ver StackSampler).
+    #
+    # Apenas uma etapa é perfilada por vez, e as amostras são das threads da etapa. Por isso, o TenantRunner executa
+    # os tenants um de cada vez quando o perfil está ligado.
+    #
+    # Configuração: PROFILE_SAMPLE_INTERVAL (ms entre as amostras, padrão 10), PROFILE_TOP_ALLOCATORS (padrão 25) e
+    # PROFILE_TRACEBACK_FRAMES (quadros guardados por alocação, padrão 1).
+
+    def __init__(self):
+        self.enabled = False
+        self.sample_interval = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "10")) / 1000
+        self.top_allocators = int(os.getenv("PROFILE_TOP_ALLOCATORS", "25"))
+        self.traceback_frames = int(os.getenv("PROFILE_TRACEBACK_FRAMES", "1"))
+
+        # Etapas aninhadas (uma etapa chamando outra) são contabilizadas apenas na etapa mais externa
+        self.active_stage = None
+        self.sequence = 0
+        self.lock = threading.Lock()
+
+    def enable(self):
+        if self.enabled:
+            return
+
+        self.enabled = True
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.traceback_frames)
+
+        logger.info(f"Perfil de tempo e memória ligado. Os arquivos serão gravados em {PROFILE_FOLDER}.")
+
+    def run(self, stage: str, func, *args, **kwargs):
+        # Executa 'func' dentro da etapa 'stage', com os perfis de tempo e memória
+        with self.lock:
+            if not self.enabled or self.active_stage is not None:
+                nested = True
+            else:
+                nested = False
+                self.active_stage = stage
+                self.sequence += 1
+                sequence = self.sequence
+
+        if nested:
+            return func(*args, **kwargs)
+
+        sampler = StackSampler(self.sample_interval)
+        tracemalloc.reset_peak()
+        snapshot_before = tracemalloc.take_snapshot()
+        started_at = time.perf_counter()
+        sampler.start()
+
+        try:
+            return func(*args, **kwargs)
+        finally:
+            sampler.stop()
+            elapsed = time.perf_counter() - started_at
+            _, traced_peak = tracemalloc.get_traced_memory()
+            snapshot_after = tracemalloc.take_snapshot()
+
+            try:
+                self.write_stage(stage, sequence, elapsed, sampler, snapshot_before, snapshot_after, traced_peak)
+            except Exception as e:
+                logger.error(f"Não foi possível gravar o perfil da etapa {stage}: {e}")
+            finally:
+                with self.lock:
+                    self.active_stage = None
+
+    def write_stage(self, stage, sequence, elapsed, sampler, snapshot_before, snapshot_after, traced_peak):
+        folder = os.path.join(PROFILE_FOLDER, get_date())
+        os.makedirs(folder, exist_ok=True)
+        prefix = os.path.join(folder, f"{datetime.now().strftime("%H%M%S")}_{sequence:03}_{stage}")
+
+        # Os próprios snapshots do tracemalloc e o módulo de perfil não entram na lista de alocadores
+        filters = [
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ]
+        statistics = snapshot_after.filter_traces(filters).compare_to(snapshot_before.filter_traces(filters), "lineno")
+        top_allocators = sorted(statistics, key=lambda stat: stat.size_diff, reverse=True)[:self.top_allocators]
+        peak_rss = get_peak_rss()
+
+        with open(f"{prefix}_memory.txt", "w", encoding="utf-8") as file:
+            file.write(f"Etapa: {stage}\n")
+            file.write(f"Duração: {elapsed:.2f} s\n")
+            file.write(f"Pico de memória rastreada (tracemalloc): {format_bytes(traced_peak)}\n")
+            file.write(f"Pico de RSS do processo: {format_bytes(peak_rss) if peak_rss else "indisponível"}\n")
+            file.write(f"\nMaiores alocadores da etapa (diferença entre o início e o fim):\n")
+
+            for stat in top_allocators:
+                file.write(f"{stat}\n")
+
+        with open(f"{prefix}_wall.folded", "w", encoding="utf-8") as file:
+            for stack, count in sampler.stacks.most_common():
+                file.write(f"{stack} {count}\n")
+
+        logger.info(
+            f"Perfil da etapa {stage}: {elapsed:.2f} s, {sampler.samples} amostras ({sampler.idle} pilhas ociosas descartadas), "
+            f"pico de memória rastreada de {format_bytes(traced_peak)}, pico de RSS de "
+            f"{format_bytes(peak_rss) if peak_rss else "indisponível"}."
+        )
+
+        for stat in top_allocators[:3]:
+            logger.info(f"Alocador da etapa {stage}: {stat}")
+
+        logger.info(f"Arquivos de perfil gravados em {prefix}_*.")
+
+# Funções em que uma thread fica parada esperando (arquivo, função). Uma pilha cujo quadro mais interno é uma delas é
+# de uma thread ociosa (worker do pool sem tarefa, heartbeat, servidor HTTP aguardando conexões) e não entra no perfil.
+IDLE_FRAMES = {
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("threading.py", "join"),
+    ("thread.py", "_worker"),
+    ("selectors.py", "select"),
+}
+
+class StackSampler():
+    # Amostrador estatístico de tempo de parede (wall-clock): uma thread lê, a cada 'interval' segundos, a pilha das
+    # threads da etapa (sys._current_frames) e conta quantas vezes cada pilha apareceu. Diferente do cProfile, o custo
+    # não depende da quantidade de chamadas de função, então ele pode ficar ligado em execuções reais.
+    #
+    # As threads da etapa são a que iniciou o amostrador e as criadas depois dele (ex: o pool de verificação das
+    # fichas). Threads que já existiam (servidor HTTP, etapas de outros tenants) ficam de fora, assim como as pilhas
+    # paradas em esperas (IDLE_FRAMES). Uma thread bloqueada em uma consulta ao banco continua sendo contada.
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.idle = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.sample, name="stack-sampler", daemon=True)
+        self.excluded_threads = set()
+
+    def start(self):
+        current = threading.current_thread()
+        self.excluded_threads = {thread for thread in threading.enumerate() if thread is not current}
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def sample(self):
+        sampler_id = threading.get_ident()
+
+        while not self.stop_event.wait(self.interval):
+            threads = {thread.ident: thread for thread in threading.enumerate()}
+
+            for thread_id, frame in sys._current_frames().items():
+                thread = threads.get(thread_id)
+
+                if thread_id == sampler_id or thread is None or thread in self.excluded_threads:
+                    continue
+
+                if (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in IDLE_FRAMES:
+                    self.idle += 1
+                    continue
+
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_qualname}")
+                    frame = frame.f_back
+
+                stack.append(thread.name)
+                self.stacks[";".join(reversed(stack))] += 1
+
+            self.samples += 1
+
+def get_peak_rss():
+    '''retorna o pico de memória residente (RSS) do processo em bytes, ou None se não for possível obtê-lo'''
+    try:
+        import resource
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # No Linux o valor vem em KB, e no macOS em bytes
+        return peak if sys.platform == "darwin" else peak * 1024
+    except ImportError:
+        pass
+
+    try:
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [
+                ("cb", wintypes.DWORD),
+                ("PageFaultCount", wintypes.DWORD),
+                ("PeakWorkingSetSize", ctypes.c_size_t),
+                ("WorkingSetSize", ctypes.c_size_t),
+                ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                ("PagefileUsage", ctypes.c_size_t),
+                ("PeakPagefileUsage", ctypes.c_size_t),
+            ]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(PROCESS_MEMORY_COUNTERS)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+
+        if ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return counters.PeakWorkingSetSize
+    except Exception:
+        pass
+
+    return None
+
+def format_bytes(size: int) -> str:
+    '''formata uma quantidade de bytes em MB'''
+    return f"{size / (1024 * 1024):.1f} MB"
+
+profiler = Profiler()
+
+def profile_stage(stage: str):
+    '''decorador que executa a função como uma etapa do perfil de tempo e memória (ver Profiler)'''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return func(*args, **kwargs)
+
+            return profiler.run(stage, func, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
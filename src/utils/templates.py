@@ -0,0 +1,7 @@
+from functools import lru_cache
+
+@lru_cache(maxsize=None)
+def read_template(path: str) -> str:
+    '''retorna o conteúdo de um template (.sql ou .html), lido do disco apenas na primeira chamada'''
+    with open(path, encoding="utf-8") as file:
+        return file.read()
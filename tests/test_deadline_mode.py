@@ -0,0 +1,142 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+import pandas as pd
+
+from src.classes.Records import ShippingTicket, TotalBusAggregate
+
+# Testes do modo prazo de App.check_shipping_tickets e da limpeza da tabela unchecked_tickets, com conectores falsos
+# do Protheus e do TotalBus e o duck.db em uma pasta temporária.
+#
+# Execução, a partir da raiz do projeto: python -m unittest discover -s tests
+
+# Ficha do dia 05/05/2025, verificada e exportada na execução do dia 06/05/2025
+RUN_DATE = datetime(2025, 5, 6)
+TICKET_NUMBER = "20250505"
+
+class FakeProtheus():
+    def __init__(self, tickets: list):
+        self.tickets = tickets
+        self.scheduler = None
+        self.diagnostics = None
+
+    def get_shipping_ticket_summary(self, date=None):
+        return list(self.tickets)
+
+    def iter_shipping_ticket_summary(self, date=None, chunk_size=1000):
+        for start in range(0, len(self.tickets), chunk_size):
+            yield self.tickets[start:start + chunk_size]
+
+    def get_shipping_details(self, date=None, agency_code=None, associated_company=None):
+        return pd.DataFrame(columns=["transaction_description", "transaction_value_cents"])
+
+    def dispose(self):
+        pass
+
+class FakeTotalBus():
+    # Receita de cada agência no TotalBus, em centavos. As agências sem valor não batem com o Protheus.
+    def __init__(self, receipts: dict):
+        self.receipts = receipts
+        self.scheduler = None
+        self.diagnostics = None
+
+    def get_agency_shipping_report(self, date=None, agency_name=None):
+        return [TotalBusAggregate("01", self.receipts.get(agency_name, 1), 0, 0, 0, 0, self.receipts.get(agency_name, 1))]
+
+    def get_agency_extra_events(self, date=None, agency_name=None):
+        return []
+
+    def get_agency_cancelled_total(self, date=None, agency_name=None):
+        return []
+
+    def clear_cache(self):
+        pass
+
+    def get_cache_stats(self):
+        return {"hits": 0, "misses": 0, "size": 0}
+
+    def clear_local_totals(self):
+        pass
+
+    def dispose(self):
+        pass
+
+def ticket(number: int, receipt_cents: int) -> ShippingTicket:
+    return ShippingTicket(
+        associated_company="01 ",
+        agency_name=f"AGENCIA {number}   ",
+        agency_code=f"{number:06d} ",
+        ticket_number=TICKET_NUMBER,
+        receipt_cents=receipt_cents,
+        expenses_cents=0,
+        net_value_cents=receipt_cents,
+    )
+
+class DeadlineModeTest(unittest.TestCase):
+    def setUp(self):
+        # O duck.db e as planilhas do App são criados em ./database, então o teste roda dentro de uma pasta temporária
+        self.previous_path = os.getcwd()
+        self.temp_path = tempfile.mkdtemp()
+        os.chdir(self.temp_path)
+
+        from src.app import App
+
+        tickets = [ticket(number, 1000 * number) for number in range(1, 6)]
+
+        # AGENCIA 1 e 2 batem com o TotalBus; 3, 4 e 5 ficam discrepantes
+        self.app = App(diagnostics=False, profile=False)
+        self.app._protheus_connector = FakeProtheus(tickets)
+        self.app._totalbus_connector = FakeTotalBus({"AGENCIA 1": 1000, "AGENCIA 2": 2000})
+
+    def tearDown(self):
+        self.app.close()
+        os.chdir(self.previous_path)
+        shutil.rmtree(self.temp_path, ignore_errors=True)
+
+    def query(self, sql: str) -> list:
+        return self.app.duck_connector.duck_connection.execute(sql).fetchall()
+
+    def unchecked_export_exists(self) -> bool:
+        return os.path.exists(os.path.join(self.app.csv_path, "fichas_nao_verificadas.xlsx"))
+
+    def test_expired_deadline_records_every_ticket_as_unchecked(self):
+        # Com o prazo já esgotado (o prazo desconta a reserva para a exportação), nenhuma ficha é verificada
+        self.assertEqual(self.app.check_shipping_tickets(date=RUN_DATE, deadline=datetime.now()), 0)
+
+        self.assertEqual(
+            self.query("SELECT nome_agencia, cod_agencia_protheus, empresa, valor_receita FROM unchecked_tickets ORDER BY valor_receita DESC LIMIT 1"),
+            [("AGENCIA 5", "000005", "01", 50)],
+        )
+        self.assertEqual(self.query("SELECT COUNT(*) FROM unchecked_tickets"), [(5,)])
+        self.assertEqual(self.query("SELECT COUNT(*) FROM information_schema.tables WHERE table_name = 'daily_agency_summary'"), [(0,)])
+
+        self.assertEqual(self.app.generate_csv_files(date=RUN_DATE), 0)
+        self.assertTrue(self.unchecked_export_exists())
+
+    def test_full_rerun_clears_stale_unchecked_tickets(self):
+        self.app.check_shipping_tickets(date=RUN_DATE, deadline=datetime.now())
+        self.app.generate_csv_files(date=RUN_DATE)
+
+        self.assertEqual(self.app.check_shipping_tickets(date=RUN_DATE), 0)
+
+        self.assertEqual(self.query("SELECT COUNT(*) FROM unchecked_tickets"), [(0,)])
+        self.assertEqual(self.query("SELECT COUNT(*) FROM valid_tickets"), [(2,)])
+        self.assertEqual(self.query("SELECT COUNT(*) FROM incongruent_tickets"), [(3,)])
+        self.assertEqual(self.query("SELECT SUM(fichas_validas), SUM(fichas_discrepantes) FROM daily_agency_summary"), [(2, 3)])
+
+        self.assertEqual(self.app.generate_csv_files(date=RUN_DATE), 0)
+        self.assertFalse(self.unchecked_export_exists())
+
+    def test_chunked_rerun_clears_stale_unchecked_tickets(self):
+        self.app.check_shipping_tickets(date=RUN_DATE, deadline=datetime.now())
+
+        self.assertEqual(self.app.check_shipping_tickets(date=RUN_DATE, chunk_size=2), 0)
+
+        self.assertEqual(self.query("SELECT COUNT(*) FROM unchecked_tickets"), [(0,)])
+        self.assertEqual(self.query("SELECT COUNT(*) FROM valid_tickets"), [(2,)])
+
+if __name__ == "__main__":
+    unittest.main()
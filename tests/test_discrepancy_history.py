@@ -0,0 +1,120 @@
+import unittest
+from datetime import date, datetime
+
+import duckdb
+
+from src.classes.DiscrepancyHistory import DiscrepancyHistory, DiscrepancyRollup
+from src.classes.Records import ReconciliationResult
+
+# Testes dos resumos diários (DiscrepancyHistory) sobre um duck.db em memória.
+#
+# Execução, a partir da raiz do projeto: python -m unittest discover -s tests
+
+class FakeDuckConnector():
+    def __init__(self):
+        self.duck_connection = duckdb.connect(":memory:")
+        self.changes = 0
+
+    def mark_data_changed(self):
+        self.changes += 1
+
+def result(agency, valid=True, message="", company="01"):
+    return ReconciliationResult(
+        agency_name=agency,
+        agency_code=agency[-1].zfill(6),
+        ticket_number="20250505",
+        associated_company=company,
+        valid=valid,
+        message=message,
+    )
+
+def rollup_of(*results) -> DiscrepancyRollup:
+    rollup = DiscrepancyRollup()
+    rollup.add_all(list(results))
+    return rollup
+
+class DiscrepancyHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.duck_connector = FakeDuckConnector()
+        self.history = DiscrepancyHistory(self.duck_connector)
+
+    def tearDown(self):
+        self.duck_connector.duck_connection.close()
+
+    def query(self, sql: str) -> list:
+        return self.duck_connector.duck_connection.execute(sql).fetchall()
+
+    def test_rollup_counts_tickets_and_splits_reasons(self):
+        rollup = rollup_of(
+            result("AGENCIA 1"),
+            result("AGENCIA 1", valid=False, message=";Valor da receita não está batendo.;Multa divergente."),
+            result("AGENCIA 2", valid=False, message=";Valor da receita não está batendo."),
+        )
+
+        self.assertEqual(rollup.agencies[("01", "AGENCIA 1", "000001")], [1, 1])
+        self.assertEqual(rollup.agencies[("01", "AGENCIA 2", "000002")], [0, 1])
+        self.assertEqual(rollup.reasons[("01", "Valor da receita não está batendo.")], 2)
+        self.assertEqual(rollup.reasons[("01", "Multa divergente.")], 1)
+
+    def test_save_rollup_replaces_only_the_processed_day(self):
+        self.history.save_rollup(datetime(2025, 5, 5), rollup_of(result("AGENCIA 1", valid=False, message=";Erro A.")))
+        self.history.save_rollup(datetime(2025, 5, 6), rollup_of(
+            result("AGENCIA 1", valid=False, message=";Erro A."),
+            result("AGENCIA 2"),
+        ))
+
+        # Uma nova execução do dia 06/05 substitui as linhas do dia, sem somar às anteriores
+        self.history.save_rollup(datetime(2025, 5, 6), rollup_of(result("AGENCIA 1")))
+
+        self.assertEqual(
+            self.query("SELECT data_ficha, nome_agencia, fichas_validas, fichas_discrepantes FROM daily_agency_summary ORDER BY ALL"),
+            [(date(2025, 5, 5), "AGENCIA 1", 0, 1), (date(2025, 5, 6), "AGENCIA 1", 1, 0)],
+        )
+        self.assertEqual(
+            self.query("SELECT data_ficha, motivo, ocorrencias FROM daily_reason_summary ORDER BY ALL"),
+            [(date(2025, 5, 5), "Erro A.", 1)],
+        )
+        self.assertEqual(self.duck_connector.changes, 3)
+
+    def test_empty_rollup_keeps_the_day(self):
+        self.history.save_rollup(datetime(2025, 5, 6), rollup_of(result("AGENCIA 1")))
+
+        self.assertIsNone(self.history.save_rollup(datetime(2025, 5, 6), DiscrepancyRollup()))
+        self.assertEqual(self.query("SELECT COUNT(*) FROM daily_agency_summary"), [(1,)])
+
+    def test_discrepancy_durations_group_consecutive_checked_days(self):
+        # AGENCIA 1: discrepante em 01 e 02/05, válida em 03/05, sem ficha em 06 e 07/05 (fim de semana) e discrepante
+        # em 05 e 08/05. AGENCIA 2: discrepante só em 02/05, com o último dia verificado em 08/05.
+        days = {
+            1: [result("AGENCIA 1", valid=False, message=";Erro."), result("AGENCIA 2")],
+            2: [result("AGENCIA 1", valid=False, message=";Erro."), result("AGENCIA 2", valid=False, message=";Erro.")],
+            3: [result("AGENCIA 1"), result("AGENCIA 2")],
+            5: [result("AGENCIA 1", valid=False, message=";Erro."), result("AGENCIA 2")],
+            8: [result("AGENCIA 1", valid=False, message=";Erro."), result("AGENCIA 2")],
+        }
+
+        for day, results in days.items():
+            self.history.save_rollup(datetime(2025, 5, day), rollup_of(*results))
+
+        durations = self.history.get_discrepancy_durations(datetime(2025, 5, 1), datetime(2025, 5, 31))
+        periods = [
+            (row.nome_agencia, row.inicio.date(), row.fim.date(), row.dias_verificados, row.dias_corridos, bool(row.em_aberto))
+            for row in durations.itertuples()
+        ]
+
+        self.assertEqual(periods, [
+            ("AGENCIA 1", date(2025, 5, 5), date(2025, 5, 8), 2, 4, True),
+            ("AGENCIA 1", date(2025, 5, 1), date(2025, 5, 2), 2, 2, False),
+            ("AGENCIA 2", date(2025, 5, 2), date(2025, 5, 2), 1, 1, False),
+        ])
+
+    def test_agency_discrepancy_rates(self):
+        self.history.save_rollup(datetime(2025, 5, 5), rollup_of(result("AGENCIA 1", valid=False, message=";Erro."), result("AGENCIA 2")))
+        self.history.save_rollup(datetime(2025, 5, 6), rollup_of(result("AGENCIA 1"), result("AGENCIA 2")))
+
+        rates = self.history.get_agency_discrepancy_rates(datetime(2025, 5, 1), datetime(2025, 5, 31))
+
+        self.assertEqual(rates, {("01", "AGENCIA 1"): 0.5, ("01", "AGENCIA 2"): 0.0})
+
+if __name__ == "__main__":
+    unittest.main()
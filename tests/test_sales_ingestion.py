@@ -0,0 +1,223 @@
+import os
+import unittest
+from collections import namedtuple
+from datetime import datetime, timedelta
+from decimal import ROUND_HALF_UP, Decimal
+
+import duckdb
+
+from src.classes.SalesIngestion import SalesIngestion
+
+# Testes da ingestão incremental (SalesIngestion) sobre um duck.db em memória, com um TotalBus falso que devolve as
+# linhas do trecho lido em partições, como o stream_rows do conector real.
+#
+# Execução, a partir da raiz do projeto: python -m unittest discover -s tests
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SaleRow = namedtuple("SaleRow", [
+    "row_id", "row_time", "agency_name", "associated_company", "cancelled", "ticket_total",
+    "boarding_tax_total", "toll_tax_total", "others_total", "insurance_total",
+])
+ExtraRow = namedtuple("ExtraRow", [
+    "row_id", "row_time", "agency_name", "associated_company", "bill_description", "nature", "bill_value",
+])
+
+# Ficha do dia 06/05/2025, com as vendas do dia 05/05/2025
+TICKET_DATE = datetime(2025, 5, 6)
+SALES_DAY = datetime(2025, 5, 5)
+
+class FakeTotalBus():
+    # Devolve, a cada chamada de stream_rows, as próximas partições do template (uma lista de partições por chamada)
+    def __init__(self, reads: dict):
+        self.reads = reads
+        self.queries = []
+
+    def stream_rows(self, query, chunk_size=None, template=None):
+        self.queries.append((template, query))
+
+        for partition in self.reads[template].pop(0):
+            yield partition
+
+class FakeDuckConnector():
+    def __init__(self):
+        self.duck_connection = duckdb.connect(":memory:")
+        self.changes = 0
+
+    def mark_data_changed(self):
+        self.changes += 1
+
+# As consultas do trecho devolvem os valores do Oracle, em reais e sem arredondar
+def sale(row_id, hour, agency="AGENCIA 1", cancelled=0, ticket="10.00", boarding_tax="0.10"):
+    return SaleRow(
+        row_id, SALES_DAY + timedelta(hours=hour), agency, "01", cancelled,
+        Decimal(ticket), Decimal(boarding_tax), Decimal("0"), Decimal("0"), Decimal("0.05"),
+    )
+
+def extra(row_id, hour, agency="AGENCIA 1", value="7.50"):
+    return ExtraRow(row_id, SALES_DAY + timedelta(hours=hour), agency, "01", "MULTA ", None, Decimal(value))
+
+def live_cents(values: list) -> int:
+    '''arredonda a soma dos valores para centavos como o ROUND(SUM(valor) * 100) das consultas do TotalBus'''
+    return int((sum(Decimal(value) for value in values) * 100).quantize(Decimal("1"), rounding=ROUND_HALF_UP))
+
+class SalesIngestionTest(unittest.TestCase):
+    def setUp(self):
+        # Os templates SQL são lidos a partir da raiz do projeto
+        self.previous_path = os.getcwd()
+        os.chdir(ROOT_PATH)
+        self.duck_connector = FakeDuckConnector()
+
+    def tearDown(self):
+        self.duck_connector.duck_connection.close()
+        os.chdir(self.previous_path)
+
+    def build(self, sales_reads: list, extra_reads: list) -> SalesIngestion:
+        totalbus = FakeTotalBus({"totalbus_sales_delta": sales_reads, "totalbus_extra_events_delta": extra_reads})
+        return SalesIngestion(totalbus, self.duck_connector, lag_minutes=0)
+
+    def test_merge_accumulates_across_partitions_and_reads(self):
+        ingestion = self.build(
+            sales_reads=[
+                [[sale(1, 8), sale(2, 9)], [sale(3, 10, cancelled=1, ticket="5.00"), sale(4, 11, agency="AGENCIA 2")]],
+                [[sale(5, 12, ticket="25.00")]],
+            ],
+            extra_reads=[
+                [[extra(1, 8)], [extra(2, 9, value="2.50")]],
+                [],
+            ],
+        )
+
+        self.assertEqual(ingestion.ingest(date=TICKET_DATE), 6)
+        self.assertEqual(ingestion.ingest(date=TICKET_DATE), 1)
+
+        totals = ingestion.load_totals(date=TICKET_DATE)
+
+        agency_1 = totals["shipping_report"]["AGENCIA 1"]
+        self.assertEqual(len(agency_1), 1)
+        self.assertEqual(agency_1[0].ticket_total_cents, 1000 + 1000 + 2500)
+        self.assertEqual(agency_1[0].boarding_tax_total_cents, 30)
+        self.assertEqual(agency_1[0].total_cents, 4500 + 30 + 15)
+
+        self.assertEqual(totals["cancelled_transactions"]["AGENCIA 1"][0].ticket_total_cents, 500)
+        self.assertEqual(totals["shipping_report"]["AGENCIA 2"][0].ticket_total_cents, 1000)
+
+        extra_events = totals["extra_events"]["AGENCIA 1"]
+        self.assertEqual(len(extra_events), 1)
+        self.assertEqual(extra_events[0].description, "MULTA")
+        self.assertIsNone(extra_events[0].nature)
+        self.assertEqual(extra_events[0].total_cents, 1000)
+
+    def test_watermark_follows_last_row_and_survives_empty_reads(self):
+        ingestion = self.build(
+            sales_reads=[[[sale(7, 8), sale(9, 10)]], []],
+            extra_reads=[[], []],
+        )
+
+        ingestion.ingest(date=TICKET_DATE)
+        self.assertEqual(ingestion.get_watermark("caja", SALES_DAY.date()), (SALES_DAY + timedelta(hours=10), 9))
+
+        # Sem linhas novas, a marca d'água é mantida e o contador de linhas não muda
+        ingestion.ingest(date=TICKET_DATE)
+        self.assertEqual(ingestion.get_watermark("caja", SALES_DAY.date()), (SALES_DAY + timedelta(hours=10), 9))
+        self.assertEqual(ingestion.get_watermark("caja_diversos", SALES_DAY.date()), (SALES_DAY, -1))
+
+        rows = self.duck_connector.duck_connection.execute(
+            f"SELECT linhas FROM {SalesIngestion.WATERMARK_TABLE} WHERE fonte = 'caja'"
+        ).fetchone()[0]
+        self.assertEqual(rows, 2)
+
+        # A consulta seguinte parte da marca d'água gravada
+        last_query = ingestion.totalbus_connector.queries[-2][1]
+        self.assertIn("2025-05-05 10:00:00.000000", last_query)
+        self.assertIn("cj.caja_id > 9", last_query)
+
+    def test_failed_read_does_not_merge_or_move_watermark(self):
+        def broken_read():
+            yield [sale(1, 8)]
+            raise RuntimeError("conexão perdida")
+
+        ingestion = self.build(sales_reads=[], extra_reads=[])
+        ingestion.totalbus_connector.stream_rows = lambda query, chunk_size=None, template=None: broken_read()
+
+        with self.assertRaises(RuntimeError):
+            ingestion.ingest(date=TICKET_DATE)
+
+        totals = ingestion.load_totals(date=TICKET_DATE)
+        self.assertEqual(totals["shipping_report"], {})
+        self.assertEqual(ingestion.get_watermark("caja", SALES_DAY.date()), (SALES_DAY, -1))
+
+    def test_covers_sales_day_only_after_reading_to_end_of_day(self):
+        ingestion = self.build(sales_reads=[[[sale(1, 8)]]], extra_reads=[[[extra(1, 8)]]])
+
+        self.assertFalse(ingestion.covers_sales_day(date=TICKET_DATE))
+
+        # A ficha de um dia já encerrado é lida até a meia-noite seguinte
+        ingestion.ingest(date=TICKET_DATE)
+        self.assertTrue(ingestion.covers_sales_day(date=TICKET_DATE))
+
+        # Para o dia de vendas em andamento, a leitura para em 'agora - lag'
+        today = datetime.now()
+        ongoing = self.build(sales_reads=[[]], extra_reads=[[]])
+        ongoing.ingest(date=today + timedelta(days=1))
+        self.assertFalse(ongoing.covers_sales_day(date=today + timedelta(days=1)))
+
+    def test_rebuild_discards_totals_and_watermarks(self):
+        ingestion = self.build(
+            sales_reads=[[[sale(1, 8)]], [[sale(1, 8, ticket="3.00")]]],
+            extra_reads=[[], []],
+        )
+
+        ingestion.ingest(date=TICKET_DATE)
+        ingestion.ingest(date=TICKET_DATE, rebuild=True)
+
+        totals = ingestion.load_totals(date=TICKET_DATE)
+        self.assertEqual(totals["shipping_report"]["AGENCIA 1"][0].ticket_total_cents, 300)
+
+    def test_totals_are_rounded_once_like_the_live_queries(self):
+        # Valores com mais de duas casas decimais, divididos entre partições e leituras: arredondar cada linha daria
+        # 3 x 1001 centavos de passagens e 99 de taxas, enquanto o ROUND(SUM(valor) * 100) das consultas do TotalBus
+        # dá 3002 e 100
+        tickets = ["10.005", "10.005", "10.005"]
+        boarding_taxes = ["0.333", "0.333", "0.334"]
+        extra_values = ["1.0049", "1.0049"]
+
+        ingestion = self.build(
+            sales_reads=[
+                [[sale(1, 8, ticket=tickets[0], boarding_tax=boarding_taxes[0])], [sale(2, 9, ticket=tickets[1], boarding_tax=boarding_taxes[1])]],
+                [[sale(3, 10, ticket=tickets[2], boarding_tax=boarding_taxes[2])]],
+            ],
+            extra_reads=[[[extra(1, 8, value=extra_values[0])]], [[extra(2, 9, value=extra_values[1])]]],
+        )
+        ingestion.ingest(date=TICKET_DATE)
+        ingestion.ingest(date=TICKET_DATE)
+
+        totals = ingestion.load_totals(date=TICKET_DATE)
+        agency_1 = totals["shipping_report"]["AGENCIA 1"][0]
+
+        self.assertEqual(agency_1.ticket_total_cents, live_cents(tickets))
+        self.assertEqual(agency_1.ticket_total_cents, 3002)
+        self.assertEqual(agency_1.boarding_tax_total_cents, live_cents(boarding_taxes))
+        self.assertEqual(agency_1.boarding_tax_total_cents, 100)
+        self.assertEqual(totals["extra_events"]["AGENCIA 1"][0].total_cents, live_cents(extra_values))
+        self.assertEqual(totals["extra_events"]["AGENCIA 1"][0].total_cents, 201)
+
+    def test_totals_are_stored_unrounded_and_outdated_tables_are_dropped(self):
+        ingestion = self.build(sales_reads=[[[sale(1, 8, ticket="12.345")]]], extra_reads=[[]])
+        ingestion.ingest(date=TICKET_DATE)
+
+        self.assertEqual(
+            self.duck_connector.duck_connection.execute(f"SELECT ticket_total FROM {SalesIngestion.SALES_TABLE}").fetchone()[0],
+            Decimal("12.345"),
+        )
+
+        # Uma tabela com os valores em centavos (formato antigo) é descartada com as marcas d'água
+        self.duck_connector.duck_connection.execute(f"DROP TABLE {SalesIngestion.EXTRA_TABLE}")
+        self.duck_connector.duck_connection.execute(f"CREATE TABLE {SalesIngestion.EXTRA_TABLE} (valor_cents BIGINT)")
+
+        ingestion = self.build(sales_reads=[], extra_reads=[])
+        self.assertEqual(ingestion.load_totals(date=TICKET_DATE)["shipping_report"], {})
+        self.assertEqual(ingestion.get_watermark("caja", SALES_DAY.date()), (SALES_DAY, -1))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,196 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import date, datetime
+from types import SimpleNamespace
+from unittest import mock
+
+import duckdb
+
+from src import tenants as tenants_module
+from src.classes.QueryScheduler import QueryScheduler
+from src.tenants import REQUIRED_SETTINGS, Tenant, TenantRunner
+
+# Testes da execução multi-tenant (TenantRunner): compartilhamento das engines e dos escalonadores entre conectores com
+# a mesma string de conexão e registro dos resultados na tabela tenant_runs, com App e conectores falsos.
+#
+# Execução, a partir da raiz do projeto: python -m unittest discover -s tests
+
+RUN_DATE = datetime(2025, 5, 6)
+TICKET_NUMBER = 20250505
+
+class FakeConnector():
+    # Mesma interface de engine e escalonador dos conectores de BaseClasses, sem abrir conexões
+    def __init__(self, source_name: str, conn_string: str, fail: bool = False):
+        self.source_name = source_name
+        self.conn_string = conn_string
+        self.fail = fail
+        self.engine = None
+        self.scheduler = None
+        self.engines_created = 0
+
+    def get_engine(self):
+        if self.fail:
+            raise ValueError("string de conexão inválida")
+
+        if self.engine is None:
+            self.engine = object()
+            self.engines_created += 1
+
+        return self.engine
+
+    def get_scheduler(self):
+        if self.scheduler is None:
+            self.scheduler = QueryScheduler(self.source_name)
+
+        return self.scheduler
+
+def fake_app(name: str, protheus: str, totalbus: str, fail: bool = False):
+    return SimpleNamespace(
+        tenant=Tenant(name=name, env_prefix=f"{name.upper()}_"),
+        protheus_connector=FakeConnector("protheus", protheus),
+        totalbus_connector=FakeConnector("totalbus", totalbus, fail=fail),
+    )
+
+class FakeApp():
+    # Substitui App em TenantRunner.run. O comparativo grava as fichas válidas e discrepantes no duck.db do tenant, e
+    # 'failing_step' faz a etapa correspondente retornar 1.
+    failing_step = {}
+
+    def __init__(self, diagnostics=None, tenant=None, duck_connection=None):
+        self.tenant = tenant
+        self.duck_connector = SimpleNamespace(duck_connection=duckdb.connect(":memory:"))
+        self.protheus_connector = FakeConnector("protheus", "mssql://protheus")
+        self.totalbus_connector = FakeConnector("totalbus", f"oracle://{tenant.name}")
+
+    def step(self, name: str) -> int:
+        return 1 if self.failing_step.get(self.tenant.name) == name else 0
+
+    def preflight(self, sources=None):
+        return self.step("preflight")
+
+    def check_shipping_tickets(self, date=None, **options):
+        duck_connection = self.duck_connector.duck_connection
+        duck_connection.execute("CREATE TABLE valid_tickets AS SELECT * FROM (VALUES (?), (?)) t(num_ficha_protheus)", [TICKET_NUMBER, TICKET_NUMBER])
+        duck_connection.execute("CREATE TABLE incongruent_tickets AS SELECT * FROM (VALUES (?)) t(num_ficha_protheus)", [TICKET_NUMBER])
+        return self.step("check")
+
+    def generate_csv_files(self, date=None):
+        return self.step("export")
+
+    def send_email(self, date=None, recipients=None):
+        return self.step("send")
+
+    def close(self):
+        self.duck_connector.duck_connection.close()
+
+def tenant_settings(*names) -> dict:
+    '''retorna as variáveis de conexão de cada tenant, como se estivessem no .env'''
+    return {
+        f"{name.upper()}_{setting}": "x"
+        for name in names
+        for settings in REQUIRED_SETTINGS.values()
+        for setting in settings
+    }
+
+class ShareConnectionsTest(unittest.TestCase):
+    def test_same_connection_string_shares_engine_and_scheduler(self):
+        apps = [
+            fake_app("grupo_a", "mssql://protheus", "oracle://a"),
+            fake_app("grupo_b", "mssql://protheus", "oracle://b"),
+            fake_app("grupo_c", "mssql://protheus", "oracle://a"),
+        ]
+        failures = {}
+
+        ready = TenantRunner([app.tenant for app in apps], workers=1).share_connections(apps, failures)
+
+        self.assertEqual(failures, {})
+        self.assertEqual(len(ready), 3)
+
+        # Um único Protheus: a engine e o escalonador do primeiro conector são usados pelos outros dois
+        first = apps[0].protheus_connector
+        for app in apps[1:]:
+            self.assertIs(app.protheus_connector.engine, first.engine)
+            self.assertIs(app.protheus_connector.scheduler, first.scheduler)
+            self.assertEqual(app.protheus_connector.engines_created, 0)
+
+        # Dois TotalBus: grupo_a e grupo_c dividem o mesmo pool, grupo_b tem o seu
+        self.assertIs(apps[2].totalbus_connector.engine, apps[0].totalbus_connector.engine)
+        self.assertIs(apps[2].totalbus_connector.scheduler, apps[0].totalbus_connector.scheduler)
+        self.assertIsNot(apps[1].totalbus_connector.engine, apps[0].totalbus_connector.engine)
+        self.assertIsNot(apps[1].totalbus_connector.scheduler, apps[0].totalbus_connector.scheduler)
+
+    def test_invalid_connection_is_a_config_failure(self):
+        apps = [
+            fake_app("grupo_a", "mssql://protheus", "oracle://a", fail=True),
+            fake_app("grupo_b", "mssql://protheus", "oracle://a"),
+        ]
+        failures = {}
+
+        ready = TenantRunner([app.tenant for app in apps], workers=1).share_connections(apps, failures)
+
+        self.assertEqual([app.tenant.name for app in ready], ["grupo_b"])
+        self.assertEqual(failures["grupo_a"]["etapa_erro"], "config")
+
+        # O primeiro conector válido com a string de conexão é o que passa a ser compartilhado
+        self.assertIsNotNone(apps[1].totalbus_connector.engine)
+        self.assertEqual(apps[1].totalbus_connector.engines_created, 1)
+
+class TenantRunsTest(unittest.TestCase):
+    def setUp(self):
+        # O duck.db principal é criado em ./database, então o teste roda dentro de uma pasta temporária
+        self.previous_path = os.getcwd()
+        self.temp_path = tempfile.mkdtemp()
+        os.chdir(self.temp_path)
+
+        patcher = mock.patch.object(tenants_module, "App", FakeApp)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # grupo_c não tem as variáveis de conexão no .env
+        patcher = mock.patch.dict(os.environ, tenant_settings("grupo_a", "grupo_b"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        FakeApp.failing_step = {"grupo_b": "export"}
+
+    def tearDown(self):
+        os.chdir(self.previous_path)
+        shutil.rmtree(self.temp_path, ignore_errors=True)
+
+    def query(self, sql: str) -> list:
+        connection = duckdb.connect(os.path.join("database", "duck.db"))
+
+        try:
+            return connection.execute(sql).fetchall()
+        finally:
+            connection.close()
+
+    def run_tenants(self) -> int:
+        tenants = [Tenant(name=name, env_prefix=f"{name.upper()}_") for name in ("grupo_a", "grupo_b", "grupo_c")]
+        return TenantRunner(tenants, workers=2).run(date=RUN_DATE, skip_preflight=True)
+
+    def test_each_tenant_result_is_recorded(self):
+        self.assertEqual(self.run_tenants(), 1)
+
+        self.assertEqual(
+            self.query(f"SELECT tenant, data_ficha, status, etapa_erro, fichas_validas, fichas_discrepantes FROM {TenantRunner.RUNS_TABLE} ORDER BY tenant"),
+            [
+                ("grupo_a", date(2025, 5, 6), 0, None, 2, 1),
+                ("grupo_b", date(2025, 5, 6), 1, "export", 2, 1),
+                ("grupo_c", date(2025, 5, 6), 1, "config", None, None),
+            ],
+        )
+
+    def test_runs_are_appended_with_their_own_run_id(self):
+        self.run_tenants()
+
+        FakeApp.failing_step = {}
+        self.run_tenants()
+
+        runs = self.query(f"SELECT run_id, COUNT(*), SUM(status) FROM {TenantRunner.RUNS_TABLE} GROUP BY run_id ORDER BY run_id")
+        self.assertEqual([(rows, failed) for _, rows, failed in runs], [(3, 2), (3, 1)])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,123 @@
+import os
+import unittest
+from collections import namedtuple
+from datetime import datetime
+
+from src.classes.TotalBus import TotalBus
+
+# Testes do cache das consultas do TotalBus por (template, janela de datas, agência), com o fetch_rows trocado por um
+# falso que registra as consultas feitas ao banco.
+#
+# Execução, a partir da raiz do projeto: python -m unittest discover -s tests
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+AggregateRow = namedtuple("AggregateRow", [
+    "associated_company", "ticket_total_cents", "boarding_tax_total_cents", "toll_tax_total_cents",
+    "others_total_cents", "insurance_total_cents",
+])
+ExtraRow = namedtuple("ExtraRow", ["associated_company", "bill_description", "nature", "bill_value_cents"])
+
+TICKET_DATE = datetime(2025, 5, 6)
+
+class TotalBusCacheTest(unittest.TestCase):
+    def setUp(self):
+        # Os templates SQL são lidos a partir da raiz do projeto
+        self.previous_path = os.getcwd()
+        os.chdir(ROOT_PATH)
+
+    def tearDown(self):
+        os.chdir(self.previous_path)
+
+    def build(self, cache_size: int = 0, fail: bool = False) -> TotalBus:
+        totalbus = TotalBus(cache_size=cache_size)
+        totalbus.queries = []
+
+        def fetch_rows(query, template=None):
+            totalbus.queries.append((template, query))
+
+            if fail:
+                return None
+
+            if template == "totalbus_agency_extra_events":
+                return [ExtraRow("01", "MULTA ", None, 750)]
+
+            return [AggregateRow("01", 1000, 10, 0, 0, 5)]
+
+        totalbus.fetch_rows = fetch_rows
+        return totalbus
+
+    def test_repeated_lookup_is_served_from_cache(self):
+        totalbus = self.build()
+
+        first = totalbus.get_agency_shipping_report(date=TICKET_DATE, agency_name="AGENCIA 1")
+        second = totalbus.get_agency_shipping_report(date=TICKET_DATE, agency_name="AGENCIA 1")
+
+        self.assertEqual(len(totalbus.queries), 1)
+        self.assertIs(first, second)
+        self.assertEqual(first[0].total_cents, 1015)
+        self.assertEqual(totalbus.get_cache_stats(), {"hits": 1, "misses": 1, "size": 1})
+
+    def test_keys_are_isolated_by_template_date_and_agency(self):
+        totalbus = self.build()
+
+        totalbus.get_agency_shipping_report(date=TICKET_DATE, agency_name="AGENCIA 1")
+        totalbus.get_agency_cancelled_total(date=TICKET_DATE, agency_name="AGENCIA 1")
+        totalbus.get_agency_extra_events(date=TICKET_DATE, agency_name="AGENCIA 1")
+        totalbus.get_agency_shipping_report(date=datetime(2025, 5, 7), agency_name="AGENCIA 1")
+        totalbus.get_agency_shipping_report(date=TICKET_DATE, agency_name="AGENCIA 2")
+
+        self.assertEqual(
+            [template for template, _ in totalbus.queries],
+            [
+                "totalbus_agency_shipping_report",
+                "totalbus_agency_cancelled_transactions",
+                "totalbus_agency_extra_events",
+                "totalbus_agency_shipping_report",
+                "totalbus_agency_shipping_report",
+            ],
+        )
+        self.assertEqual(totalbus.get_cache_stats(), {"hits": 0, "misses": 5, "size": 5})
+
+        # O tipo do resultado em cache é o do template da chave
+        extra_events = totalbus.get_agency_extra_events(date=TICKET_DATE, agency_name="AGENCIA 1")
+        self.assertEqual(extra_events[0].description, "MULTA")
+        self.assertEqual(len(totalbus.queries), 5)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        totalbus = self.build(cache_size=2)
+
+        totalbus.get_agency_shipping_report(date=TICKET_DATE, agency_name="AGENCIA 1")
+        totalbus.get_agency_shipping_report(date=TICKET_DATE, agency_name="AGENCIA 2")
+
+        # A AGENCIA 1 passa a ser a mais recente, então a AGENCIA 2 é a descartada quando a AGENCIA 3 entra
+        totalbus.get_agency_shipping_report(date=TICKET_DATE, agency_name="AGENCIA 1")
+        totalbus.get_agency_shipping_report(date=TICKET_DATE, agency_name="AGENCIA 3")
+        self.assertEqual(totalbus.get_cache_stats()["size"], 2)
+
+        totalbus.get_agency_shipping_report(date=TICKET_DATE, agency_name="AGENCIA 1")
+        self.assertEqual(len(totalbus.queries), 3)
+
+        totalbus.get_agency_shipping_report(date=TICKET_DATE, agency_name="AGENCIA 2")
+        self.assertEqual(len(totalbus.queries), 4)
+        self.assertEqual(totalbus.get_cache_stats(), {"hits": 2, "misses": 4, "size": 2})
+
+    def test_errors_are_not_cached_and_clear_cache_resets_counters(self):
+        totalbus = self.build(fail=True)
+
+        self.assertIsNone(totalbus.get_agency_shipping_report(date=TICKET_DATE, agency_name="AGENCIA 1"))
+        self.assertIsNone(totalbus.get_agency_shipping_report(date=TICKET_DATE, agency_name="AGENCIA 1"))
+        self.assertEqual(len(totalbus.queries), 2)
+        self.assertEqual(totalbus.get_cache_stats(), {"hits": 0, "misses": 2, "size": 0})
+
+        totalbus = self.build()
+        totalbus.get_agency_shipping_report(date=TICKET_DATE, agency_name="AGENCIA 1")
+        totalbus.get_agency_shipping_report(date=TICKET_DATE, agency_name="AGENCIA 1")
+        totalbus.clear_cache()
+
+        self.assertEqual(totalbus.get_cache_stats(), {"hits": 0, "misses": 0, "size": 0})
+        totalbus.get_agency_shipping_report(date=TICKET_DATE, agency_name="AGENCIA 1")
+        self.assertEqual(len(totalbus.queries), 2)
+
+if __name__ == "__main__":
+    unittest.main()
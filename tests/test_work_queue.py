@@ -0,0 +1,187 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from dataclasses import asdict
+from datetime import datetime
+from unittest import mock
+
+from src.classes import WorkQueue as work_queue_module
+from src.classes.Records import ReconciliationResult
+from src.classes.WorkQueue import WorkQueue
+
+# Testes da fila de trabalho do modo distribuído (WorkQueue) e da coleta dos resultados pelo coordenador
+# (App.collect_shipping_tickets), com a fila em um arquivo SQLite temporário. O relógio do módulo da fila é trocado
+# por um relógio falso, para que as reservas expirem sem esperas reais.
+#
+# Execução, a partir da raiz do projeto: python -m unittest discover -s tests
+
+RUN_DATE = "2025-05-06"
+
+class FakeClock():
+    # Substitui o módulo 'time' dentro de WorkQueue: sleep apenas avança o relógio
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+def result(agency, valid=True, message=""):
+    return asdict(ReconciliationResult(
+        agency_name=agency,
+        agency_code=agency[-1].zfill(6),
+        ticket_number="20250505",
+        associated_company="01",
+        valid=valid,
+        message=message,
+    ))
+
+class WorkQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_path = tempfile.mkdtemp()
+        self.clock = FakeClock()
+
+        patcher = mock.patch.object(work_queue_module, "time", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.queue = WorkQueue(path=os.path.join(self.temp_path, "work_queue.db"), lease_seconds=60, max_attempts=2)
+        self.queue.enqueue(RUN_DATE, {"AGENCIA 1": [{"ficha": 1}], "AGENCIA 2": [{"ficha": 2}]})
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_path, ignore_errors=True)
+
+    def test_claim_reserves_each_item_once(self):
+        first = self.queue.claim("worker-1")
+        second = self.queue.claim("worker-2")
+
+        self.assertEqual((first["agency_name"], second["agency_name"]), ("AGENCIA 1", "AGENCIA 2"))
+        self.assertEqual(json.loads(first["payload"]), [{"ficha": 1}])
+        self.assertIsNone(self.queue.claim("worker-3"))
+        self.assertEqual(self.queue.get_progress(RUN_DATE), {"leased": 2})
+
+    def test_expired_lease_is_taken_over_and_old_worker_is_rejected(self):
+        item = self.queue.claim("worker-1")
+        other = self.queue.claim("worker-1")
+
+        # A reserva renovada não expira
+        self.clock.sleep(45)
+        self.assertTrue(self.queue.heartbeat(item["id"], "worker-1"))
+        self.assertTrue(self.queue.heartbeat(other["id"], "worker-1"))
+        self.clock.sleep(45)
+        self.assertIsNone(self.queue.claim("worker-2"))
+
+        # Sem heartbeat, a reserva expira e o item é assumido por outro worker
+        self.clock.sleep(16)
+        taken = self.queue.claim("worker-2")
+        self.assertEqual(taken["id"], item["id"])
+        self.assertEqual(taken["attempts"], 2)
+
+        self.assertFalse(self.queue.heartbeat(item["id"], "worker-1"))
+        self.assertFalse(self.queue.complete(item["id"], "worker-1", []))
+        self.assertTrue(self.queue.complete(item["id"], "worker-2", [result("AGENCIA 1")]))
+
+    def test_failed_item_is_retried_until_max_attempts(self):
+        item = self.queue.claim("worker-1")
+        self.assertTrue(self.queue.fail(item["id"], "worker-1", "erro 1"))
+        self.assertEqual(self.queue.get_items(RUN_DATE, "pending")[0]["error"], "erro 1")
+
+        item = self.queue.claim("worker-1")
+        self.assertEqual(item["attempts"], 2)
+        self.assertTrue(self.queue.fail(item["id"], "worker-1", "erro 2"))
+
+        failed = self.queue.get_items(RUN_DATE, "failed")
+        self.assertEqual([(row["agency_name"], row["error"]) for row in failed], [("AGENCIA 1", "erro 2")])
+
+    def test_wait_returns_when_all_items_are_finished(self):
+        for _ in range(2):
+            item = self.queue.claim("worker-1")
+            self.queue.complete(item["id"], "worker-1", [])
+
+        self.assertTrue(self.queue.wait(RUN_DATE, poll_seconds=1))
+
+    def test_wait_requeues_expired_leases_and_gives_up_without_workers(self):
+        # Os dois itens são reservados por um worker que cai em seguida
+        self.queue.claim("worker-1")
+        self.queue.claim("worker-1")
+
+        self.assertFalse(self.queue.wait(RUN_DATE, poll_seconds=10))
+        self.assertEqual(self.queue.get_progress(RUN_DATE), {"pending": 2})
+        self.assertIsNone(self.queue.get_items(RUN_DATE, "pending")[0]["worker_id"])
+
+    def test_wait_fails_expired_leases_after_max_attempts(self):
+        for _ in range(2):
+            self.queue.claim("worker-1")
+            self.queue.claim("worker-1")
+            self.clock.sleep(61)
+            self.queue.wait(RUN_DATE, timeout=0)
+
+        self.assertEqual(self.queue.get_progress(RUN_DATE), {"failed": 2})
+        self.assertTrue(self.queue.wait(RUN_DATE))
+
+    def test_wait_respects_timeout_while_workers_are_alive(self):
+        self.queue.claim("worker-1")
+
+        self.assertFalse(self.queue.wait(RUN_DATE, timeout=30, poll_seconds=10))
+        self.assertEqual(self.queue.get_progress(RUN_DATE), {"leased": 1, "pending": 1})
+
+class CollectShippingTicketsTest(unittest.TestCase):
+    def setUp(self):
+        # O duck.db do App é criado em ./database, então o teste roda dentro de uma pasta temporária
+        self.previous_path = os.getcwd()
+        self.temp_path = tempfile.mkdtemp()
+        os.chdir(self.temp_path)
+
+        patcher = mock.patch.dict(os.environ, {"WORK_QUEUE_PATH": os.path.join(self.temp_path, "work_queue.db")})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        from src.app import App
+
+        self.app = App(diagnostics=False, profile=False)
+        self.queue = WorkQueue()
+        self.queue.enqueue(RUN_DATE, {"AGENCIA 1": [], "AGENCIA 2": []})
+
+    def tearDown(self):
+        self.app.close()
+        os.chdir(self.previous_path)
+        shutil.rmtree(self.temp_path, ignore_errors=True)
+
+    def query(self, sql: str) -> list:
+        return self.app.duck_connector.duck_connection.execute(sql).fetchall()
+
+    def test_partial_run_writes_results_but_keeps_the_rollup(self):
+        item = self.queue.claim("worker-1")
+        self.queue.complete(item["id"], "worker-1", [result("AGENCIA 1", valid=False, message=";Erro.")])
+
+        # A AGENCIA 2 falha em todas as tentativas
+        for _ in range(self.queue.max_attempts):
+            item = self.queue.claim("worker-1")
+            self.queue.fail(item["id"], "worker-1", "erro")
+
+        self.assertEqual(self.app.collect_shipping_tickets(date=datetime(2025, 5, 6)), 1)
+
+        self.assertEqual(self.query("SELECT nome_agencia FROM incongruent_tickets"), [("AGENCIA 1",)])
+        self.assertEqual(self.query("SELECT COUNT(*) FROM information_schema.tables WHERE table_name = 'daily_agency_summary'"), [(0,)])
+
+    def test_complete_run_saves_the_rollup(self):
+        for agency, valid in (("AGENCIA 1", False), ("AGENCIA 2", True)):
+            item = self.queue.claim("worker-1")
+            self.queue.complete(item["id"], "worker-1", [result(agency, valid=valid, message="" if valid else ";Erro.")])
+
+        self.assertEqual(self.app.collect_shipping_tickets(date=datetime(2025, 5, 6)), 0)
+
+        self.assertEqual(
+            self.query("SELECT nome_agencia, fichas_validas, fichas_discrepantes FROM daily_agency_summary ORDER BY ALL"),
+            [("AGENCIA 1", 0, 1), ("AGENCIA 2", 1, 0)],
+        )
+
+if __name__ == "__main__":
+    unittest.main()